@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+import argparse
+import builtins
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+from time import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2
+
+from database import Database
+
+# End to end benchmarks of git-db commands. A throwaway PostgreSQL cluster is
+# created with initdb in a temporary directory (or an existing server is used
+# with --server), filled with a synthetic schema of the requested scale, and
+# `database pull`, an incremental pull, `patch create` and `patch apply` are run
+# in a temporary repository. Every command is timed as a whole and per phase
+# (the Database methods listed in PHASES), and the results are written as JSON
+# so runs of different commits can be compared with --compare.
+
+RESULTS_VERSION = 1
+
+# databases x schemas x tables (x partitions) with columns and indexes each;
+# `changes` is the number of table files altered for patch create/apply
+SCENARIOS = {
+    'small': {'databases': 1, 'schemas': 2, 'tables': 25, 'columns': 8,
+        'indexes': 2, 'partitions': 0, 'changes': 5},
+    'medium': {'databases': 2, 'schemas': 5, 'tables': 100, 'columns': 10,
+        'indexes': 3, 'partitions': 2, 'changes': 20},
+    # the shape of the production servers: 10,000 tables
+    'production': {'databases': 2, 'schemas': 25, 'tables': 200, 'columns': 12,
+        'indexes': 3, 'partitions': 0, 'changes': 50},
+}
+
+# Database methods timed as phases; times are inclusive, a phase called by
+# another one is counted in both
+PHASES = ['connect', 'loadCatalog', 'getFingerprints', 'createTableStructure', 'dumpTable',
+    'removeDroppedFiles', 'writeManifest', 'classifyDiff', 'checkTableDiff',
+    'pushChangesToPatchFile', 'addQueriesToPatch', 'registerPatch', 'applyPatchToDatabase']
+
+COLUMN_TYPES = ['integer', 'bigint', 'text', 'character varying(64)', 'numeric(12,2)',
+    'timestamp with time zone', 'boolean', 'jsonb', 'date', 'uuid']
+
+DATABASE_PREFIX = 'bench_'
+REMOTE = 'bench'
+
+
+class PhaseTimer:
+    # wraps the PHASES methods of Database for the duration of a `with` block
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.originals = {}
+
+    def __enter__(self):
+        for name in PHASES:
+            original = getattr(Database, name)
+            self.originals[name] = original
+            setattr(Database, name, self.wrap(name, original))
+        return self
+
+    def __exit__(self, *args):
+        for name, original in self.originals.items():
+            setattr(Database, name, original)
+
+    def wrap(self, name, original):
+        timer = self
+
+        def timed(*args, **kwargs):
+            started = time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                timer.add(name, time() - started)
+        return timed
+
+    def add(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            phase['calls'] += 1
+            phase['seconds'] += seconds
+
+
+class Cluster:
+    # a PostgreSQL cluster in a temporary directory, listening on localhost
+    def __init__(self, binDir, directory):
+        self.binDir = binDir
+        self.directory = directory
+        self.dataDir = os.path.join(directory, 'data')
+        self.host = '127.0.0.1'
+        self.port = str(getFreePort())
+        self.user = 'bench'
+        self.password = None
+
+    def program(self, name):
+        if self.binDir is not None:
+            return os.path.join(self.binDir, name)
+        return name
+
+    def start(self):
+        log = open(os.path.join(self.directory, 'initdb.log'), 'w')
+        subprocess.check_call([self.program('initdb'), '-D', self.dataDir, '-U', self.user,
+            '-A', 'trust', '-E', 'UTF8', '--no-sync'], stdout=log, stderr=log)
+        options = '-p %s -k %s -c listen_addresses=%s -c fsync=off ' \
+            '-c synchronous_commit=off -c full_page_writes=off' % (self.port, self.directory, self.host)
+        subprocess.check_call([self.program('pg_ctl'), '-D', self.dataDir, '-o', options,
+            '-l', os.path.join(self.directory, 'postgres.log'), '-w', 'start'], stdout=log, stderr=log)
+
+    def stop(self):
+        subprocess.call([self.program('pg_ctl'), '-D', self.dataDir, '-m', 'immediate', 'stop'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class Server:
+    # an existing server given with --server host:port:user[:password]
+    def __init__(self, address):
+        parts = address.split(':')
+        if len(parts) < 3:
+            raise ValueError("--server expects host:port:user[:password]")
+        self.host, self.port, self.user = parts[:3]
+        self.password = ':'.join(parts[3:]) or None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def getFreePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def connect(server, database='postgres'):
+    connection = psycopg2.connect(host=server.host, port=server.port, user=server.user,
+        password=server.password, dbname=database)
+    connection.autocommit = True
+    return connection
+
+
+def generateSchema(schema, scale):
+    # CREATE statements of one schema, a list of strings per table
+    tables = []
+    for t in range(scale['tables']):
+        table = '%s.t%04d' % (schema, t)
+        columns = ['    id bigint NOT NULL']
+        for c in range(scale['columns'] - 1):
+            columnType = COLUMN_TYPES[(t + c) % len(COLUMN_TYPES)]
+            column = '    c%02d %s' % (c, columnType)
+            if c % 3 == 0:
+                column += ' NOT NULL'
+            if columnType == 'integer' and c % 2 == 0:
+                column += ' DEFAULT 0'
+            columns.append(column)
+        statements = []
+        if scale['partitions'] > 0:
+            statements.append('CREATE TABLE %s (\n%s,\n    PRIMARY KEY (id)\n) PARTITION BY RANGE (id)'
+                % (table, ',\n'.join(columns)))
+            for p in range(scale['partitions']):
+                statements.append('CREATE TABLE %s_p%d PARTITION OF %s FOR VALUES FROM (%d) TO (%d)'
+                    % (table, p, table, p * 1000000, (p + 1) * 1000000))
+        else:
+            statements.append('CREATE TABLE %s (\n%s,\n    PRIMARY KEY (id)\n)'
+                % (table, ',\n'.join(columns)))
+        for i in range(min(scale['indexes'], scale['columns'] - 1)):
+            statements.append('CREATE INDEX t%04d_c%02d_idx ON %s (c%02d)' % (t, i, table, i))
+        tables.append(statements)
+    return tables
+
+
+def createDatabases(server, scale):
+    names = [DATABASE_PREFIX + str(d) for d in range(scale['databases'])]
+    admin = connect(server)
+    for name in names:
+        admin.cursor().execute('DROP DATABASE IF EXISTS %s' % name)
+        admin.cursor().execute('CREATE DATABASE %s' % name)
+    admin.close()
+    for name in names:
+        connection = connect(server, name)
+        cursor = connection.cursor()
+        for s in range(scale['schemas']):
+            schema = 's%03d' % s
+            cursor.execute('CREATE SCHEMA %s' % schema)
+            statements = [st for table in generateSchema(schema, scale) for st in table]
+            # a few hundred statements per round trip
+            for i in range(0, len(statements), 500):
+                cursor.execute(';\n'.join(statements[i:i + 500]))
+        connection.close()
+    return names
+
+
+def dropDatabases(server, names):
+    admin = connect(server)
+    for name in names:
+        admin.cursor().execute('DROP DATABASE IF EXISTS %s' % name)
+    admin.close()
+
+
+@contextlib.contextmanager
+def redirectOutput(logPath):
+    # git-db prints, and git/pg_dump write to the inherited descriptors
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(logPath, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+def runCommand(label, key, argv, logPath, answer=None):
+    # runs one git-db command in-process, as the git-db script does
+    result = {'command': label, 'exit_code': 0}
+    originalInput = builtins.input
+    if answer is not None:
+        builtins.input = lambda *args: answer
+    with PhaseTimer() as timer, redirectOutput(logPath):
+        started = time()
+        try:
+            Database().run(key, list(argv))
+        except SystemExit as e:
+            result['exit_code'] = e.code if isinstance(e.code, int) else 1
+        finally:
+            result['seconds'] = time() - started
+            builtins.input = originalInput
+    result['phases'] = timer.phases
+    return result
+
+
+def git(*args):
+    subprocess.check_call(['git'] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def alterTableFiles(databases, count):
+    # adds a column to the first `count` table files of the repository
+    changed = 0
+    for database in databases:
+        structure = os.path.join(database, 'structure')
+        for schema in sorted(os.listdir(structure)):
+            tables = os.path.join(structure, schema, 'tables')
+            for fileName in sorted(os.listdir(tables)):
+                if changed >= count:
+                    return changed
+                path = os.path.join(tables, fileName)
+                with open(path) as f:
+                    content = f.read()
+                # columns of partitions come from their parent table
+                if 'ATTACH PARTITION' in content or '    id bigint NOT NULL,\n' not in content:
+                    continue
+                content = content.replace('    id bigint NOT NULL,\n',
+                    '    id bigint NOT NULL,\n    benchmark_added integer DEFAULT 1,\n', 1)
+                with open(path, 'w') as f:
+                    f.write(content)
+                changed += 1
+    return changed
+
+
+def runScenario(server, scale, workDir):
+    logPath = os.path.join(workDir, 'git-db.log')
+    results = []
+    started = time()
+    databases = createDatabases(server, scale)
+    generation = time() - started
+
+    repository = os.path.join(workDir, 'repository')
+    os.mkdir(repository)
+    cwd = os.getcwd()
+    os.chdir(repository)
+    try:
+        git('init', '-q')
+        runCommand('init', 'init', [], logPath)
+        address = '%s:%s' % (server.host, server.port)
+        credentials = [server.user] + ([server.password] if server.password else [])
+        runCommand('database add', 'database', ['add', REMOTE, address] + credentials, logPath)
+
+        results.append(runCommand('database pull', 'database', ['pull', REMOTE], logPath))
+        results.append(runCommand('database pull (incremental)', 'database', ['pull', REMOTE], logPath))
+
+        git('checkout', '-q', '-b', 'benchmark')
+        runCommand('remote add', 'remote', ['add', REMOTE], logPath)
+        changed = alterTableFiles(databases, scale['changes'])
+        git('commit', '-q', '-am', 'benchmark changes')
+        results.append(runCommand('patch create', 'patch', ['create'], logPath))
+        patches = sorted(os.listdir('patches'), key=lambda p: int(p.split('_')[-1]))
+        results.append(runCommand('patch apply', 'patch',
+            ['apply', REMOTE, patches[-1]], logPath, answer='y'))
+    finally:
+        os.chdir(cwd)
+        dropDatabases(server, databases)
+    return {
+        'generation_seconds': generation,
+        'tables': scale['databases'] * scale['schemas'] * scale['tables'],
+        'changed_tables': changed,
+        'commands': results,
+    }
+
+
+def getServerVersion(server):
+    connection = connect(server)
+    cursor = connection.cursor()
+    cursor.execute('SHOW server_version')
+    version = cursor.fetchone()[0]
+    connection.close()
+    return version
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', '-C', ROOT, 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def printResults(results):
+    print('%-30s %10s' % ('command', 'seconds'))
+    for command in results['commands']:
+        status = '' if command['exit_code'] == 0 else '  (exit code %s)' % command['exit_code']
+        print('%-30s %10.3f%s' % (command['command'], command['seconds'], status))
+        phases = sorted(command['phases'].items(), key=lambda p: -p[1]['seconds'])
+        for name, phase in phases:
+            print('    %-26s %10.3f  %d calls' % (name, phase['seconds'], phase['calls']))
+
+
+def compare(basePath, otherPath):
+    with open(basePath) as f:
+        base = json.load(f)
+    with open(otherPath) as f:
+        other = json.load(f)
+    print('%-36s %10s %10s %8s' % ('', base.get('commit', '')[:10] if base.get('commit') else 'base',
+        other.get('commit', '')[:10] if other.get('commit') else 'other', 'ratio'))
+    baseCommands = dict((c['command'], c) for c in base['results']['commands'])
+    for command in other['results']['commands']:
+        baseCommand = baseCommands.get(command['command'])
+        if baseCommand is None:
+            continue
+        printComparison(command['command'], baseCommand['seconds'], command['seconds'])
+        for name, phase in command['phases'].items():
+            if name in baseCommand['phases']:
+                printComparison('    ' + name, baseCommand['phases'][name]['seconds'], phase['seconds'])
+
+
+def printComparison(label, baseSeconds, seconds):
+    ratio = seconds / baseSeconds if baseSeconds > 0 else float('inf')
+    print('%-36s %10.3f %10.3f %7.2fx' % (label, baseSeconds, seconds, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark git-db commands on a synthetic schema.')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='small')
+    for key in ['databases', 'schemas', 'tables', 'columns', 'indexes', 'partitions', 'changes']:
+        parser.add_argument('--' + key, type=int, help='overrides the scenario')
+    parser.add_argument('--server', help='use an existing server, host:port:user[:password], '
+        'instead of a temporary cluster; note that pull extracts every database of the server')
+    parser.add_argument('--pg-bin', help='directory of initdb and pg_ctl')
+    parser.add_argument('--output', help='results file, default benchmarks/results/<scenario>-<commit>.json')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'OTHER'),
+        help='compare two results files instead of running a benchmark')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    scale = dict(SCENARIOS[args.scenario])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+
+    if args.server is None and hasattr(os, 'geteuid') and os.geteuid() == 0:
+        print('[ERROR] initdb cannot run as root, run the benchmark as another user or use --server')
+        exit(1)
+
+    workDir = tempfile.mkdtemp(prefix='git-db-benchmark-')
+    server = Server(args.server) if args.server else Cluster(args.pg_bin, workDir)
+    # commits of the benchmark repository shouldn't depend on the user's git setup
+    for variable in ['GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME']:
+        os.environ[variable] = 'git-db benchmark'
+    for variable in ['GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL']:
+        os.environ[variable] = 'benchmark@localhost'
+    if server.password is None:
+        os.environ.pop('PGPASSWORD', None)
+
+    print('[INFO] scenario %s: %s' % (args.scenario, json.dumps(scale)))
+    try:
+        server.start()
+        results = {
+            'version': RESULTS_VERSION,
+            'scenario': args.scenario,
+            'scale': scale,
+            'commit': getCommit(),
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'server_version': getServerVersion(server),
+            'results': runScenario(server, scale, workDir),
+        }
+    finally:
+        server.stop()
+        if args.keep:
+            print('[INFO] temporary files kept in ' + workDir)
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    printResults(results['results'])
+    output = args.output
+    if output is None:
+        directory = os.path.join(ROOT, 'benchmarks', 'results')
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, '%s-%s.json' % (args.scenario, (results['commit'] or 'unknown')[:10]))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('[INFO] results written to ' + output)
+
+
+if __name__ == '__main__':
+    main()
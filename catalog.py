@@ -0,0 +1,681 @@
+import re
+
+import tracing
+
+# Reads the structure of a whole database from the system catalogs in a few
+# batched queries and renders per-table files in the same format as
+# `pg_dump --schema-only --table`. Tables using features the renderer does
+# not know how to reproduce exactly are reported as unsupported, so the
+# caller can fall back to pg_dump for them.
+
+SCHEMA_FILTER = '''n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname NOT LIKE 'pg\\_toast%%'
+    AND n.nspname NOT LIKE 'pg\\_temp%%' '''
+
+RELATIONS_QUERY = '''SELECT c.oid, n.nspname, c.relname, c.relkind, c.relpersistence,
+        pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(c.relname),
+        r.rolname, pg_catalog.quote_ident(r.rolname), am.amname,
+        c.relkind <> 'r' OR c.reltablespace <> 0 OR c.reloptions IS NOT NULL
+            OR c.reloftype <> 0 OR c.relispartition OR c.relrowsecurity
+            OR c.relforcerowsecurity OR c.relreplident <> 'd' OR c.relhasrules
+            OR EXISTS (SELECT 1 FROM pg_catalog.pg_inherits i WHERE i.inhrelid = c.oid)
+            OR EXISTS (SELECT 1 FROM pg_catalog.pg_policy p WHERE p.polrelid = c.oid)
+            OR EXISTS (SELECT 1 FROM pg_catalog.pg_statistic_ext s WHERE s.stxrelid = c.oid)
+            OR EXISTS (SELECT 1 FROM pg_catalog.pg_publication_rel p WHERE p.prrelid = c.oid)
+            OR EXISTS (SELECT 1 FROM pg_catalog.pg_seclabel l
+                WHERE l.objoid = c.oid AND l.classoid = 'pg_catalog.pg_class'::pg_catalog.regclass)
+            OR EXISTS (SELECT 1 FROM pg_catalog.pg_depend d
+                WHERE d.objid = c.oid AND d.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+                AND d.deptype = 'e'),
+        pg_catalog.obj_description(c.oid, 'pg_class'),
+        c.relacl::pg_catalog.text[],
+        pg_catalog.acldefault('r', c.relowner)::pg_catalog.text[]
+    FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_catalog.pg_roles r ON r.oid = c.relowner
+    LEFT JOIN pg_catalog.pg_am am ON am.oid = c.relam
+    WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f') AND ''' + SCHEMA_FILTER + '''
+    ORDER BY c.oid'''
+
+COLUMNS_QUERY = '''SELECT a.attrelid, a.attnum, a.attname, pg_catalog.quote_ident(a.attname),
+        pg_catalog.format_type(a.atttypid, a.atttypmod),
+        a.attnotnull, a.attidentity, a.attgenerated,
+        CASE WHEN a.attcollation <> t.typcollation
+            THEN pg_catalog.quote_ident(cn.nspname) || '.' || pg_catalog.quote_ident(co.collname)
+        END,
+        pg_catalog.pg_get_expr(d.adbin, d.adrelid),
+        EXISTS (SELECT 1 FROM pg_catalog.pg_depend dd
+            JOIN pg_catalog.pg_depend od
+                ON od.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+                AND od.objid = dd.refobjid AND od.refobjid = a.attrelid AND od.deptype = 'a'
+            WHERE dd.classid = 'pg_catalog.pg_attrdef'::pg_catalog.regclass
+                AND dd.objid = d.oid
+                AND dd.refclassid = 'pg_catalog.pg_class'::pg_catalog.regclass),
+        a.attstorage <> t.typstorage OR COALESCE(a.attstattarget::pg_catalog.int4, -1) <> -1
+            OR a.attoptions IS NOT NULL OR a.attacl IS NOT NULL OR NOT a.attislocal
+            %(compression)s,
+        pg_catalog.col_description(a.attrelid, a.attnum)
+    FROM pg_catalog.pg_attribute a
+    JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_catalog.pg_type t ON t.oid = a.atttypid
+    LEFT JOIN pg_catalog.pg_collation co ON co.oid = a.attcollation
+    LEFT JOIN pg_catalog.pg_namespace cn ON cn.oid = co.collnamespace
+    LEFT JOIN pg_catalog.pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+    WHERE a.attnum > 0 AND NOT a.attisdropped AND c.relkind = 'r' AND ''' + SCHEMA_FILTER + '''
+    ORDER BY a.attrelid, a.attnum'''
+
+CONSTRAINTS_QUERY = '''SELECT co.conrelid, co.conname, pg_catalog.quote_ident(co.conname), co.contype,
+        pg_catalog.pg_get_constraintdef(co.oid), co.convalidated, co.conislocal,
+        co.conparentid <> 0
+            OR pg_catalog.obj_description(co.oid, 'pg_constraint') IS NOT NULL
+            OR COALESCE(ci.reltablespace <> 0 OR ci.reloptions IS NOT NULL
+                OR i.indisclustered, false)
+    FROM pg_catalog.pg_constraint co
+    JOIN pg_catalog.pg_class c ON c.oid = co.conrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_catalog.pg_class ci ON ci.oid = co.conindid AND co.contype IN ('p', 'u', 'x')
+    LEFT JOIN pg_catalog.pg_index i ON i.indexrelid = ci.oid
+    WHERE co.contype IN ('c', 'f', 'p', 'u', 'x') AND c.relkind = 'r' AND ''' + SCHEMA_FILTER + '''
+    ORDER BY co.conrelid, co.conname'''
+
+INDEXES_QUERY = '''SELECT i.indrelid, ic.relname, pg_catalog.pg_get_indexdef(i.indexrelid),
+        i.indisclustered OR ic.reltablespace <> 0
+            OR pg_catalog.obj_description(ic.oid, 'pg_class') IS NOT NULL
+            OR EXISTS (SELECT 1 FROM pg_catalog.pg_attribute ia WHERE ia.attrelid = ic.oid
+                AND COALESCE(ia.attstattarget::pg_catalog.int4, -1) <> -1)
+    FROM pg_catalog.pg_index i
+    JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+    JOIN pg_catalog.pg_class c ON c.oid = i.indrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r' AND i.indisvalid AND ''' + SCHEMA_FILTER + '''
+        AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_constraint co
+            WHERE co.conindid = i.indexrelid AND co.conrelid = i.indrelid
+            AND co.contype IN ('p', 'u', 'x'))
+    ORDER BY i.indrelid, ic.relname'''
+
+TRIGGERS_QUERY = '''SELECT t.tgrelid, t.tgname, pg_catalog.pg_get_triggerdef(t.oid, false),
+        t.tgenabled <> 'O' OR pg_catalog.obj_description(t.oid, 'pg_trigger') IS NOT NULL
+            %(trigger_parent)s
+    FROM pg_catalog.pg_trigger t
+    JOIN pg_catalog.pg_class c ON c.oid = t.tgrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE NOT t.tgisinternal AND c.relkind = 'r' AND ''' + SCHEMA_FILTER + '''
+    ORDER BY t.tgrelid, t.tgname'''
+
+SEQUENCES_QUERY = '''SELECT d.refobjid, d.refobjsubid, d.deptype, sn.nspname, s.relname,
+        pg_catalog.quote_ident(sn.nspname) || '.' || pg_catalog.quote_ident(s.relname),
+        r.rolname, pg_catalog.quote_ident(r.rolname),
+        pg_catalog.format_type(q.seqtypid, NULL),
+        q.seqstart, q.seqincrement, q.seqmin, q.seqmax, q.seqcache, q.seqcycle,
+        s.relpersistence <> 'p' OR s.reloptions IS NOT NULL
+            OR pg_catalog.obj_description(s.oid, 'pg_class') IS NOT NULL,
+        s.relacl::pg_catalog.text[],
+        pg_catalog.acldefault('s', s.relowner)::pg_catalog.text[]
+    FROM pg_catalog.pg_depend d
+    JOIN pg_catalog.pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+    JOIN pg_catalog.pg_namespace sn ON sn.oid = s.relnamespace
+    JOIN pg_catalog.pg_roles r ON r.oid = s.relowner
+    JOIN pg_catalog.pg_sequence q ON q.seqrelid = s.oid
+    WHERE d.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+        AND d.refclassid = 'pg_catalog.pg_class'::pg_catalog.regclass
+        AND d.deptype IN ('a', 'i')
+    ORDER BY d.refobjid, s.relname'''
+
+GRANTS_QUERY = '''SELECT c.oid, u.pos, u.item::pg_catalog.text,
+        CASE WHEN x.grantee = 0 THEN 'PUBLIC' ELSE pg_catalog.quote_ident(g.rolname) END,
+        x.grantor = c.relowner, x.privilege_type, x.is_grantable
+    FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    CROSS JOIN LATERAL pg_catalog.unnest(c.relacl) WITH ORDINALITY AS u(item, pos)
+    CROSS JOIN LATERAL pg_catalog.aclexplode(ARRAY[u.item]) AS x
+    LEFT JOIN pg_catalog.pg_roles g ON g.oid = x.grantee
+    WHERE c.relacl IS NOT NULL AND c.relkind IN ('r', 'S') AND ''' + SCHEMA_FILTER + '''
+    ORDER BY c.oid, u.pos'''
+
+# a hash of every catalog row pg_dump looks at when it dumps a relation; the
+# same hash means the dumped file would be identical
+FINGERPRINTS_QUERY = '''SELECT n.nspname, c.relname, pg_catalog.md5(pg_catalog.concat_ws('|',
+        c.relkind, c.relpersistence, c.relowner::pg_catalog.regrole, c.reloptions, c.relacl,
+        c.reltablespace, c.relam, c.reloftype, c.relispartition, c.relrowsecurity,
+        c.relforcerowsecurity, c.relreplident,
+        pg_catalog.obj_description(c.oid, 'pg_class'),
+        CASE WHEN c.relkind IN ('v', 'm') THEN pg_catalog.pg_get_viewdef(c.oid) END,
+        CASE WHEN c.relkind = 'p' THEN pg_catalog.pg_get_partkeydef(c.oid) END,
+        pg_catalog.pg_get_expr(c.relpartbound, c.oid),
+        (SELECT pg_catalog.string_agg(pg_catalog.concat_ws(',', a.attname,
+                pg_catalog.format_type(a.atttypid, a.atttypmod), a.attnotnull, a.attidentity,
+                a.attgenerated, a.attcollation, a.attstorage, a.attstattarget, a.attoptions,
+                a.attacl, a.attislocal, a.attinhcount, a.attfdwoptions,
+                pg_catalog.pg_get_expr(d.adbin, d.adrelid),
+                pg_catalog.col_description(a.attrelid, a.attnum)), ';' ORDER BY a.attnum)
+            FROM pg_catalog.pg_attribute a
+            LEFT JOIN pg_catalog.pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+            WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),
+        (SELECT pg_catalog.string_agg(pg_catalog.concat_ws(',', co.conname,
+                pg_catalog.pg_get_constraintdef(co.oid), co.convalidated, co.conislocal,
+                pg_catalog.obj_description(co.oid, 'pg_constraint')), ';' ORDER BY co.conname)
+            FROM pg_catalog.pg_constraint co WHERE co.conrelid = c.oid),
+        (SELECT pg_catalog.string_agg(pg_catalog.concat_ws(',', ic.relname,
+                pg_catalog.pg_get_indexdef(i.indexrelid), i.indisclustered, i.indisvalid,
+                ic.reltablespace, pg_catalog.obj_description(ic.oid, 'pg_class')), ';'
+                ORDER BY ic.relname)
+            FROM pg_catalog.pg_index i
+            JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+            WHERE i.indrelid = c.oid),
+        (SELECT pg_catalog.string_agg(pg_catalog.concat_ws(',', t.tgname,
+                pg_catalog.pg_get_triggerdef(t.oid, false), t.tgenabled,
+                pg_catalog.obj_description(t.oid, 'pg_trigger')), ';' ORDER BY t.tgname)
+            FROM pg_catalog.pg_trigger t WHERE t.tgrelid = c.oid AND NOT t.tgisinternal),
+        (SELECT pg_catalog.string_agg(pg_catalog.concat_ws(',', r.rulename,
+                pg_catalog.pg_get_ruledef(r.oid), r.ev_enabled), ';' ORDER BY r.rulename)
+            FROM pg_catalog.pg_rewrite r WHERE r.ev_class = c.oid),
+        (SELECT pg_catalog.string_agg(pg_catalog.concat_ws(',', p.polname, p.polcmd,
+                p.polpermissive, p.polroles, pg_catalog.pg_get_expr(p.polqual, p.polrelid),
+                pg_catalog.pg_get_expr(p.polwithcheck, p.polrelid)), ';' ORDER BY p.polname)
+            FROM pg_catalog.pg_policy p WHERE p.polrelid = c.oid),
+        (SELECT pg_catalog.string_agg(i.inhparent::pg_catalog.regclass::pg_catalog.text, ';'
+                ORDER BY i.inhseqno)
+            FROM pg_catalog.pg_inherits i WHERE i.inhrelid = c.oid),
+        (SELECT pg_catalog.string_agg(pg_catalog.concat_ws(',', s.relname,
+                s.relowner::pg_catalog.regrole, s.relacl, q.seqtypid, q.seqstart,
+                q.seqincrement, q.seqmin, q.seqmax, q.seqcache, q.seqcycle,
+                pg_catalog.obj_description(s.oid, 'pg_class')), ';' ORDER BY s.relname)
+            FROM pg_catalog.pg_depend d
+            JOIN pg_catalog.pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+            JOIN pg_catalog.pg_sequence q ON q.seqrelid = s.oid
+            WHERE d.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+                AND d.refclassid = 'pg_catalog.pg_class'::pg_catalog.regclass
+                AND d.refobjid = c.oid AND d.deptype IN ('a', 'i')),
+        (SELECT pg_catalog.string_agg(x.stxname || pg_catalog.pg_get_statisticsobjdef(x.oid), ';'
+                ORDER BY x.stxname)
+            FROM pg_catalog.pg_statistic_ext x WHERE x.stxrelid = c.oid),
+        (SELECT pg_catalog.string_agg(pp.prpubid::pg_catalog.text, ';' ORDER BY pp.prpubid)
+            FROM pg_catalog.pg_publication_rel pp WHERE pp.prrelid = c.oid),
+        (SELECT pg_catalog.string_agg(l.provider || l.label, ';' ORDER BY l.provider, l.objsubid)
+            FROM pg_catalog.pg_seclabel l WHERE l.objoid = c.oid
+                AND l.classoid = 'pg_catalog.pg_class'::pg_catalog.regclass)))
+    FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f') AND ''' + SCHEMA_FILTER
+
+# privilege order used by pg_dump when it prints GRANT statements
+TABLE_PRIVILEGES = ['SELECT', 'INSERT', 'REFERENCES', 'DELETE', 'TRIGGER',
+    'TRUNCATE', 'MAINTAIN', 'UPDATE']
+SEQUENCE_PRIVILEGES = ['SELECT', 'USAGE', 'UPDATE']
+
+SEQUENCE_LIMITS = {
+    'smallint': (-32768, 32767),
+    'integer': (-2147483648, 2147483647),
+    'bigint': (-9223372036854775808, 9223372036854775807),
+}
+
+# entry ordering of pg_dump for objects that belong to a table
+PRIORITY_CONSTRAINT = 1
+PRIORITY_INDEX = 2
+PRIORITY_TRIGGER = 3
+PRIORITY_FK_CONSTRAINT = 4
+
+
+class Catalog:
+    def __init__(self, connection):
+        self.connection = connection
+        self.header = None
+        self.footer = None
+        self.dumpVersion = None
+        self.serverVersion = 0
+        self.relations = {}
+        self.relationOids = {}
+
+    def isSupportedServer(self):
+        # pg_sequence, pg_am for tables and the current pg_dump output
+        # format all require PostgreSQL 12 or newer
+        return self.serverVersion >= 120000
+
+    def load(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT pg_catalog.current_setting('server_version_num')::int")
+        self.serverVersion = cursor.fetchone()[0]
+        self.relations = {}
+        self.relationOids = {}
+        if not self.isSupportedServer():
+            return
+
+        # pg_dump runs with an empty search path, so every name printed by
+        # format_type/pg_get_expr/pg_get_*def is schema qualified
+        cursor.execute('SHOW search_path')
+        searchPath = cursor.fetchone()[0]
+        cursor.execute("SELECT pg_catalog.set_config('search_path', '', false)")
+        try:
+            for load in [self.loadRelations, self.loadColumns, self.loadConstraints,
+                    self.loadIndexes, self.loadTriggers, self.loadSequences, self.loadGrants]:
+                with tracing.span('catalog ' + load.__name__):
+                    load(cursor)
+        finally:
+            cursor.execute("SELECT pg_catalog.set_config('search_path', %s, false)",
+                (searchPath,))
+            if not self.connection.autocommit:
+                self.connection.commit()
+
+    def loadRelations(self, cursor):
+        cursor.execute(RELATIONS_QUERY)
+        for row in cursor.fetchall():
+            relation = {
+                'oid': row[0],
+                'schema': row[1],
+                'name': row[2],
+                'kind': row[3],
+                'persistence': row[4],
+                'qualified': row[5],
+                'owner': row[6],
+                'owner_ident': row[7],
+                'access_method': row[8],
+                'unsupported': row[9],
+                'comment': row[10],
+                'acl': row[11],
+                'acl_default': row[12],
+                'columns': [],
+                'constraints': [],
+                'indexes': [],
+                'triggers': [],
+                'sequences': [],
+                'grants': [],
+            }
+            self.relations[(relation['schema'], relation['name'])] = relation
+            self.relationOids[relation['oid']] = relation
+
+    def loadColumns(self, cursor):
+        compression = ''
+        if self.serverVersion >= 140000:
+            compression = "OR a.attcompression::pg_catalog.text <> ''"
+        cursor.execute(COLUMNS_QUERY % {'compression': compression})
+        for row in cursor.fetchall():
+            relation = self.relationOids.get(row[0])
+            if relation is None:
+                continue
+            relation['columns'].append({
+                'number': row[1],
+                'name': row[2],
+                'ident': row[3],
+                'type': row[4],
+                'not_null': row[5],
+                'identity': row[6],
+                'generated': row[7],
+                'collation': row[8],
+                'default': row[9],
+                'separate_default': row[10],
+                'unsupported': row[11],
+                'comment': row[12],
+            })
+
+    def loadConstraints(self, cursor):
+        cursor.execute(CONSTRAINTS_QUERY)
+        for row in cursor.fetchall():
+            relation = self.relationOids.get(row[0])
+            if relation is None:
+                continue
+            relation['constraints'].append({
+                'name': row[1],
+                'ident': row[2],
+                'type': row[3],
+                'definition': row[4],
+                'validated': row[5],
+                'local': row[6],
+                'unsupported': row[7],
+            })
+
+    def loadIndexes(self, cursor):
+        cursor.execute(INDEXES_QUERY)
+        for row in cursor.fetchall():
+            relation = self.relationOids.get(row[0])
+            if relation is None:
+                continue
+            relation['indexes'].append({
+                'name': row[1],
+                'definition': row[2],
+                'unsupported': row[3],
+            })
+
+    def loadTriggers(self, cursor):
+        triggerParent = ''
+        if self.serverVersion >= 130000:
+            triggerParent = 'OR t.tgparentid <> 0'
+        cursor.execute(TRIGGERS_QUERY % {'trigger_parent': triggerParent})
+        for row in cursor.fetchall():
+            relation = self.relationOids.get(row[0])
+            if relation is None:
+                continue
+            relation['triggers'].append({
+                'name': row[1],
+                'definition': row[2],
+                'unsupported': row[3],
+            })
+
+    def loadSequences(self, cursor):
+        cursor.execute(SEQUENCES_QUERY)
+        for row in cursor.fetchall():
+            relation = self.relationOids.get(row[0])
+            if relation is None:
+                continue
+            relation['sequences'].append({
+                'column': row[1],
+                'identity': row[2] == 'i',
+                'schema': row[3],
+                'name': row[4],
+                'qualified': row[5],
+                'owner': row[6],
+                'owner_ident': row[7],
+                'type': row[8],
+                'start': row[9],
+                'increment': row[10],
+                'min': row[11],
+                'max': row[12],
+                'cache': row[13],
+                'cycle': row[14],
+                'unsupported': row[15],
+                'acl': row[16],
+                'acl_default': row[17],
+                'grants': [],
+            })
+
+    def loadGrants(self, cursor):
+        # grants of sequences are attached to the sequence of the table owning them
+        sequences = {}
+        for relation in self.relations.values():
+            for sequence in relation['sequences']:
+                sequences[sequence['qualified']] = sequence
+        cursor.execute('''SELECT c.oid, pg_catalog.quote_ident(n.nspname) || '.'
+                || pg_catalog.quote_ident(c.relname)
+            FROM pg_catalog.pg_class c
+            JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind = 'S' AND c.relacl IS NOT NULL AND ''' + SCHEMA_FILTER)
+        sequenceOids = {}
+        for row in cursor.fetchall():
+            if row[1] in sequences:
+                sequenceOids[row[0]] = sequences[row[1]]
+
+        cursor.execute(GRANTS_QUERY)
+        for row in cursor.fetchall():
+            target = self.relationOids.get(row[0], sequenceOids.get(row[0]))
+            if target is None:
+                continue
+            target['grants'].append({
+                'position': row[1],
+                'item': row[2],
+                'grantee': row[3],
+                'by_owner': row[4],
+                'privilege': row[5],
+                'grantable': row[6],
+            })
+
+    def loadFingerprints(self):
+        # (schema, relation name) -> hash of the catalog rows describing it,
+        # empty when the server is too old to compute them
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT pg_catalog.current_setting('server_version_num')::int")
+        self.serverVersion = cursor.fetchone()[0]
+        if not self.isSupportedServer():
+            return {}
+        fingerprints = {}
+        with tracing.span('catalog loadFingerprints'):
+            cursor.execute(FINGERPRINTS_QUERY)
+            for row in cursor.fetchall():
+                fingerprints[(row[0], row[1])] = row[2]
+        if not self.connection.autocommit:
+            self.connection.commit()
+        return fingerprints
+
+    def getTables(self, schema):
+        return [r['name'] for r in self.relations.values()
+            if r['schema'] == schema and r['kind'] == 'r']
+
+    # --------------------------------------------------------------
+    # -------------------------- dump frame ------------------------
+    # --------------------------------------------------------------
+
+    def hasDumpFrame(self):
+        return self.header is not None
+
+    def setDumpFrame(self, dump):
+        # learn header (SET commands) and footer from a real pg_dump output,
+        # so the rendered files match it byte for byte
+        match = re.search(r'^(SET default_tablespace|SET default_table_access_method|--\n-- Name: )',
+            dump, re.MULTILINE)
+        footer = dump.find('--\n-- PostgreSQL database dump complete\n--\n')
+        if match is None or footer < 0:
+            return False
+        version = re.search(r'^-- Dumped by pg_dump version (\d+)', dump, re.MULTILINE)
+        if version is None:
+            return False
+        self.header = dump[:match.start()]
+        self.footer = dump[footer:]
+        self.dumpVersion = int(version.group(1))
+        return True
+
+    # --------------------------------------------------------------
+    # -------------------------- rendering -------------------------
+    # --------------------------------------------------------------
+
+    def isSupported(self, relation):
+        if relation['kind'] != 'r' or relation['unsupported']:
+            return False
+        for key in ['columns', 'constraints', 'indexes', 'triggers', 'sequences']:
+            if any(item['unsupported'] for item in relation[key]):
+                return False
+        for constraint in relation['constraints']:
+            # NOT VALID checks and inherited constraints are dumped separately
+            if constraint['type'] == 'c' and not (constraint['validated'] and constraint['local']):
+                return False
+        for column in relation['columns']:
+            if column['identity'] and not any(s['identity'] and s['column'] == column['number']
+                    for s in relation['sequences']):
+                return False
+        if self.renderGrants(relation, TABLE_PRIVILEGES, 'TABLE') is None:
+            return False
+        for sequence in relation['sequences']:
+            if self.renderGrants(sequence, SEQUENCE_PRIVILEGES, 'SEQUENCE') is None:
+                return False
+        return True
+
+    def renderTable(self, schema, name):
+        relation = self.relations.get((schema, name))
+        if relation is None or not self.hasDumpFrame() or not self.isSupported(relation):
+            return None
+
+        entries = [renderEntry(relation['name'], 'TABLE', relation['schema'], relation['owner'],
+            self.renderCreateTable(relation),
+            'ALTER TABLE %s OWNER TO %s;\n\n' % (relation['qualified'], relation['owner_ident']))]
+        tableIdent = self.getIdent(relation, relation['name'])
+        if relation['comment'] is not None:
+            entries.append(renderEntry('TABLE ' + tableIdent, 'COMMENT', relation['schema'],
+                relation['owner'], 'COMMENT ON TABLE %s IS %s;\n' % (relation['qualified'],
+                    quoteLiteral(relation['comment']))))
+        for column in relation['columns']:
+            if column['comment'] is not None:
+                entries.append(renderEntry('COLUMN %s.%s' % (tableIdent, column['ident']),
+                    'COMMENT', relation['schema'], relation['owner'],
+                    'COMMENT ON COLUMN %s.%s IS %s;\n' % (relation['qualified'], column['ident'],
+                        quoteLiteral(column['comment']))))
+
+        for sequence in relation['sequences']:
+            entries += self.renderSequence(relation, sequence)
+
+        for column in relation['columns']:
+            if column['default'] is not None and column['separate_default']:
+                entries.append(renderEntry(relation['name'] + ' ' + column['name'],
+                    'DEFAULT', relation['schema'], relation['owner'],
+                    'ALTER TABLE ONLY %s ALTER COLUMN %s SET DEFAULT %s;\n'
+                        % (relation['qualified'], column['ident'], column['default'])))
+
+        postData = []
+        for constraint in relation['constraints']:
+            if constraint['type'] == 'c':
+                continue
+            priority, entryType = PRIORITY_CONSTRAINT, 'CONSTRAINT'
+            if constraint['type'] == 'f':
+                priority, entryType = PRIORITY_FK_CONSTRAINT, 'FK CONSTRAINT'
+            postData.append((priority, constraint['name'], renderEntry(
+                relation['name'] + ' ' + constraint['name'], entryType,
+                relation['schema'], relation['owner'],
+                'ALTER TABLE ONLY %s\n    ADD CONSTRAINT %s %s;\n'
+                    % (relation['qualified'], constraint['ident'], constraint['definition']))))
+        for index in relation['indexes']:
+            postData.append((PRIORITY_INDEX, index['name'], renderEntry(
+                index['name'], 'INDEX', relation['schema'], relation['owner'],
+                index['definition'] + ';\n')))
+        for trigger in relation['triggers']:
+            postData.append((PRIORITY_TRIGGER, trigger['name'], renderEntry(
+                relation['name'] + ' ' + trigger['name'], 'TRIGGER',
+                relation['schema'], relation['owner'],
+                trigger['definition'] + ';\n')))
+        entries += [e[2] for e in sorted(postData, key=lambda e: (e[0], e[1]))]
+
+        # ACLs are printed in a separate pass at the very end of the dump
+        grants = self.renderGrants(relation, TABLE_PRIVILEGES, 'TABLE')
+        if grants:
+            entries.append(renderEntry('TABLE ' + tableIdent, 'ACL', relation['schema'],
+                relation['owner'], grants))
+        for sequence in relation['sequences']:
+            grants = self.renderGrants(sequence, SEQUENCE_PRIVILEGES, 'SEQUENCE')
+            if grants:
+                entries.append(renderEntry('SEQUENCE ' + self.getIdent(sequence, sequence['name']),
+                    'ACL', sequence['schema'], sequence['owner'], grants))
+
+        # pg_dump selects tablespace and access method right before the
+        # first object that has them, which is always the table itself
+        settings = "SET default_tablespace = '';\n\n"
+        if self.dumpVersion >= 12:
+            settings += 'SET default_table_access_method = %s;\n\n' \
+                % self.getAccessMethodIdent(relation)
+        return self.header + settings + ''.join(entries) + self.footer
+
+    def renderCreateTable(self, relation):
+        sql = 'CREATE %sTABLE %s' % (
+            'UNLOGGED ' if relation['persistence'] == 'u' else '', relation['qualified'])
+        parts = []
+        for column in relation['columns']:
+            part = column['ident'] + ' ' + column['type']
+            if column['collation'] is not None:
+                part += ' COLLATE ' + column['collation']
+            if column['default'] is not None and not column['separate_default']:
+                if column['generated'] == 's':
+                    part += ' GENERATED ALWAYS AS (%s) STORED' % column['default']
+                else:
+                    part += ' DEFAULT ' + column['default']
+            if column['not_null']:
+                part += ' NOT NULL'
+            parts.append(part)
+        for constraint in relation['constraints']:
+            if constraint['type'] == 'c':
+                parts.append('CONSTRAINT %s %s' % (constraint['ident'], constraint['definition']))
+        if len(parts) > 0:
+            sql += ' (\n    ' + ',\n    '.join(parts) + '\n)'
+        else:
+            sql += ' (\n)'
+        return sql + ';\n'
+
+    def renderSequence(self, relation, sequence):
+        column = None
+        for c in relation['columns']:
+            if c['number'] == sequence['column']:
+                column = c
+        if sequence['identity']:
+            sql = 'ALTER TABLE %s ALTER COLUMN %s ADD GENERATED %s AS IDENTITY (\n' % (
+                relation['qualified'], column['ident'],
+                'ALWAYS' if column['identity'] == 'a' else 'BY DEFAULT')
+            sql += '    SEQUENCE NAME %s\n' % sequence['qualified']
+        else:
+            sql = 'CREATE SEQUENCE %s\n' % sequence['qualified']
+            if sequence['type'] != 'bigint':
+                sql += '    AS %s\n' % sequence['type']
+        minDefault, maxDefault = SEQUENCE_LIMITS.get(sequence['type'], (None, None))
+        if sequence['increment'] > 0:
+            minDefault = 1
+        else:
+            maxDefault = -1
+        sql += '    START WITH %s\n' % sequence['start']
+        sql += '    INCREMENT BY %s\n' % sequence['increment']
+        if sequence['min'] == minDefault:
+            sql += '    NO MINVALUE\n'
+        else:
+            sql += '    MINVALUE %s\n' % sequence['min']
+        if sequence['max'] == maxDefault:
+            sql += '    NO MAXVALUE\n'
+        else:
+            sql += '    MAXVALUE %s\n' % sequence['max']
+        sql += '    CACHE %s' % sequence['cache']
+        if sequence['cycle']:
+            sql += '\n    CYCLE'
+
+        if sequence['identity']:
+            return [renderEntry(sequence['name'], 'SEQUENCE', sequence['schema'], sequence['owner'],
+                sql + '\n);\n')]
+
+        ownerStatement = 'ALTER %s %s OWNER TO %s;\n\n' % (
+            'SEQUENCE' if self.dumpVersion >= 15 else 'TABLE',
+            sequence['qualified'], sequence['owner_ident'])
+        return [
+            renderEntry(sequence['name'], 'SEQUENCE', sequence['schema'], sequence['owner'],
+                sql + ';\n', ownerStatement),
+            renderEntry(sequence['name'], 'SEQUENCE OWNED BY', sequence['schema'], sequence['owner'],
+                'ALTER SEQUENCE %s OWNED BY %s.%s;\n' % (
+                    sequence['qualified'], relation['qualified'], column['ident']))
+        ]
+
+    def renderGrants(self, target, privilegeOrder, objectType):
+        # returns the GRANT statements pg_dump prints for an object, '' when
+        # there is nothing to grant and None when the ACL can't be reproduced
+        if target['acl'] is None:
+            return ''
+        acl = target['acl']
+        if any(item not in acl for item in target['acl_default']):
+            # privileges revoked from the owner or PUBLIC
+            return None
+        allPrivileges = [p for p in privilegeOrder
+            if p != 'MAINTAIN' or self.serverVersion >= 170000]
+        items = {}
+        for grant in target['grants']:
+            if grant['item'] in target['acl_default']:
+                continue
+            if not grant['by_owner'] or grant['grantable']:
+                return None
+            item = items.setdefault(grant['position'], (grant['grantee'], set()))
+            item[1].add(grant['privilege'])
+
+        sql = ''
+        for position in sorted(items.keys()):
+            grantee, privileges = items[position]
+            if all(p in privileges for p in allPrivileges):
+                privilegeList = 'ALL'
+            else:
+                privilegeList = ','.join([p for p in allPrivileges if p in privileges])
+            sql += 'GRANT %s ON %s %s TO %s;\n' % (privilegeList, objectType,
+                target['qualified'], grantee)
+        return sql
+
+    def getIdent(self, target, name):
+        # qualified names are built from quote_ident() output, so the quoted
+        # form of the object name is whatever follows the quoted schema
+        return target['qualified'][len(target['qualified']) - self.getIdentLength(target, name):]
+
+    def getIdentLength(self, target, name):
+        quoted = '"' + name.replace('"', '""') + '"'
+        if target['qualified'].endswith('.' + quoted):
+            return len(quoted)
+        return len(name)
+
+    def getAccessMethodIdent(self, relation):
+        accessMethod = relation['access_method'] or 'heap'
+        if re.match('^[a-z_][a-z0-9_]*$', accessMethod):
+            return accessMethod
+        return '"' + accessMethod.replace('"', '""') + '"'
+
+
+def renderEntry(tag, entryType, schema, owner, definition, ownerStatement=''):
+    # an object the way pg_dump writes it, after its TOC comment
+    return '--\n-- Name: %s; Type: %s; Schema: %s; Owner: %s\n--\n\n%s\n\n%s' % (
+        tag, entryType, schema, owner, definition, ownerStatement)
+
+
+def quoteLiteral(value):
+    return "'" + value.replace("'", "''") + "'"
@@ -0,0 +1,162 @@
+import getpass
+import os
+import threading
+from collections.abc import Mapping
+
+import lazy
+import tracing
+
+psycopg2 = lazy.load('psycopg2')
+
+# Opens connections to the databases of the remotes defined in the git config.
+# Credentials of a remote are resolved once per run, every connection is opened
+# on first use only and then reused until closeAll() is called. A daemon keeps
+# them across commands, calling resetAll() after each one.
+
+
+class ConnectionManager:
+    def __init__(self, configSectionPrefix, gitConfig):
+        self.configSectionPrefix = configSectionPrefix
+        # gitconfig.ConfigSnapshot of the repository
+        self.gitConfig = gitConfig
+        self.credentials = {}
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.connectionLocks = {}
+
+    def getCredentials(self, name):
+        with self.lock:
+            if name not in self.credentials:
+                self.credentials[name] = self.readCredentials(name)
+            return self.credentials[name]
+
+    def readCredentials(self, name):
+        # based on how remotes are stored
+        sectionName = self.configSectionPrefix + ' "' + name + '"'
+        rw = self.gitConfig
+        url = rw.getValue(sectionName, 'url', '')
+        service = rw.getValue(sectionName, 'service', '')
+        # url is mandatory, unless the connection is described by a pg_service.conf entry
+        if len(url) == 0 and len(service) == 0:
+            print('[ERROR] Database "' + name + '" does not exists')
+            exit(1)
+
+        port = rw.getValue(sectionName, 'port', '')
+        # default PgSQL port, if not specified directly
+        if not port and not service:
+            port = '5432'
+
+        username = rw.getValue(sectionName, 'user', '')
+        if len(username) == 0 and not service:
+            username = os.environ.get('PGUSER', '')
+            if len(username) == 0:
+                username = input('username:')
+
+        # without a password in the config libpq looks it up in PGPASSWORD or
+        # the .pgpass file, the user is only asked when that doesn't work
+        password = rw.getValue(sectionName, 'password', '')
+        return {
+            'host': url or None,
+            'port': port or None,
+            'username': username or None,
+            'password': password or None,
+            'service': service or None,
+        }
+
+    def getConnectionLock(self, key):
+        with self.lock:
+            return self.connectionLocks.setdefault(key, threading.Lock())
+
+    def connect(self, name, database=None):
+        if database is None:
+            database = 'postgres'
+        key = (name, database)
+        with self.getConnectionLock(key):
+            connection = self.connections.get(key)
+            if connection is None or connection.closed:
+                connection = self.open(name, database)
+                self.connections[key] = connection
+            else:
+                # tracing may be on for this command only
+                connection.cursor_factory = tracing.getCursorFactory()
+            return connection
+
+    def open(self, name, database):
+        credentials = self.getCredentials(name)
+        try:
+            with tracing.span('connect', remote=name, database=database):
+                return psycopg2.connect(host=credentials['host'],
+                    port=credentials['port'],
+                    user=credentials['username'],
+                    password=credentials['password'],
+                    service=credentials['service'],
+                    database=database,
+                    cursor_factory=tracing.getCursorFactory())
+        except psycopg2.OperationalError as e:
+            if credentials['password'] is None and self.isPasswordError(e):
+                with self.lock:
+                    if credentials['password'] is None:
+                        credentials['password'] = getpass.getpass()
+                return self.open(name, database)
+            print("[ERROR] I am unable to connect to the database '" + database + "'")
+            exit(1)
+
+    def isPasswordError(self, error):
+        message = str(error)
+        return 'no password supplied' in message or 'password authentication failed' in message
+
+    def getDatabaseConnections(self, name, databases):
+        return DatabaseConnections(self, name, databases)
+
+    def getEnvironment(self, name):
+        # environment for client programs (pg_dump) using the same credentials
+        credentials = self.getCredentials(name)
+        env = dict(os.environ)
+        if credentials['password'] is not None:
+            env['PGPASSWORD'] = credentials['password']
+        if credentials['service'] is not None:
+            env['PGSERVICE'] = credentials['service']
+        return env
+
+    def closeAll(self):
+        with self.lock:
+            for connection in self.connections.values():
+                if not connection.closed:
+                    connection.close()
+            self.connections = {}
+
+    def resetAll(self):
+        # ends what a command left open and sets the session back to its
+        # defaults, dropping connections that don't work anymore
+        with self.lock:
+            for key, connection in list(self.connections.items()):
+                if not connection.closed:
+                    try:
+                        connection.reset()
+                        continue
+                    except psycopg2.Error:
+                        connection.close()
+                del self.connections[key]
+
+
+class DatabaseConnections(Mapping):
+    # database name -> connection of one remote; a database is connected to
+    # only when its connection is actually used
+    def __init__(self, manager, name, databases):
+        self.manager = manager
+        self.name = name
+        self.databases = list(databases)
+
+    def __getitem__(self, database):
+        if database not in self.databases:
+            raise KeyError(database)
+        return self.manager.connect(self.name, database)
+
+    def __iter__(self):
+        return iter(self.databases)
+
+    def __len__(self):
+        return len(self.databases)
+
+    def __contains__(self, database):
+        return database in self.databases
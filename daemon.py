@@ -0,0 +1,281 @@
+import io
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+
+import lazy
+
+# 'git db daemon' keeps a process running per repository that serves git-db
+# commands on a Unix socket in .git/, with the connections to the databases,
+# the loaded catalogs and the diffs of patch create kept between commands. The
+# git-db script forwards a command to it when it's running, passing its
+# standard streams along, so prompts and subprocess output work as usual;
+# without a daemon the command runs in-process. Catalogs of a database are
+# loaded again once its catalog changed, connections and everything else once
+# the git config changed.
+
+SOCKET_PATH = '.git/git-db.sock'
+# set to run a command in-process even though a daemon is running
+DISABLE_VARIABLE = 'GIT_DB_NO_DAEMON'
+MESSAGE_SIZE = 64 * 1024
+
+# system catalogs holding the objects git-db pulls; a new row version gets a
+# new xmin and a dropped row lowers the count, so any DDL changes the result
+VERSION_CATALOGS = ['pg_namespace', 'pg_class', 'pg_attribute', 'pg_attrdef', 'pg_constraint',
+    'pg_index', 'pg_inherits', 'pg_trigger', 'pg_rewrite', 'pg_proc', 'pg_type', 'pg_enum',
+    'pg_sequence', 'pg_depend', 'pg_description']
+CATALOG_VERSION_QUERY = ' UNION ALL '.join(
+    "SELECT '%s', pg_catalog.count(*), pg_catalog.max(xmin::text::bigint) FROM pg_catalog.%s"
+    % (name, name) for name in VERSION_CATALOGS)
+
+
+class SharedState:
+    # what the commands run by a daemon share
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gitConfig = None
+        self.configStamp = None
+        self.connectionManager = None
+        # remote -> {cache name: {database: value}}, cache names are the
+        # attributes of Database holding them
+        self.caches = {}
+        # remote -> {database: catalog version the caches were loaded at}
+        self.versions = {}
+        # (patch target commit, current commit) -> Database.diffIndex
+        self.diffs = {}
+        self.commands = 0
+
+    def getConfig(self):
+        import gitconfig
+        stamp = getStamp('.git/config')
+        if self.gitConfig is None or stamp != self.configStamp:
+            if self.connectionManager is not None:
+                self.connectionManager.closeAll()
+            self.gitConfig = gitconfig.ConfigSnapshot()
+            self.configStamp = stamp
+            self.connectionManager = None
+            self.caches = {}
+            self.versions = {}
+        return self.gitConfig
+
+    def getConnectionManager(self, configSectionPrefix, gitConfig):
+        from connection import ConnectionManager
+        if self.connectionManager is None:
+            self.connectionManager = ConnectionManager(configSectionPrefix, gitConfig)
+        return self.connectionManager
+
+    def useCaches(self, database, remote):
+        # gives the Database the caches of the remote, without the ones of
+        # databases whose catalog changed since they were loaded
+        with self.lock:
+            caches = self.caches.setdefault(remote, {})
+            versions = self.versions.setdefault(remote, {})
+        for name, version in list(versions.items()):
+            if name in database.connections \
+                    and getCatalogVersion(database.connections[name]) == version:
+                continue
+            with self.lock:
+                del versions[name]
+                for cache in caches.values():
+                    cache.pop(name, None)
+        for attribute in ['catalogs', 'objectCatalogs', 'catalogFingerprints', 'dependencies']:
+            setattr(database, attribute, caches.setdefault(attribute, {}))
+
+    def noteLoad(self, remote, name, connection):
+        # the version is read before the catalog, a change made while it
+        # loads makes the next command load it again
+        with self.lock:
+            versions = self.versions.setdefault(remote, {})
+            if name in versions:
+                return
+        version = getCatalogVersion(connection)
+        with self.lock:
+            versions.setdefault(name, version)
+
+
+def getCatalogVersion(connection):
+    cursor = connection.cursor()
+    cursor.execute(CATALOG_VERSION_QUERY)
+    version = tuple(cursor.fetchall())
+    if not connection.autocommit:
+        connection.commit()
+    return version
+
+
+def getStamp(path):
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None
+    return (status.st_mtime_ns, status.st_size)
+
+
+def connect():
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SOCKET_PATH)
+    except OSError:
+        client.close()
+        return None
+    return client
+
+
+def receive(connection):
+    # one JSON message per line, file descriptors come with the first part
+    data, fds, flags, address = socket.recv_fds(connection, MESSAGE_SIZE, 3)
+    while not data.endswith(b'\n'):
+        more = connection.recv(MESSAGE_SIZE)
+        if len(more) == 0:
+            break
+        data += more
+    if len(data) == 0:
+        return None, fds
+    return json.loads(data.decode('utf-8')), fds
+
+
+def send(connection, message, fds=None):
+    data = json.dumps(message).encode('utf-8') + b'\n'
+    if fds is not None:
+        sent = socket.send_fds(connection, [data], fds)
+        data = data[sent:]
+    connection.sendall(data)
+
+
+def forward(argv):
+    # runs the command in the daemon, None when there is none to run it
+    if argv[:1] == ['daemon'] or os.environ.get(DISABLE_VARIABLE) \
+            or not os.path.exists(SOCKET_PATH):
+        return None
+    client = connect()
+    if client is None:
+        return None
+    with client:
+        send(client, {'argv': argv, 'cwd': os.getcwd(), 'environment': dict(os.environ)},
+            [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()])
+        reply, fds = receive(client)
+    if reply is None:
+        print('[ERROR] the git-db daemon stopped while running the command')
+        return 1
+    return reply.get('status')
+
+
+def stop():
+    client = connect()
+    if client is None:
+        print('[INFO] no git-db daemon is running')
+        return
+    with client:
+        send(client, {'stop': True})
+        receive(client)
+    print('[INFO] git-db daemon stopped')
+
+
+def status():
+    client = connect()
+    if client is None:
+        print('[INFO] no git-db daemon is running')
+        return
+    with client:
+        send(client, {'status': True})
+        reply, fds = receive(client)
+    print('[INFO] git-db daemon running, pid %d, %d commands served, %d databases cached'
+        % (reply['pid'], reply['commands'], reply['databases']))
+
+
+def serve(log=print):
+    client = connect()
+    if client is not None:
+        client.close()
+        print('[ERROR] a git-db daemon is already running for this repository')
+        exit(1)
+    if os.path.exists(SOCKET_PATH):
+        # left behind by a daemon that didn't stop cleanly
+        os.remove(SOCKET_PATH)
+    state = SharedState()
+    root = os.path.realpath(os.getcwd())
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        server.bind(SOCKET_PATH)
+    finally:
+        os.umask(umask)
+    server.listen()
+    log('[INFO] git-db daemon listening on %s (pid %d)' % (SOCKET_PATH, os.getpid()))
+    try:
+        while True:
+            connection, address = server.accept()
+            with connection:
+                message, fds = receive(connection)
+                try:
+                    if message is None:
+                        continue
+                    if message.get('stop'):
+                        send(connection, {})
+                        break
+                    if message.get('status'):
+                        send(connection, {'pid': os.getpid(), 'commands': state.commands,
+                            'databases': sum(len(v) for v in state.versions.values())})
+                        continue
+                    if os.path.realpath(message['cwd']) != root or len(fds) != 3:
+                        # another checkout, run it in-process
+                        send(connection, {'status': None})
+                        continue
+                    send(connection, {'status': runCommand(state, message, fds)})
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+        if state.connectionManager is not None:
+            state.connectionManager.closeAll()
+        log('[INFO] git-db daemon stopped')
+
+
+def runCommand(state, message, fds):
+    # one command at a time: the standard streams of the process are the ones
+    # of the client while it runs
+    database = lazy.load('database')
+    argv = message['argv']
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(fd) for fd in [0, 1, 2]]
+    stdin = sys.stdin
+    environment = dict(os.environ)
+    status = 0
+    try:
+        for fd, target in zip(fds, [0, 1, 2]):
+            os.dup2(fd, target)
+        sys.stdin = io.TextIOWrapper(io.FileIO(0, closefd=False))
+        os.environ.clear()
+        os.environ.update(message['environment'])
+        state.commands += 1
+        database.Database(state).run(argv[0], argv[1:])
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            status = e.code
+        elif e.code is not None:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except OSError:
+            pass
+        sys.stdin = stdin
+        os.environ.clear()
+        os.environ.update(environment)
+        for fd, target in zip(saved, [0, 1, 2]):
+            os.dup2(fd, target)
+            os.close(fd)
+    return status
@@ -1,46 +1,123 @@
-import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from time import time
 import subprocess
 import os
-import git
 import re
-import getpass
 import shutil
+import tempfile
+import threading
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from catalog import Catalog
+import daemon
+import diffcache
+import fleet
+import gitconfig
+import gittree
+import lazy
+import patchfile
+import locking
+import metadata
+import objects
+import planner
+import querymanifest
+import tracing
+from connection import ConnectionManager
+
+# imported when a command uses them, see lazy.py
+git = lazy.load('git')
+psycopg2 = lazy.load('psycopg2')
+ddl = lazy.load('ddl')
+
+# per-relation catalog fingerprints of the last pull, kept on the database branch
+MANIFEST_PATH = '.git-db/fingerprints.json'
+MANIFEST_VERSION = 1
+# databases and object dependencies of a pulled server, for 'patch create --offline'
+CATALOG_SNAPSHOT_PATH = '.git-db/catalog.json'
+CATALOG_SNAPSHOT_VERSION = 1
 
 class Database:
-    def __init__(self):
+    def __init__(self, shared=None):
+        # daemon.SharedState when run by 'git db daemon'
+        self.shared = shared
         self.schemas = []
         self.connections = {}
-        self.connection_info = {}
-        
-        if os.path.exists('.git'):
-            r = git.Repo()
-            rw = r.config_reader()
-            sectionName = 'git-db'
-            self.config = {}
-            self.config['config_section_prefix'] = rw.get_value(sectionName, 'configsectionprefix', '')
-            self.config['database_branch_prefix'] = rw.get_value(sectionName, 'databasebranchprefix', '')
-            self.config['database'] = rw.get_value(sectionName, 'database', '')
-            self.config['default_database'] = rw.get_value(sectionName, 'defaultdatabase', '')
-            self.config['store_migrations'] = rw.get_value(sectionName, 'storemigrations', '')
-            # TODO: implement ignore options
-            self.config['ignore_db'] = rw.get_value(sectionName, 'ignoredb', '')
-            self.config['ignore_schema'] = rw.get_value(sectionName, 'ignoreschema', 'git_db')
-            rw.release()
+        self.catalogs = {}
+        self.objectCatalogs = {}
+        self.dependencies = {}
+        self.catalogLock = threading.Lock()
+        self.catalogLocks = {}
+        self.manifest = {}
+        self.fingerprints = {}
+        self.catalogFingerprints = {}
+        self.pulledFiles = set()
+        self.diffIndex = None
+        self.diffCache = None
+        self.offline = False
+        # the tree a 'pull --no-checkout' builds, None while pulling into the
+        # working tree
+        self.tree = None
+        self.gitDbInitialized = set()
+        self.queryManifest = querymanifest.QueryManifest()
+        # read once, the first time a command needs the config
+        self.gitConfig = gitconfig.ConfigSnapshot()
+        self.config = {}
+        self.connectionManager = None
         self.connection = None
 
+    def loadConfig(self):
+        if self.shared is not None:
+            self.gitConfig = self.shared.getConfig()
+        rw = self.gitConfig
+        sectionName = 'git-db'
+        self.config['config_section_prefix'] = rw.getValue(sectionName, 'configsectionprefix', '')
+        self.config['database_branch_prefix'] = rw.getValue(sectionName, 'databasebranchprefix', '')
+        self.config['database'] = rw.getValue(sectionName, 'database', '')
+        self.config['default_database'] = rw.getValue(sectionName, 'defaultdatabase', '')
+        self.config['store_migrations'] = rw.getValue(sectionName, 'storemigrations', '')
+        # TODO: implement ignore options
+        self.config['ignore_db'] = rw.getValue(sectionName, 'ignoredb', '')
+        self.config['ignore_schema'] = rw.getValue(sectionName, 'ignoreschema', 'git_db')
+        # 'catalog' renders table files from the system catalogs, 'pg_dump'
+        # runs a pg_dump process per table
+        self.config['extractor'] = rw.getValue(sectionName, 'extractor', 'catalog')
+        # lock_timeout/statement_timeout of patch statements, optionally per
+        # object type in [git-db "<type>"] sections, and how long to retry
+        # statements that could not get their locks
+        self.config['lock_timeout'] = rw.getValue(sectionName, 'locktimeout', '')
+        self.config['statement_timeout'] = rw.getValue(sectionName, 'statementtimeout', '')
+        self.config['lock_retry_deadline'] = rw.getValue(sectionName, 'lockretrydeadline', '5min')
+        # throughput in MB/s the cost estimates of 'patch apply --plan' assume
+        self.config['plan_scan_rate'] = str(rw.getValue(sectionName, 'planscanrate', planner.SCAN_RATE))
+        self.config['plan_rewrite_rate'] = str(rw.getValue(sectionName, 'planrewriterate', planner.REWRITE_RATE))
+        # size limit of the table diffs 'patch create' keeps in .git/, 0 turns it off
+        self.config['diff_cache_size'] = rw.getValue(sectionName, 'diffcachesize', diffcache.MAX_SIZE)
+        self.config['object_timeouts'] = {}
+        for objectType in locking.OBJECT_TYPES:
+            objectSection = '%s "%s"' % (sectionName, objectType)
+            if rw.hasSection(objectSection):
+                self.config['object_timeouts'][objectType] = {
+                    'lock_timeout': rw.getValue(objectSection, 'locktimeout', ''),
+                    'statement_timeout': rw.getValue(objectSection, 'statementtimeout', ''),
+                }
+        if self.shared is not None:
+            self.connectionManager = self.shared.getConnectionManager(
+                self.config['config_section_prefix'], rw)
+        else:
+            self.connectionManager = ConnectionManager(self.config['config_section_prefix'], rw)
+
     def init(self, argv):
         if not os.path.exists('.git'):
+            tracing.count('subprocesses')
             os.system('git init')
-        r = git.Repo()
-        rw = r.config_writer()
+        rw = self.gitConfig
         sectionName = 'git-db'
-        rw.set_value(sectionName, 'configsectionprefix', 'database')
-        rw.set_value(sectionName, 'databasebranchprefix', 'database')
-        rw.set_value(sectionName, 'database', 'pgsql')
-        rw.set_value(sectionName, 'storemigrations', 'database')
-        rw.release()
+        rw.setValue(sectionName, 'configsectionprefix', 'database')
+        rw.setValue(sectionName, 'databasebranchprefix', 'database')
+        rw.setValue(sectionName, 'database', 'pgsql')
+        rw.setValue(sectionName, 'storemigrations', 'database')
+        rw.setValue(sectionName, 'extractor', 'catalog')
+        rw.write()
     
     def run(self, key, argv):
         switch = {
@@ -48,13 +125,42 @@ class Database:
             'database': self.database,
             'remote': self.remote,
             'patch': self.patch,
-            'query': self.query
+            'query': self.query,
+            'daemon': self.daemon
         }
         functionCall = switch.get(key)
         if functionCall is None:
             print("'" + key + "' is not a git-db function. See 'git-db --help'")
             return
-        return functionCall(argv)
+        tracePath = self.getTraceOption(argv)
+        if tracePath is not None:
+            tracing.start(tracePath)
+        try:
+            with tracing.span('git db ' + ' '.join([key] + argv[:1])):
+                # usage messages don't need the config
+                if os.path.exists('.git') and '--help' not in argv:
+                    self.loadConfig()
+                return functionCall(argv)
+        finally:
+            if self.connectionManager is not None:
+                # a daemon keeps the connections for the next command
+                if self.shared is not None:
+                    self.connectionManager.resetAll()
+                else:
+                    self.connectionManager.closeAll()
+            tracing.finish()
+
+    def getTraceOption(self, argv):
+        # reads and removes '--trace' or '--trace=<file>' from argv, falling
+        # back to the GIT_DB_TRACE environment variable
+        for i, arg in enumerate(argv):
+            if arg == '--trace':
+                del argv[i]
+                return tracing.DEFAULT_PATH
+            if arg.startswith('--trace='):
+                del argv[i]
+                return arg.split('=', 1)[1] or tracing.DEFAULT_PATH
+        return tracing.getEnvironmentPath()
 
     # --------------------------------------------------------------
     # -------------------------- git db remote ---------------------
@@ -81,15 +187,15 @@ class Database:
         r = git.Repo()
         branch = r.active_branch.name
         sectionName = "branch \"%s\"" % branch
-        rw = r.config_writer()
-        if not rw.has_section('%s "%s"' % (self.config['config_section_prefix'], name)):
+        rw = self.gitConfig
+        if not rw.hasSection('%s "%s"' % (self.config['config_section_prefix'], name)):
             print("Database '" + name + "' does not exist")
             exit(1)
-        rw.set_value(sectionName, 'database', self.config['config_section_prefix'] + '/' + name)
+        rw.setValue(sectionName, 'database', self.config['config_section_prefix'] + '/' + name)
         # TODO: add more patch numbering options
-        rw.set_value(sectionName, 'numbering', 'simple')
-        rw.set_value(sectionName, 'current', 0)
-        rw.release()
+        rw.setValue(sectionName, 'numbering', 'simple')
+        rw.setValue(sectionName, 'current', 0)
+        rw.write()
         print("Branch '" + branch + "' set to track database '" + name + "'")
     
     def patch(self, argv):
@@ -106,19 +212,35 @@ class Database:
             return
         return functionCall(argv[1:])
 
+    # --------------------------------------------------------------
+    # -------------------------- git db daemon ---------------------
+    # --------------------------------------------------------------
+
+    def daemon(self, argv):
+        if len(argv) > 0 and argv[0] == '--help':
+            print('usage: git db daemon [--stop | --status]')
+            exit(0)
+        if not os.path.exists('.git'):
+            print('[ERROR] git db daemon runs in the top directory of a repository')
+            exit(1)
+        if '--stop' in argv:
+            daemon.stop()
+        elif '--status' in argv:
+            daemon.status()
+        else:
+            daemon.serve()
+
     # --------------------------------------------------------------
     # -------------------------- git db query ----------------------
     # --------------------------------------------------------------
 
     def query(self, argv):
-        r = git.Repo()
-        rw = r.config_reader()
         if len(argv) < 1 or argv[0] == '--help':
             print('usage: git db query <database name>')
             exit(0)
         database = argv[0]
 
-        name = rw.get_value('git_db', 'query_name', '{branch}/{timestamp}.sql')
+        name = self.gitConfig.getValue('git_db', 'query_name', '{branch}/{timestamp}.sql')
         name, timestamp = self.replaceWildcards(name)
         nameArray = str.split(name, '/')
         subdir = None
@@ -133,15 +255,16 @@ class Database:
             os.makedirs(queryPath)
             
         filePath = queryPath + '/' + name
+        tracing.count('subprocesses')
         os.system('touch ' + filePath)
         
         context = {
             'database': database,
             'record': {
-                'name': '\'' + name + '\'',
-                'path': '\'' + queryPath + '/' + name + '\'',
-                'timestamp': 'to_timestamp(' + timestamp + ')',
-                'namespace': '\'' + subdir + '\''
+                'name': name,
+                'path': queryPath + '/' + name,
+                'timestamp': int(timestamp),
+                'namespace': subdir or ''
             }
         }
         self.setPatchTarget()
@@ -159,6 +282,8 @@ class Database:
             'add': self.database_add,
             'check': self.database_check,
             'pull': self.database_pull,
+            'status': self.database_status,
+            'verify': self.database_verify,
         }
         functionCall = switch.get(argv[0])
         if functionCall is None:
@@ -167,47 +292,63 @@ class Database:
         return functionCall(argv[1:])
     
     def database_pull(self, argv):
+        if '--pg-dump' in argv:
+            self.config['extractor'] = 'pg_dump'
+            argv.remove('--pg-dump')
+        full = False
+        if '--full' in argv:
+            full = True
+            argv.remove('--full')
+        # --no-checkout commits the structure to the database branch through
+        # the object database, see pullWithoutCheckout
+        noCheckout = False
+        if '--no-checkout' in argv:
+            noCheckout = True
+            argv.remove('--no-checkout')
+        jobs = self.getJobsOption(argv)
         if len(argv) < 1 or argv[0] == '--help':
-            print('usage: git db database pull <name>')
+            print('usage: git db database pull <name> [--pg-dump] [--jobs <n>] [--full] [--no-checkout]')
             exit(0)
+        if noCheckout:
+            return self.pullWithoutCheckout(argv[0], full, jobs)
         r = git.Repo()
         if len(r.index.diff(None)) != 0 or len(r.untracked_files) != 0:
             print('Your working tree has uncomitted changes.')
             print('Please, commit your changes or stash them before you can switch branches')
             exit(0)
         name = argv[0]
-        url, port, username, password = self.getDatabaseConnectionInfo(name)
-        connection = self.connect(url, port, username, password)
+        connection = self.connect(name)
         cursor = connection.cursor()
         message = '[GIT DB] pulled from remote'
+        isIncremental = False
         # check does the target database branch exists
         # if anything in the block returns an exception it means the branch does not exists
         try:
             branchName = self.config['database_branch_prefix'] + '/' + name
+            tracing.count('subprocesses')
             branchHash = subprocess.check_output('git rev-parse --verify --quiet ' \
                  + branchName, shell=True)
             if len(branchHash) > 0:
                 print('Pulling to existing branch for database: "' + name + '"')
+                tracing.count('subprocesses')
                 os.system('git checkout ' + branchName)
-                os.system('git ls-tree --name-only HEAD | xargs rm -r')
+                isIncremental = True
         except:
             print('Creating database branch for database: "' + name + '"')
             message = '[GIT DB] initial commit'
             self.createDbBranch(name)
 
-        self.setDatabases(cursor)
-        self.createDbDirectories(cursor)
-        self.setDatabaseConnections(name)
-        for conn in self.connections:
-            schemas =  self.getSchemas(conn)
-            self.createSchemaDirectories(conn, schemas)
-        
-        for conn in self.connections:
-            schemas =  self.getSchemas(conn)
-            print("\r\n======== Connected to: '" + conn + '" ========')
-            for schema in schemas:
-                print("Fetching table structure for: '" + schema + "'")
-                self.createTableStructure(conn, schema)
+        # only objects with a changed fingerprint are extracted again, unless
+        # the manifest is missing or was written by a different setup
+        environment = self.getDumpEnvironment(cursor)
+        if isIncremental:
+            self.manifest = self.readManifest(environment)
+            if full or self.manifest is None:
+                self.manifest = {}
+                tracing.count('subprocesses')
+                os.system('git ls-tree --name-only HEAD | xargs rm -r')
+
+        self.pullStructure(cursor, name, jobs, environment, isIncremental)
         r = git.Repo()
         
         isFirstCommit = False
@@ -229,6 +370,65 @@ class Database:
             r.git.commit('-m', message)
             print('[Info] database branch updated')
     
+    def pullStructure(self, cursor, name, jobs, environment, isIncremental):
+        self.setDatabases(cursor)
+        self.createDbDirectories(cursor)
+        self.setDatabaseConnections(name)
+        schemas = {}
+        for conn in self.connections:
+            schemas[conn] = self.getSchemas(conn)
+            self.createSchemaDirectories(conn, schemas[conn])
+
+        if jobs > 1:
+            self.createStructureParallel(schemas, jobs)
+        else:
+            for conn in self.connections:
+                print("\r\n======== Connected to: '" + conn + '" ========')
+                for schema in schemas[conn]:
+                    print("Fetching table structure for: '" + schema + "'")
+                    self.createTableStructure(conn, schema)
+
+        if isIncremental:
+            self.removeDroppedFiles(schemas)
+        self.writeManifest(environment)
+        self.writeCatalogSnapshot()
+
+    def pullWithoutCheckout(self, name, full, jobs):
+        # files are hashed and stored as blobs, directories without a changed
+        # file keep their tree and the commit is put on the database branch
+        # with update-ref; the working tree, the index and HEAD stay as they are
+        r = git.Repo()
+        branchName = self.config['database_branch_prefix'] + '/' + name
+        if not r.head.is_detached and r.active_branch.name == branchName:
+            print("[ERROR] '%s' is checked out, '--no-checkout' only updates branches that aren't"
+                % branchName)
+            exit(1)
+        connection = self.connect(name)
+        cursor = connection.cursor()
+        message = '[GIT DB] pulled from remote'
+        try:
+            commit = r.commit(branchName)
+            print('Pulling to existing branch for database: "' + name + '"')
+        except (git.BadName, ValueError):
+            commit = None
+            print('Creating database branch for database: "' + name + '"')
+            message = '[GIT DB] initial commit'
+        self.tree = gittree.TreeBuilder(r, commit)
+        environment = self.getDumpEnvironment(cursor)
+        if commit is not None:
+            self.manifest = self.readManifest(environment)
+            if full or self.manifest is None:
+                # every object is extracted again, files that didn't change
+                # keep their blob
+                self.manifest = {}
+        self.pullStructure(cursor, name, jobs, environment, commit is not None)
+        with tracing.span('commit tree', branch=branchName):
+            commit = self.tree.commitTo(branchName, message)
+        if commit is None:
+            print('\n\n[Info] Nothing to commit')
+        else:
+            print('[Info] database branch updated')
+    
     def database_add(self, argv):
         setAsDefault = False
         if '--default' in argv:
@@ -243,35 +443,198 @@ class Database:
         # based on how remotes are stored
         sectionName = self.config['config_section_prefix'] + ' "' + name + '"'
         # save to git config file
-        r = git.Repo()
-        rw = r.config_writer()
-        if len(rw.get_value(sectionName, 'url', '')) > 0:
+        rw = self.gitConfig
+        if len(rw.getValue(sectionName, 'url', '')) > 0:
             print('database "' + argv[0] + '" already exists')
             return 0
         urlArray = str.split(argv[1], ':')
         url = urlArray[0]
-        rw.set_value(sectionName, 'url', url)
+        rw.setValue(sectionName, 'url', url)
         if len(urlArray) > 1:
-            rw.set_value(sectionName, 'port', urlArray[1])
+            rw.setValue(sectionName, 'port', urlArray[1])
         if len(argv) > 2:
-            rw.set_value(sectionName, 'user', argv[2])
+            rw.setValue(sectionName, 'user', argv[2])
         if len(argv) > 3:
-            rw.set_value(sectionName, 'password', argv[3])
+            rw.setValue(sectionName, 'password', argv[3])
         if setAsDefault:
-            rw.set_value('git-db', 'defaultdatabase', name)
+            rw.setValue('git-db', 'defaultdatabase', name)
         
-         # save buffer and release file handle
-        rw.release()
+        # save to the config file
+        rw.write()
         return 0
 
+    def database_verify(self, argv):
+        if len(argv) < 1 or argv[0] == '--help':
+            print('usage: git db database verify <database name>')
+            exit(0)
+        name = argv[0]
+        connection = self.connect(name)
+        cursor = connection.cursor()
+        self.setDatabases(cursor)
+        self.setDatabaseConnections(name)
+
+        # render every table from the catalog and compare it with the output
+        # of pg_dump, so switching extractors never changes the database branch
+        checked = 0
+        fallback = 0
+        mismatched = []
+        tmpDir = tempfile.mkdtemp()
+        try:
+            for conn in self.connections:
+                catalog = self.getCatalog(conn)
+                if catalog is None:
+                    print("[WARNING] database '%s' can't be read from the catalog" % conn)
+                    continue
+                for schema in self.getSchemas(conn):
+                    for t in self.getTables(conn, schema):
+                        fileName = tmpDir + '/table.sql'
+                        self.dumpTable(conn, schema, t, fileName)
+                        expected = self.getFileContent(fileName)
+                        if not catalog.hasDumpFrame():
+                            catalog.setDumpFrame(expected)
+                        content = catalog.renderTable(schema, t)
+                        if content is None:
+                            fallback += 1
+                            continue
+                        checked += 1
+                        if self.stripDumpKeys(content) != self.stripDumpKeys(expected):
+                            mismatched.append('%s/structure/%s/tables/%s.sql' % (conn, schema, t))
+        finally:
+            shutil.rmtree(tmpDir)
+
+        for fileName in mismatched:
+            print('[ERROR] catalog output differs from pg_dump: ' + fileName)
+        print('[INFO] %d tables compared, %d differ, %d always dumped with pg_dump'
+            % (checked, len(mismatched), fallback))
+        if len(mismatched) > 0:
+            exit(1)
+
+    def database_status(self, argv):
+        # compares the live catalog with what the last pull recorded on the
+        # database branch without extracting or committing anything, see
+        # getDrift; exits with 1 when a server drifted or couldn't be compared
+        jobs = self.getJobsOption(argv)
+        if len(argv) < 1 or argv[0] == '--help':
+            print('usage: git db database status [--jobs <n>] <name or pattern>...')
+            exit(0)
+        servers = fleet.matchRemotes(self.gitConfig.getSubsections(self.config['config_section_prefix']),
+            ','.join(argv))
+        if len(servers) == 0:
+            print('[ERROR] no remote matches \'%s\'' % ' '.join(argv))
+            exit(1)
+        if len(servers) == 1:
+            if self.getDrift(servers[0]) != 0:
+                exit(1)
+            return
+
+        # the report of a server is printed in one piece once it's complete
+        for server in servers:
+            self.connectionManager.getCredentials(server)
+        lazy.resolve(psycopg2, git)
+        outputLock = threading.Lock()
+
+        def check(server):
+            lines = []
+            try:
+                drift = self.createWorker().getDrift(server, lines.append)
+            except SystemExit:
+                drift = None
+            with outputLock:
+                print('\n======== %s ========' % server)
+                for line in lines:
+                    print(line)
+            return drift
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = dict(zip(servers, executor.map(check, servers)))
+        print('\n======== Status of %d servers ========' % len(servers))
+        for server, drift in results.items():
+            status = 'unknown' if drift is None else 'drifted' if drift > 0 else 'in sync'
+            print('%-10s %s' % (status, server) + (' (%d objects)' % drift if drift else ''))
+        if any(drift != 0 for drift in results.values()):
+            exit(1)
+
+    def getDrift(self, name, log=print):
+        # number of objects that were added, removed or changed on the server
+        # since the last pull, None when they can't be compared; tables are
+        # compared by their catalog fingerprints in the manifest, the other
+        # objects are rendered from the catalog and compared by blob id
+        r = git.Repo()
+        branchName = self.config['database_branch_prefix'] + '/' + name
+        try:
+            commit = r.commit(branchName)
+        except (git.BadName, ValueError):
+            log("[ERROR] there is no branch '%s', run 'git db database pull %s' first" % (branchName, name))
+            return None
+        self.tree = gittree.TreeBuilder(r, commit)
+        try:
+            manifest = json.loads(self.readPulledFile(MANIFEST_PATH) or 'null')
+        except ValueError:
+            manifest = None
+        if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+            log("[ERROR] '%s' has no fingerprint manifest, run 'git db database pull %s' first"
+                % (branchName, name))
+            return None
+        recorded = manifest.get('objects', {})
+        connection = self.connect(name)
+        self.setDatabases(connection.cursor())
+        self.setDatabaseConnections(name)
+        expected = set(path for path in self.tree.paths() if self.isObjectPath(path))
+        found = set()
+        changes = []
+        with tracing.span('database status', remote=name):
+            for conn in self.connections:
+                schemas = self.getSchemas(conn)
+                fingerprints = self.getFingerprints(conn)
+                if len(fingerprints) == 0:
+                    log("[ERROR] database '%s' has no catalog fingerprints, PostgreSQL 12 or newer "
+                        "is needed" % conn)
+                    return None
+                for schema, table in self.getAllTables(conn):
+                    if schema not in schemas:
+                        continue
+                    fileName = '%s/structure/%s/tables/%s.sql' % (conn, schema, table)
+                    found.add(fileName)
+                    if fileName not in expected:
+                        changes.append((fileName, 'added'))
+                    elif recorded.get(fileName) != fingerprints.get((schema, table)):
+                        changes.append((fileName, 'changed'))
+                objectCatalog = self.getObjectCatalog(conn)
+                for schema in schemas:
+                    for kind, objectName, content in objectCatalog.getFiles(schema):
+                        fileName = '%s/structure/%s/%s/%s.sql' % (conn, schema, kind, objectName)
+                        found.add(fileName)
+                        if fileName not in expected:
+                            changes.append((fileName, 'added'))
+                        elif not self.tree.isUnchanged(fileName, content):
+                            changes.append((fileName, 'changed'))
+        for fileName in expected - found:
+            changes.append((fileName, 'removed'))
+
+        for fileName, change in sorted(changes):
+            log('%-10s %s' % (change, fileName))
+        counts = dict((change, sum(1 for c in changes if c[1] == change))
+            for change in ['added', 'removed', 'changed'])
+        if len(changes) == 0:
+            log("[INFO] '%s' matches '%s'" % (name, branchName))
+        else:
+            log("[INFO] '%s' drifted from '%s': %d added, %d removed, %d changed"
+                % (name, branchName, counts['added'], counts['removed'], counts['changed']))
+        return len(changes)
+
+    def isObjectPath(self, path):
+        # <db>/structure/<schema>/<kind>/<name>.sql
+        parts = path.split('/')
+        return len(parts) == 5 and parts[1] == 'structure' and parts[3] in objects.KINDS \
+            and parts[4].endswith('.sql')
+
     def database_check(self, argv):
         # two arguments are needed: name and address of the database
         if len(argv) < 1 or argv[0] == '--help':
             print('usage: git db database check <database name>')
             exit(0)
         name = argv[0]
-        url, port, username, password = self.getDatabaseConnectionInfo(name)
-        connection = self.connect(url, port, username, password)
+        connection = self.connect(name)
         cursor = connection.cursor()
         cursor.execute("SELECT version();")
         record = cursor.fetchone()
@@ -287,28 +650,49 @@ class Database:
     # --------------------------------------------------------------
     
     def patch_create(self, argv):
+        if '--help' in argv:
+            print('usage: git db patch create [--online] [--offline] [--overwrite] [<database branch>]')
+            return
         useNextNumber = True 
+        # --online generates DDL taking only brief locks, see ddl.compareTableStructure
+        self.online = '--online' in argv
+        if self.online:
+            argv.remove('--online')
+        # --offline reads the catalog snapshot of the patch target instead of
+        # the server, the patch is registered in git_db when it is applied
+        self.offline = '--offline' in argv
+        if self.offline:
+            argv.remove('--offline')
         if '--overwrite' in argv:
             useNextNumber = False
             self.deletePatchFiles()
             argv.remove('--overwrite')
         # read patch target (database the patch is for) from branch config
-        if len(argv) > 0 and argv[0] != '--help':
+        if len(argv) > 0:
             self.patchTarget = argv[0]
         else:
             self.setPatchTarget()
-        dbName = self.getDatabaseFromPatchTarget()
-        url, port, username, password = self.getDatabaseConnectionInfo(dbName)
-        connection = self.connect(url, port, username, password)
-        cursor = connection.cursor()
-        self.setDatabases(cursor)
+        if self.offline:
+            self.readCatalogSnapshot()
+        else:
+            dbName = self.getDatabaseFromPatchTarget()
+            connection = self.connect(dbName)
+            cursor = connection.cursor()
+            self.setDatabases(cursor)
+            self.setDatabaseConnections(dbName)
         self.resetPatchData()
-        self.setDatabaseConnections(self.getDatabaseFromPatchTarget())
-
-        # first look at new files and add them to patchData
-        self.addNewFilesToPatch('tables')
-        self.addDeletedFilesToPatch('tables')
-        self.addAlteredFilesToPatch('tables')
+        self.diffIndex = None
+        self.diffCache = self.getDiffCache()
+
+        # first look at new files and add them to patchData, then add the
+        # views that have to be rebuilt and order everything by dependencies
+        self.replacedPaths = {}
+        for kind in objects.KINDS:
+            self.addNewFilesToPatch(kind)
+            self.addDeletedFilesToPatch(kind)
+            self.addAlteredFilesToPatch(kind)
+        self.addDependentObjectsToPatch()
+        self.orderPatchData()
 
         dbNeedsPatch = False
         if self.checkPatchData():
@@ -316,15 +700,6 @@ class Database:
             dbNeedsPatch = True
             useNextNumber = False
 
-        # TODO: add more than tables like so:
-        # self.addNewFilesToPatch('views')
-        # self.addDeletedFilesToPatch('views')
-        # self.addAlteredFilesToPatch('views')
-        # if self.checkPatchData():
-        #     self.pushChangesToPatchFile(useNextNumber)
-        #     dbNeedsPatch = True
-        #     useNextNumber = False
-
         self.addQueriesToPatch()
         if self.checkPatchData():
             self.pushChangesToPatchFile(useNextNumber)
@@ -336,11 +711,44 @@ class Database:
             print("Patch created: " + fileName)
         else:
             print("Nothing to patch")
+        if self.diffCache is not None:
+            self.diffCache.evict()
+
+    def getDiffCache(self):
+        try:
+            maxSize = diffcache.parseSize(self.config['diff_cache_size'])
+        except ValueError as e:
+            print("[ERROR] 'diffcachesize': %s" % e)
+            exit(1)
+        if maxSize == 0:
+            return None
+        return diffcache.DiffCache(maxSize)
 
     def patch_apply(self, argv):
-        if len(argv) > 0 and argv[0] == '--help':
-            print('usage: git db patch apply <database name> <patch name>')
-            # exit(0)
+        # --statements runs the patch statement by statement, committing each one
+        # together with a checkpoint; --resume continues after the last checkpoint
+        # --jobs applies the files of different databases concurrently, --fail-fast
+        # stops starting new databases after the first failure; --plan only
+        # prints what the statements would cost, see planPatch; --fleet applies
+        # the patch to every matching remote, see applyToFleet
+        resume = '--resume' in argv
+        statements = resume or '--statements' in argv
+        failFast = '--fail-fast' in argv
+        plan = '--plan' in argv
+        argv = [a for a in argv if a not in ['--resume', '--statements', '--fail-fast', '--plan']]
+        if '--help' in argv:
+            print('usage: git db patch apply [--plan] [--statements] [--resume] [--jobs <n>] [--fail-fast]\n'
+                '    [--lock-timeout <t>] [--statement-timeout <t>] [--lock-retry-deadline <t>]\n'
+                '    <database name> <patch name>\n'
+                '   or: git db patch apply --fleet <remotes> [--parallel <n>] [--canary <n>]\n'
+                '    [--max-failures <n|n%>] [<apply options>] [<patch name>]')
+            return
+        jobs = self.getJobsOption(argv)
+        self.lockPolicy = self.getLockPolicy(argv)
+        fleet = self.getOption(argv, '--fleet')
+        if fleet is not None:
+            self.applyToFleet(fleet, argv, statements, resume, jobs, failFast)
+            return
         elif len(argv) == 1:
             connectionName = argv[0]
             patchName = self.getPatchName(False).split('/')[-1]
@@ -353,6 +761,9 @@ class Database:
             self.setPatchTarget()
             connectionName = self.getDatabaseFromPatchTarget()
             patchName = self.getPatchName(False).split('/')[-1]
+        if plan:
+            self.planPatch(connectionName, patchName)
+            return
         print('Do you want to apply patch \'%s\' to the database \'%s\'? [y/n]' 
             % (patchName, connectionName))
         choice = input().lower()
@@ -360,8 +771,15 @@ class Database:
             print ('[Abort]')
             exit(0)
 
-        url, port, username, password = self.getDatabaseConnectionInfo(connectionName)
-        conn = self.connect(url, port, username, password)
+        results = self.applyToServer(connectionName, patchName, statements, resume, jobs, failFast)
+        self.printApplySummary(patchName, results)
+        if any(r is not None and not r[0] for r in results.values()):
+            exit(1)
+
+    def applyToServer(self, connectionName, patchName, statements, resume, jobs, failFast, log=print):
+        # applies the patch files to the databases of one remote, creating the
+        # databases and schemas they need first
+        conn = self.connect(connectionName)
         cursor = conn.cursor()
         self.setDatabases(cursor)
         self.setDatabaseConnections(connectionName)
@@ -370,10 +788,11 @@ class Database:
             ext = f.split('.')[-1]
             name = f.split('.')[0]
             if ext == 'sql' and name not in self.connections.keys():
-                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
                 cursor = conn.cursor()
-                print ('[INFO] creating database \'%s\'' % name)
+                log('[INFO] creating database \'%s\'' % name)
                 cursor.execute("CREATE DATABASE %s;" % name)
+                conn.autocommit = False
                 self.setDatabases(cursor)
                 self.setDatabaseConnections(connectionName)
                 self.registerPatch(patchName, name)
@@ -386,102 +805,421 @@ class Database:
                 c = self.connections[name]
                 for d in os.listdir(name + '/structure'):
                     cr = c.cursor()
-                    print ('[INFO] creating schema \'%s\' for database \'%s\'' 
+                    log('[INFO] creating schema \'%s\' for database \'%s\''
                         % (d, name))
                     cr.execute("CREATE SCHEMA IF NOT EXISTS %s;" % d)
                 c.commit()
-                
-        for dbName, connection in self.connections.items():
+
+        return self.applyPatchFiles(patchName, statements, resume, jobs, failFast, log)
+
+    def applyToFleet(self, patterns, argv, statements, resume, jobs, failFast):
+        # one confirmation for every remote matching the patterns, each remote
+        # is applied to by its own Database sharing the config and connections
+        try:
+            parallel = int(self.getOption(argv, '--parallel', '1'))
+            canaries = int(self.getOption(argv, '--canary', '1'))
+        except ValueError:
+            print("[ERROR] '--parallel' and '--canary' expect a number")
+            exit(1)
+        maxFailures = self.getOption(argv, '--max-failures', '0')
+        if len(argv) > 1:
+            print('[ERROR] --fleet takes the remotes from its pattern, only a patch name is expected')
+            exit(1)
+        patchName = argv[0] if len(argv) == 1 else self.getPatchName(False).split('/')[-1]
+        if not os.path.isdir('patches/' + patchName):
+            print('[ERROR] patch \'%s\' does not exist' % patchName)
+            exit(1)
+        servers = fleet.matchRemotes(self.gitConfig.getSubsections(self.config['config_section_prefix']),
+            patterns)
+        if len(servers) == 0:
+            print('[ERROR] no remote matches \'%s\'' % patterns)
+            exit(1)
+        try:
+            maxFailures = fleet.parseThreshold(maxFailures, len(servers))
+        except ValueError as e:
+            print("[ERROR] '--max-failures': %s" % e)
+            exit(1)
+        rollout = fleet.Rollout(servers, parallel, canaries, maxFailures)
+        print('Do you want to apply patch \'%s\' to %d databases (%s)? [y/n]'
+            % (patchName, len(servers), ', '.join(servers)))
+        print('Canaries: %s; %d at a time afterwards, stopping after %d failed'
+            % (', '.join(servers[:rollout.canaries]) or 'none', rollout.parallel, maxFailures + 1))
+        choice = input().lower()
+        if (choice != 'y'):
+            print ('[Abort]')
+            exit(0)
+        # prompts for missing user names can't run concurrently
+        for server in servers:
+            self.connectionManager.getCredentials(server)
+        lazy.resolve(psycopg2, ddl)
+
+        outputLock = threading.Lock()
+
+        def apply(server):
+            def log(line):
+                with outputLock:
+                    for part in line.strip('\n').split('\n'):
+                        print('[%s] %s' % (server, part))
+            worker = self.createWorker()
+            with tracing.span('apply patch to server', remote=server):
+                results = worker.applyToServer(server, patchName, statements, resume, jobs,
+                    failFast, log)
+            ok = all(r is None or r[0] for r in results.values())
+            return fleet.ServerResult(fleet.OK if ok else fleet.FAILED, databases=results)
+
+        results = rollout.run(apply)
+        fleet.printReport(patchName, results)
+        if any(r.status != fleet.OK for r in results.values()):
+            exit(1)
+
+    def createWorker(self):
+        # a Database for one remote of a command working on many of them at
+        # the same time, sharing the config and the connections
+        worker = Database(self.shared)
+        worker.gitConfig = self.gitConfig
+        worker.config = self.config
+        worker.connectionManager = self.connectionManager
+        worker.lockPolicy = getattr(self, 'lockPolicy', None)
+        return worker
+
+    def planPatch(self, connectionName, patchName):
+        # classifies every statement of the patch as metadata-only, validating
+        # scan or full rewrite using the live catalog, nothing is executed
+        conn = self.connect(connectionName)
+        self.setDatabases(conn.cursor())
+        self.setDatabaseConnections(connectionName)
+        totals = dict((kind, 0) for kind in planner.CLASSES)
+        totalBytes = 0
+        totalSeconds = 0.0
+        for f in sorted(os.listdir('patches/' + patchName)):
+            name, ext = os.path.splitext(f)
+            if ext != '.sql':
+                continue
+            path = 'patches/%s/%s' % (patchName, f)
+            print('\n======== Plan of patch \'%s\' for database \'%s\' ========' % (patchName, name))
+            connection = None
+            if name in self.connections:
+                connection = self.connections[name]
+            else:
+                print('[INFO] database \'%s\' does not exist yet, all its tables are new' % name)
+            estimator = planner.Planner(connection, self.config['plan_scan_rate'],
+                self.config['plan_rewrite_rate'])
+            try:
+                with tracing.span('plan patch file', file=path):
+                    plans = estimator.plan(self.getFileContent(path))
+            except ddl.SqlError as e:
+                print('[ERROR] Unable to split \'%s\' into statements: %s' % (path, e))
+                continue
+            except psycopg2.Error as e:
+                self.printApplyError(e)
+                continue
+            counts = dict((kind, 0) for kind in planner.CLASSES)
+            for p in plans:
+                kind = p.getClass()
+                counts[kind] += 1
+                table = '.'.join(p.table) if p.table is not None else ''
+                stats = estimator.tables.get(p.table)
+                print('[%d/%d] %-15s %-30s %10s %9s  %s' % (p.number, len(plans), kind, table,
+                    planner.formatSize(p.bytes) if p.bytes > 0 else '',
+                    '~%.1fs' % p.seconds if p.seconds > 0 else '', self.describeStatement(p.statement)))
+                for stepKind, reason in p.steps:
+                    if len(reason) > 0:
+                        print('        %s: %s' % (stepKind, reason))
+                if stats is not None and not stats.analyzed and kind != planner.METADATA:
+                    print('        %s was never analyzed, its size is read from disk' % table)
+                totalBytes += p.bytes
+                totalSeconds += p.seconds
+            print(', '.join('%d %s' % (counts[kind], kind) for kind in planner.CLASSES if counts[kind] > 0)
+                + '; %s touched, ~%.1fs' % (planner.formatSize(sum(p.bytes for p in plans)),
+                sum(p.seconds for p in plans)))
+            for kind in planner.CLASSES:
+                totals[kind] += counts[kind]
+        print('\n[INFO] %d statements would rewrite a table and %d would scan one, '
+            '%s touched in ~%.1fs in total (assuming %s MB/s for scans, %s MB/s for rewrites)'
+            % (totals[planner.REWRITE], totals[planner.SCAN], planner.formatSize(totalBytes),
+            totalSeconds, self.config['plan_scan_rate'], self.config['plan_rewrite_rate']))
+
+    def applyPatchFiles(self, patchName, statements, resume, jobs, failFast, log=print):
+        # database name -> (ok, seconds), None for databases skipped after a
+        # failure with --fail-fast
+        files = []
+        for dbName in self.connections:
             patchFilePath = 'patches/' + patchName + '/' + dbName + '.sql'
             if (os.path.exists(patchFilePath)):
-                cursor = connection.cursor()
-                print('\n\n[INFO] Applying patch file \'%s\'' % patchFilePath)
-                    
-                command = 'BEGIN;\n'
-                command += self.getFileContent(patchFilePath) + '\n'
-                command += 'COMMIT;\n'
-
-                try:
-                    cursor.execute(command)
-                    cursor.execute('''UPDATE git_db.patch 
-                        SET applied = TRUE, applied_timestamp = current_timestamp
-                        WHERE name = %s;
-
-                        UPDATE git_db.query 
-                        SET applied = TRUE, applied_timestamp = current_timestamp
-                        WHERE applied_patch_id = (
-                            SELECT id FROM git_db.patch WHERE name = %s
-                        );''', (patchName, patchName))
-                    connection.commit()
-                    print ('[INFO]...ok')
-                except psycopg2.Error as e:
-                    print ('[ERROR] Error applying patch')
-                    print ('[ERROR]PGSQL error code: ' + e.pgcode)
-                    print ('[ERROR]PGSQL error message:' 
-                        + '\n----------------\n' 
-                        + e.pgerror 
-                        + '----------------')
-                    connection.rollback()
-                    pass
-    # --------------------------------------------------------------
-    # -------------------------- util functions --------------------
-    # --------------------------------------------------------------
+                files.append((dbName, patchFilePath))
 
-    def connect(self, url, port, user, password, database=None):
-        try:
-            if database is None:
-                database = 'postgres'
-            return psycopg2.connect(host=url, 
-                port=port,
-                user=user,
-                password=password,
-                database=database)
-        except:
-            if database is not None:
-                print("[ERROR] I am unable to connect to the database '" + database + "'")
+        results = {}
+        if jobs == 1:
+            for dbName, patchFilePath in files:
+                if failFast and any(not r[0] for r in results.values() if r is not None):
+                    results[dbName] = None
+                    continue
+                results[dbName] = self.applyPatchToDatabase(dbName, patchName, patchFilePath,
+                    statements, resume, log)
+            return results
+
+        # every database has its own connection, output lines are prefixed
+        # with the database name as they are interleaved
+        failed = threading.Event()
+        outputLock = threading.Lock()
+
+        def apply(dbName, patchFilePath):
+            if failFast and failed.is_set():
+                return None
+            def databaseLog(line):
+                with outputLock:
+                    log('[%s] %s' % (dbName, line.strip('\n')))
+            result = self.applyPatchToDatabase(dbName, patchName, patchFilePath,
+                statements, resume, databaseLog)
+            if not result[0]:
+                failed.set()
+            return result
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [(dbName, executor.submit(apply, dbName, patchFilePath))
+                for dbName, patchFilePath in files]
+            for dbName, future in futures:
+                results[dbName] = future.result()
+        return results
+
+    def applyPatchToDatabase(self, dbName, patchName, patchFilePath, statements, resume, log=print):
+        connection = self.connections[dbName]
+        log('\n\n[INFO] Applying patch file \'%s\'' % patchFilePath)
+        with tracing.span('apply patch file', file=patchFilePath):
+            return self.applyPatch(connection, patchName, patchFilePath, statements, resume, log)
+
+    def applyPatch(self, connection, patchName, patchFilePath, statements, resume, log=print):
+        started = time()
+        if not statements and ddl.NO_TRANSACTION in ddl.parseDirectives(self.getFileContent(patchFilePath)):
+            log('[INFO] The patch has statements that cannot run in a transaction, '
+                'applying it statement by statement')
+            statements = True
+        if statements:
+            ok = self.applyPatchStatements(connection, patchName, patchFilePath, resume, log)
+        else:
+            ok = self.applyPatchFile(connection, patchName, patchFilePath, log)
+        return ok, time() - started
+
+    def printApplySummary(self, patchName, results):
+        if len(results) == 0:
+            print('[INFO] Patch \'%s\' has no files for this database' % patchName)
+            return
+        print('\n======== Summary of patch \'%s\' ========' % patchName)
+        counts = {'ok': 0, 'failed': 0, 'skipped': 0}
+        for dbName, result in results.items():
+            if result is None:
+                status = 'skipped'
+                print('%-10s %s' % (status, dbName))
             else:
-                print("[ERROR] I am unable to connect to the database")
-            exit(1)
-    
-    def getDatabaseConnectionInfo(self, name):
-        # based on how remotes are stored
-        sectionName = self.config['config_section_prefix'] + ' "' + name + '"'
+                status = 'ok' if result[0] else 'failed'
+                print('%-10s %s (%.3fs)' % (status, dbName, result[1]))
+            counts[status] += 1
+        print('%d applied, %d failed, %d skipped' % (counts['ok'], counts['failed'], counts['skipped']))
 
-        r = git.Repo()
-        rw = r.config_reader()
-        # url is mandatory
-        url = rw.get_value(sectionName, 'url', '')
-        if len(rw.get_value(sectionName, 'url', '')) == 0:
-            print('[ERROR] Database "' + name + '" does not exists')
+    def applyPatchFile(self, connection, patchName, patchFilePath, log=print):
+        # the whole file in a single transaction, retried as a whole when a lock
+        # cannot be acquired
+        command = self.getFileContent(patchFilePath) + '\n'
+        stats = locking.LockStats()
+
+        def work(cursor):
+            cursor.execute(command)
+            self.markPatchApplied(cursor, patchName, command)
+
+        try:
+            # patches created with --offline may be the first git-db has seen
+            # of a database
+            metadata.migrate(connection, log)
+            connection.autocommit = False
+            self.lockPolicy.execute(connection, work, stats, log=log)
+            log('[INFO]...ok' + self.describeLockWait(stats))
+            return True
+        except psycopg2.Error as e:
+            self.printApplyError(e, log)
+            return False
+
+    def applyPatchStatements(self, connection, patchName, patchFilePath, resume, log=print):
+        content = self.getFileContent(patchFilePath)
+        checksum = hashlib.md5(content.encode('utf-8')).hexdigest()
+        try:
+            statements = ddl.splitStatements(content, withOffsets=True)
+        except ddl.SqlError as e:
+            log('[ERROR] Unable to split \'%s\' into statements: %s' % (patchFilePath, e))
+            return False
+
+        try:
+            metadata.migrate(connection, log)
+        except psycopg2.Error as e:
+            self.printApplyError(e, log)
+            return False
+        connection.autocommit = False
+        cursor = connection.cursor()
+        cursor.execute('''SELECT checksum, statement_start
+            FROM git_db.patch_statement
+            WHERE patch_name = %s''', (patchName,))
+        records = cursor.fetchall()
+        done = set()
+        if resume:
+            if any(r[0] != checksum for r in records):
+                log('[ERROR] Patch file \'%s\' changed since it was partially applied, '
+                    'cannot resume' % patchFilePath)
+                connection.rollback()
+                return False
+            done = set(r[1] for r in records)
+        else:
+            cursor.execute('DELETE FROM git_db.patch_statement WHERE patch_name = %s', (patchName,))
+        connection.commit()
+
+        if len(done) > 0:
+            log('[INFO] resuming, %d of %d statements already applied' % (len(done), len(statements)))
+        total = len(statements)
+        applied = len(done)
+        started = time()
+        stats = locking.LockStats()
+        previousEnd = 0
+        for number, (start, end, statement) in enumerate(statements, 1):
+            # '-- git-db:' comments right before a statement apply to it
+            directives = ddl.parseDirectives(content[previousEnd:start])
+            previousEnd = end
+            if start in done:
+                continue
+            statementStarted = time()
+            lockWait = stats.lockWait + stats.backoff
+
+            # statements marked 'no-transaction' run in autocommit mode, the
+            # checkpoint is then committed right after them
+            transaction = not directives.get(ddl.NO_TRANSACTION, False)
+            dropIndex = None if transaction else ddl.dropStatement(statement)
+
+            def work(cursor):
+                if dropIndex is not None and dropIndex.startswith('DROP INDEX'):
+                    self.dropInvalidIndex(cursor, dropIndex)
+                cursor.execute(statement)
+                cursor.execute('''INSERT INTO git_db.patch_statement
+                    (patch_name, checksum, statement_start, statement_end, duration)
+                    VALUES (%s, %s, %s, %s, %s)''', (patchName, checksum, start, end,
+                    time() - statementStarted))
+
+            try:
+                with tracing.span('apply statement', number=number,
+                        statement=self.describeStatement(statement)):
+                    self.lockPolicy.execute(connection, work, stats, statement, directives, log,
+                        transaction)
+                applied += 1
+            except psycopg2.Error as e:
+                log('[ERROR] Statement %d of %d failed (line %d of \'%s\'):'
+                    % (number, total, content.count('\n', 0, start) + 1, patchFilePath))
+                log(self.describeStatement(statement))
+                self.printApplyError(e, log)
+                log('[INFO] %d statements applied, run \'git db patch apply --resume\' '
+                    'to continue from the failed one' % applied)
+                return False
+            duration = time() - statementStarted
+            lockWait = stats.lockWait + stats.backoff - lockWait
+            log('[INFO] [%d/%d] %.3fs %s%s' % (number, total, duration,
+                self.describeStatement(statement),
+                ' (%.3fs waiting for locks)' % lockWait if lockWait > 0 else ''))
+
+        self.markPatchApplied(cursor, patchName, content)
+        connection.commit()
+        log('[INFO]...ok (%.3fs)%s' % (time() - started, self.describeLockWait(stats)))
+        return True
+
+    def describeLockWait(self, stats):
+        if stats.retries == 0:
+            return ''
+        return ', %.3fs waiting for locks and %.3fs backing off in %d retries' % (
+            stats.lockWait, stats.backoff, stats.retries)
+
+    def getLockPolicy(self, argv):
+        lockTimeout = self.getOption(argv, '--lock-timeout', self.config['lock_timeout'])
+        statementTimeout = self.getOption(argv, '--statement-timeout', self.config['statement_timeout'])
+        deadline = self.getOption(argv, '--lock-retry-deadline', self.config['lock_retry_deadline'])
+        try:
+            return locking.LockPolicy(lockTimeout, statementTimeout, deadline,
+                self.config['object_timeouts'])
+        except ValueError as e:
+            print("[ERROR] '--lock-retry-deadline': %s" % e)
             exit(1)
-        
-        port = rw.get_value(sectionName, 'port', '')
-        # default PgSQL port, if not specified directly
-        if not port:
-            port = '5432'
-        
-        username = rw.get_value(sectionName, 'user', '')
-        if len(username) == 0:
-            username = input('username:')
-        
-        password = rw.get_value(sectionName, 'password', '')
-        if len(password) == 0:
-            password = getpass.getpass()
-        
-        self.connection_info = {
-            'host': url, 
-            'port': port, 
-            'username': username, 
-            'password': password,
-        }
-        return url, port, username, password
+
+    def getOption(self, argv, name, default=None):
+        # reads and removes '<name> <value>' or '<name>=<value>' from argv
+        for i, arg in enumerate(argv):
+            if arg == name and i + 1 < len(argv):
+                value = argv[i + 1]
+                del argv[i:i + 2]
+                return value
+            if arg.startswith(name + '='):
+                del argv[i]
+                return arg.split('=', 1)[1]
+        return default
+
+    def dropInvalidIndex(self, cursor, dropIndex):
+        # a failed CREATE INDEX CONCURRENTLY leaves an invalid index behind,
+        # which has to go before the statement can be retried
+        name = dropIndex[len('DROP INDEX IF EXISTS '):]
+        cursor.execute('''SELECT NOT i.indisvalid
+            FROM pg_catalog.pg_index i
+            WHERE i.indexrelid = pg_catalog.to_regclass(%s)''', (name,))
+        record = cursor.fetchone()
+        if record is not None and record[0]:
+            cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+
+    def describeStatement(self, statement):
+        # first line of a statement, for progress output
+        line = statement.strip().split('\n')[0]
+        if len(line) > 80:
+            line = line[:77] + '...'
+        return line
+
+    def markPatchApplied(self, cursor, patchName, content):
+        # patches created with --offline are registered here, together with the
+        # query files they contain
+        cursor.execute('INSERT INTO git_db.patch (name) VALUES (%s) ON CONFLICT (name) DO NOTHING',
+            (patchName,))
+        for path in re.findall(r'(?m)^-- ([^/\s]+/queries/.+\.sql)$', content):
+            queriesPath, name = path.split('/queries/', 1)[0] + '/queries', path.split('/')[-1]
+            namespace = os.path.relpath(os.path.dirname(path), queriesPath)
+            cursor.execute('''INSERT INTO git_db.query (name, namespace, path, timestamp, applied_patch_id)
+                SELECT %s, %s, %s, current_timestamp, id FROM git_db.patch
+                WHERE name = %s AND NOT EXISTS (SELECT 1 FROM git_db.query WHERE path = %s)''',
+                (name, '' if namespace == '.' else namespace, path, patchName, path))
+        cursor.execute('''UPDATE git_db.patch 
+            SET applied = TRUE, applied_timestamp = current_timestamp
+            WHERE name = %s;
+
+            UPDATE git_db.query 
+            SET applied = TRUE, applied_timestamp = current_timestamp
+            WHERE applied_patch_id = (
+                SELECT id FROM git_db.patch WHERE name = %s
+            );''', (patchName, patchName))
+
+    def printApplyError(self, e, log=print):
+        log('[ERROR] Error applying patch')
+        log('[ERROR]PGSQL error code: ' + str(e.pgcode))
+        log('[ERROR]PGSQL error message:' 
+            + '\n----------------\n' 
+            + str(e.pgerror) 
+            + '----------------')
+
+    # --------------------------------------------------------------
+    # -------------------------- util functions --------------------
+    # --------------------------------------------------------------
+
+    def connect(self, name, database=None):
+        # connections are opened once per run and reused by every command
+        return self.connectionManager.connect(name, database)
 
     def setDatabases(self, cursor):
         cursor.execute("SELECT datname FROM pg_database WHERE datistemplate = false;")
         records = cursor.fetchall()
+        if not cursor.connection.autocommit:
+            cursor.connection.commit()
         self.databases = [r[0] for r in records]
 
     def createDbDirectories(self, cursor):
+        if self.tree is not None:
+            return
         for s in self.databases:
             if os.path.exists(s):
                 print("[INFO] Schema '" + s + "' already exists")
@@ -490,6 +1228,7 @@ class Database:
         return
 
     def createDbBranch(self, name):
+        tracing.count('subprocesses')
         os.system('git checkout --orphan ' + self.config['database_branch_prefix'] + '/' + name)
         try:
             with open(os.devnull, 'wb') as devnull:
@@ -498,9 +1237,11 @@ class Database:
             pass
 
     def setDatabaseConnections(self, name):
-        host, port, user, password = self.getDatabaseConnectionInfo(name)
-        for d in self.databases:
-            self.connections[d] = self.connect(host, port, user, password, d)
+        # databases are connected to lazily, on first access
+        self.remoteName = name
+        self.connections = self.connectionManager.getDatabaseConnections(name, self.databases)
+        if self.shared is not None:
+            self.shared.useCaches(self, name)
     
     def getSchemas(self, dbName):
         connection = self.connections[dbName]
@@ -514,67 +1255,400 @@ class Database:
     def getTables(self, dbName, schema):
         connection = self.connections[dbName]
         cursor = connection.cursor()
-        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = '%s'" % schema)
+        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = '%s' "
+            "AND table_type <> 'VIEW'" % schema)
         records = cursor.fetchall()
         return [r[0] for r in records]
 
+    def getAllTables(self, dbName):
+        # (schema, table) of every schema in one query, the tables getTables returns
+        connection = self.connections[dbName]
+        cursor = connection.cursor()
+        cursor.execute("SELECT table_schema, table_name FROM information_schema.tables "
+            "WHERE table_type <> 'VIEW'")
+        return cursor.fetchall()
+
     def createSchemaDirectories(self, connection, schemas):
+        if self.tree is not None:
+            # git only keeps the directories through their .gitkeep files
+            for s in schemas:
+                if not self.tree.exists(connection + '/structure/' + s):
+                    self.tree.write(connection + '/structure/' + s + '/.gitkeep', '')
+            if not self.tree.exists(connection + '/queries'):
+                self.tree.write(connection + '/queries/.gitkeep', '')
+            return
         for s in schemas:
             if os.path.exists(connection + '/structure/' + s):
                 print("[INFO] Schema '" + s + "' in '" + connection + "' already exists")
             else :
                 os.makedirs(connection + '/structure/' + s)
+                tracing.count('subprocesses')
                 os.system('touch ' + connection + '/structure/' + s + '/.gitkeep')
 
         if not os.path.exists(connection + '/queries/'):
             os.makedirs(connection + '/queries/')
+            tracing.count('subprocesses')
             os.system('touch ' + connection + '/queries/.gitkeep')
         
         return
 
-    def createTableStructure(self, conn, schema):
+    def createStructureParallel(self, schemas, jobs):
+        # every (database, schema) pair is extracted by a worker; the output
+        # of each one is buffered and printed in the same order as a serial run
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            tasks = []
+            for conn in self.connections:
+                for schema in schemas[conn]:
+                    output = []
+                    tasks.append((conn, schema, output,
+                        executor.submit(self.createTableStructure, conn, schema, output.append)))
+            lastConn = None
+            for conn, schema, output, future in tasks:
+                if conn != lastConn:
+                    print("\r\n======== Connected to: '" + conn + '" ========')
+                    lastConn = conn
+                print("Fetching table structure for: '" + schema + "'")
+                future.result()
+                for line in output:
+                    print(line)
+
+    def createTableStructure(self, conn, schema, log=print):
+        with tracing.span('extract schema', database=conn, schema=schema):
+            self.extractTables(conn, schema, log)
+            self.extractObjects(conn, schema, log)
+
+    def extractTables(self, conn, schema, log=print):
         tables = self.getTables(conn, schema)
         path = "%s/structure/%s/tables" % (conn, schema)
-        if not os.path.exists(path):
+        if self.tree is None and not os.path.exists(path):
             os.makedirs(path)
+        fingerprints = self.getFingerprints(conn)
+        unchanged = 0
         for t in tables:
             fileName = "%s/%s.sql" % (path, t)
-            print('====' + fileName)
-            os.system("export PGPASSWORD='%s' && pg_dump --host %s --port %s --schema-only --table %s --user %s --file %s --dbname=%s" % (
-                self.connection_info['password'],
-                self.connection_info['host'],
-                self.connection_info['port'],
-                schema + '.' + t,
-                self.connection_info['username'],
-                fileName,
-                conn
-            ))
+            self.pulledFiles.add(fileName)
+            fingerprint = fingerprints.get((schema, t))
+            if fingerprint is not None:
+                self.fingerprints[fileName] = fingerprint
+                if self.manifest.get(fileName) == fingerprint and self.pulledFileExists(fileName):
+                    unchanged += 1
+                    continue
+            log('====' + fileName)
+            with tracing.span('extract table', file=fileName):
+                self.extractTable(conn, schema, t, fileName)
+        if unchanged > 0:
+            log('[INFO] %d unchanged tables skipped' % unchanged)
+
+    def extractTable(self, conn, schema, table, fileName):
+        # the catalog is only read once something has to be extracted
+        catalog = self.getCatalog(conn)
+        content = None
+        if catalog is not None:
+            content = catalog.renderTable(schema, table)
+        if content is None:
+            self.dumpTable(conn, schema, table, fileName)
+            # the first pg_dump output of a database provides the header
+            # and footer for all the files rendered from the catalog
+            if catalog is not None and not catalog.hasDumpFrame():
+                catalog.setDumpFrame(self.readPulledFile(fileName))
+        else:
+            self.writeFile(fileName, content)
+
+    def extractObjects(self, conn, schema, log=print):
+        # views, functions, sequences and types are rendered from one batch of
+        # catalog queries per database; unchanged files are not written again
+        objectCatalog = self.getObjectCatalog(conn)
+        unchanged = 0
+        for kind, name, content in objectCatalog.getFiles(schema):
+            fileName = '%s/structure/%s/%s/%s.sql' % (conn, schema, kind, name)
+            self.pulledFiles.add(fileName)
+            if self.isPulledFileUnchanged(fileName, content):
+                unchanged += 1
+                continue
+            if self.tree is None:
+                os.makedirs(os.path.dirname(fileName), exist_ok=True)
+            log('====' + fileName)
+            self.writeFile(fileName, content)
+        if unchanged > 0:
+            log('[INFO] %d unchanged objects skipped' % unchanged)
+
+    def getObjectCatalog(self, conn):
+        with self.getCatalogLock(conn):
+            if conn not in self.objectCatalogs:
+                self.noteCatalogLoad(conn)
+                objectCatalog = objects.ObjectCatalog(self.connections[conn])
+                with tracing.span('object catalog load', database=conn):
+                    objectCatalog.load()
+                if not objectCatalog.isSupportedServer():
+                    print("[WARNING] views, functions, sequences and types need PostgreSQL 12 "
+                        "or newer, only tables are pulled")
+                self.objectCatalogs[conn] = objectCatalog
+            return self.objectCatalogs[conn]
+
+    def writeFile(self, fileName, content):
+        with tracing.span('write file', file=fileName):
+            if self.tree is not None:
+                self.tree.write(fileName, content)
+            else:
+                with open(fileName, 'w') as f:
+                    f.write(content)
+        tracing.count('bytes_written', len(content))
+
+    # pulled files are read from the tree being built with --no-checkout, from
+    # the working tree otherwise
+
+    def pulledFileExists(self, fileName):
+        if self.tree is not None:
+            return self.tree.exists(fileName)
+        return os.path.exists(fileName)
+
+    def readPulledFile(self, fileName):
+        if self.tree is not None:
+            return self.tree.read(fileName)
+        if not os.path.exists(fileName):
+            return None
+        return self.getFileContent(fileName)
+
+    def isPulledFileUnchanged(self, fileName, content):
+        if self.tree is not None:
+            return self.tree.isUnchanged(fileName, content)
+        return os.path.exists(fileName) and self.getFileContent(fileName) == content
+
+    def getFingerprints(self, conn):
+        with self.getCatalogLock(conn):
+            if conn not in self.catalogFingerprints:
+                self.noteCatalogLoad(conn)
+                self.catalogFingerprints[conn] = Catalog(self.connections[conn]).loadFingerprints()
+            return self.catalogFingerprints[conn]
+
+    def getDumpEnvironment(self, cursor):
+        # anything that changes the files without changing the catalog
+        cursor.execute('SELECT version();')
+        try:
+            tracing.count('subprocesses')
+            dumpVersion = subprocess.check_output(['pg_dump', '--version']).decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            dumpVersion = ''
+        return {
+            'version': MANIFEST_VERSION,
+            'server': cursor.fetchone()[0],
+            'pg_dump': dumpVersion,
+            'extractor': self.config['extractor'],
+        }
+
+    def readManifest(self, environment):
+        content = self.readPulledFile(MANIFEST_PATH)
+        if content is None:
+            return None
+        try:
+            manifest = json.loads(content)
+        except ValueError:
+            print('[WARNING] fingerprint manifest is corrupted, pulling all objects')
+            return None
+        for key, value in environment.items():
+            if manifest.get(key) != value:
+                print('[INFO] %s changed since the last pull, pulling all objects' % key)
+                return None
+        return manifest.get('objects', {})
+
+    def writeManifest(self, environment):
+        manifest = dict(environment)
+        manifest['objects'] = self.fingerprints
+        if self.tree is None and not os.path.exists(os.path.dirname(MANIFEST_PATH)):
+            os.makedirs(os.path.dirname(MANIFEST_PATH))
+        self.writeFile(MANIFEST_PATH, json.dumps(manifest, indent=1, sort_keys=True) + '\n')
+
+    def writeCatalogSnapshot(self):
+        # everything 'patch create' reads from the server, so it can run offline
+        snapshot = {
+            'version': CATALOG_SNAPSHOT_VERSION,
+            'databases': sorted(self.databases),
+            'dependencies': {},
+        }
+        for conn in self.connections:
+            snapshot['dependencies'][conn] = dict((path, sorted(referenced))
+                for path, referenced in self.getDependencies(conn).items())
+        self.writeFile(CATALOG_SNAPSHOT_PATH, json.dumps(snapshot, indent=1, sort_keys=True) + '\n')
+
+    def readCatalogSnapshot(self):
+        # the snapshot committed with the patch target, by 'database pull'
+        r = git.Repo()
+        try:
+            blob = r.commit(self.patchTarget).tree / CATALOG_SNAPSHOT_PATH
+            snapshot = json.loads(blob.data_stream.read().decode('utf-8'))
+        except (KeyError, ValueError):
+            snapshot = None
+        if snapshot is None or snapshot.get('version') != CATALOG_SNAPSHOT_VERSION:
+            print("[ERROR] '%s' has no catalog snapshot, run 'git db database pull %s' first"
+                % (self.patchTarget, self.getDatabaseFromPatchTarget()))
+            exit(1)
+        self.databases = snapshot['databases']
+        self.connections = {}
+        for db in self.databases:
+            self.dependencies[db] = dict((path, set(referenced))
+                for path, referenced in snapshot['dependencies'].get(db, {}).items())
+
+    def removeDroppedFiles(self, schemas):
+        # remove files of objects, schemas and databases that no longer exist
+        expected = set(self.pulledFiles)
+        expected.add(MANIFEST_PATH)
+        expected.add(CATALOG_SNAPSHOT_PATH)
+        for conn in self.connections:
+            expected.add(conn + '/queries/.gitkeep')
+            for schema in schemas[conn]:
+                expected.add('%s/structure/%s/.gitkeep' % (conn, schema))
+        if self.tree is not None:
+            for fileName in self.tree.paths():
+                if fileName not in expected:
+                    print('[INFO] removing ' + fileName)
+                    self.tree.remove(fileName)
+            return
+        r = git.Repo()
+        for fileName in r.git.ls_files().split('\n'):
+            if len(fileName) > 0 and fileName not in expected and os.path.exists(fileName):
+                print('[INFO] removing ' + fileName)
+                os.remove(fileName)
+
+    def dumpTable(self, conn, schema, table, fileName):
+        # quote the names, so pg_dump doesn't treat them as case-folded patterns
+        pattern = '"%s"."%s"' % (schema.replace('"', '""'), table.replace('"', '""'))
+        credentials = self.connectionManager.getCredentials(self.remoteName)
+        outputName = fileName
+        if self.tree is not None:
+            # pg_dump needs a file, its content is stored as a blob right away
+            descriptor, outputName = tempfile.mkstemp(suffix='.sql')
+            os.close(descriptor)
+        command = ['pg_dump', '--schema-only', '--table', pattern, '--file', outputName,
+            '--dbname', conn]
+        for option, key in [('--host', 'host'), ('--port', 'port'), ('--username', 'username')]:
+            if credentials[key] is not None:
+                command += [option, credentials[key]]
+        tracing.count('subprocesses')
+        with tracing.span('pg_dump', table=pattern):
+            subprocess.call(command, env=self.connectionManager.getEnvironment(self.remoteName))
+        if tracing.isEnabled() and os.path.exists(outputName):
+            tracing.count('bytes_written', os.path.getsize(outputName))
+        if self.tree is not None:
+            self.tree.write(fileName, self.getFileContent(outputName))
+            os.remove(outputName)
+
+    def getCatalog(self, conn):
+        if self.config['extractor'] != 'catalog':
+            return None
+        with self.getCatalogLock(conn):
+            return self.loadCatalog(conn)
+
+    def noteCatalogLoad(self, conn):
+        # a daemon keeps what is loaded from the catalog until it changes
+        if self.shared is not None and not self.offline:
+            self.shared.noteLoad(self.remoteName, conn, self.connections[conn])
+
+    def getCatalogLock(self, conn):
+        # one lock per database, so catalogs of different databases load concurrently
+        with self.catalogLock:
+            return self.catalogLocks.setdefault(conn, threading.Lock())
+
+    def loadCatalog(self, conn):
+        if conn not in self.catalogs:
+            self.noteCatalogLoad(conn)
+            catalog = Catalog(self.connections[conn])
+            with tracing.span('catalog load', database=conn):
+                catalog.load()
+            if not catalog.isSupportedServer():
+                print("[WARNING] catalog extraction needs PostgreSQL 12 or newer, using pg_dump")
+                catalog = None
+            self.catalogs[conn] = catalog
+        return self.catalogs[conn]
+
+    def getJobsOption(self, argv):
+        # reads and removes '--jobs <n>', '--jobs=<n>' or '-j <n>' from argv
+        jobs = '1'
+        for i, arg in enumerate(argv):
+            if arg in ['--jobs', '-j'] and i + 1 < len(argv):
+                jobs = argv[i + 1]
+                del argv[i:i + 2]
+                break
+            if arg.startswith('--jobs='):
+                jobs = arg.split('=', 1)[1]
+                del argv[i]
+                break
+        if not jobs.isdigit() or int(jobs) < 1:
+            print("[ERROR] '--jobs' expects a positive number")
+            exit(1)
+        return int(jobs)
+
+    def stripDumpKeys(self, dump):
+        # newer pg_dump versions wrap the output in \restrict lines holding a random key
+        return re.sub('^\\\\(un)?restrict .*\n', '', dump, flags=re.MULTILINE)
     
     def addNewFilesToPatch(self, directory):
+        for change in self.getChangedFiles(directory, 'A'):
+            self.addToPatchData(change['database'], patchfile.NEW, change['path'])
+
+    def addToPatchData(self, db, changeType, fileName, content=None):
+        # without content the file itself is streamed into the patch
+        if db not in self.patchData:
+            self.patchData[db] = patchfile.PatchChanges()
+        self.patchData[db].add(fileName, changeType, content)
+
+    def getChangedFiles(self, kind, changeType):
+        # the commit diff is computed once per patch and shared by every stage
+        if self.diffIndex is None:
+            self.classifyDiff()
+        return self.diffIndex.get((kind, changeType), [])
+
+    def classifyDiff(self):
         r = git.Repo()
         currentCommit = r.commit(r.active_branch.name)
         remoteCommit = r.commit(self.patchTarget)
-        diffIndex = remoteCommit.diff(currentCommit)
-        for newItem in diffIndex.iter_change_type('A'):
-            if re.match('^([^\/]*\/){3}' + directory + '\/.*', newItem.b_path):
-                db = newItem.b_path.split('/')[0]
-                if db in self.patchData.keys():
-                    self.patchData[db]['new'].append({
-                        'file': newItem.b_path,
-                        'content': self.getFileContent(newItem.b_path)
-                    })
-                else:
-                    self.patchData[db] = {
-                        'new': [],
-                        'update': [],
-                        'delete': []
-                    }
-                        
-                    self.patchData[db]['new'].append({
-                        'file': newItem.b_path,
-                        'content': self.getFileContent(newItem.b_path)
-                    })
-    
+        # commits never change, a daemon reuses the diff until one of the
+        # branches moves
+        key = (remoteCommit.hexsha, currentCommit.hexsha)
+        if self.shared is not None and key in self.shared.diffs:
+            self.diffIndex = self.shared.diffs[key]
+            return
+        self.diffIndex = {}
+        with tracing.span('diff commits', base=self.patchTarget):
+            diff = remoteCommit.diff(currentCommit)
+        for item in diff:
+            # same rules as git.DiffIndex.iter_change_type
+            changeTypes = []
+            if item.change_type == 'A' or item.new_file:
+                changeTypes.append('A')
+            if item.change_type == 'D' or item.deleted_file:
+                changeTypes.append('D')
+            if item.change_type == 'M' or (item.a_blob and item.b_blob and item.a_blob != item.b_blob):
+                changeTypes.append('M')
+            for changeType in changeTypes:
+                path = item.a_path if changeType == 'D' else item.b_path
+                change = self.classifyPath(path)
+                if change is None:
+                    continue
+                change['change'] = changeType
+                change['item'] = item
+                self.diffIndex.setdefault((change['kind'], changeType), []).append(change)
+        if self.shared is not None:
+            self.shared.diffs = {key: self.diffIndex}
+
+    def classifyPath(self, path):
+        # <db>/structure/<schema>/<kind>/<name>.sql or <db>/queries/...
+        pathArray = path.split('/')
+        if len(pathArray) > 4 and pathArray[1] == 'structure':
+            return {
+                'database': pathArray[0],
+                'schema': pathArray[2],
+                'kind': pathArray[3],
+                'path': path
+            }
+        if len(pathArray) > 2 and pathArray[1] == 'queries':
+            return {
+                'database': pathArray[0],
+                'schema': None,
+                'kind': 'queries',
+                'path': path
+            }
+        return None
+
     def getFileContent(self, filePath):
         s = ''
         with open(filePath, 'r') as f:
@@ -585,223 +1659,207 @@ class Database:
         patchPath = self.getPatchName(next)
         for db in self.patchData.keys():
             patchName = patchPath.split('/')[-1]
-            self.registerPatch(patchName, db)
+            if not self.offline:
+                self.registerPatch(patchName, db)
             if self.checkPatchDataDb(db):
                 mode = 'w'
                 fileName = patchPath + '/' + db + '.sql'
                 if os.path.exists(fileName):
                     mode = 'a'
 
-                with open(fileName, mode) as f:
-                    for changeType in ['delete', 'new', 'update']:
-                        isFirst = True
-                        for dataDict in self.patchData[db][changeType]:
-                            if isFirst:
-                                isFirst = False
-                            else:
-                                f.write('\n\n')
-                            f.write('-- ' + dataDict['file'] + '\n')
-                            f.write(re.sub('\n\n+', '\n\n', dataDict['content']))
+                with tracing.span('write file', file=fileName):
+                    with open(fileName, mode) as f:
+                        position = f.tell()
+                        patchfile.writeChanges(f, self.patchData[db])
+                        tracing.count('bytes_written', f.tell() - position)
         
         self.resetPatchData()
     
     def addAlteredFilesToPatch(self, directory):
-        r = git.Repo()
-        currentCommit = r.commit(r.active_branch.name)
-        remoteCommit = r.commit(self.patchTarget)
-        diffIndex = remoteCommit.diff(currentCommit)
-
-        for newItem in diffIndex.iter_change_type('M'):
-            if directory is 'tables':
-                if newItem.b_path != newItem.a_path:
-                    db = newItem.b_path.split('/')[0]
-                    if db not in self.patchData:
-                        self.patchData[db] = {
-                            'new': [],
-                            'update': [],
-                            'delete': []
-                        }
-                    self.patchData[db]['new'].append({
-                        'file': newItem.b_path,
-                        'content': self.getFileContent(newItem.b_path)
-                    })
-                    continue
+        for change in self.getChangedFiles(directory, 'M'):
+            newItem = change['item']
+            db = change['database']
+            if newItem.b_path != newItem.a_path:
+                self.addToPatchData(db, patchfile.NEW, newItem.b_path)
+                continue
+            if directory == 'tables':
                 addToPatch = self.checkTableDiff(newItem, newItem.b_path)
                 if addToPatch:
-                    db = newItem.b_path.split('/')[0]
-                    if db in self.patchData:
-                        self.patchData[db]['update'].append({
-                            'file': newItem.b_path,
-                            'content': addToPatch
-                        })
-                    else:
-                        self.patchData[db] = {
-                            'new': [],
-                            'update': [],
-                            'delete': []
-                        }
-
-                        self.patchData[db]['update'].append({
-                            'file': newItem.b_path,
-                            'content': addToPatch
-                        })
-            # else:
-                # self.patchData['update'][newItem.b_path] = self.getFileContent(newItem.b_path)
+                    self.addToPatchData(db, patchfile.UPDATE, newItem.b_path, addToPatch)
+                    # views using a column that changes type or goes away block the ALTER
+                    if re.search(r'\bTYPE\b|\bDROP COLUMN\b', addToPatch):
+                        self.replacedPaths.setdefault(db, set()).add(newItem.b_path)
+                continue
+            targetFile = newItem.a_blob.data_stream.read().decode('utf-8')
+            currentFile = newItem.b_blob.data_stream.read().decode('utf-8')
+            if directory == objects.FUNCTIONS:
+                self.addAlteredFunctionsToPatch(db, newItem.b_path, targetFile, currentFile)
+            elif directory == objects.SEQUENCES:
+                # pg_dump style CREATE SEQUENCE options are valid ALTER SEQUENCE options
+                content = currentFile.replace('CREATE SEQUENCE ', 'ALTER SEQUENCE ', 1)
+                if not re.search(r'(?m)^    CYCLE;$', content):
+                    content = re.sub(r'(?m)^(    CACHE \d+);$', '\\1\n    NO CYCLE;', content, 1)
+                self.addToPatchData(db, patchfile.UPDATE, newItem.b_path, content)
+            elif directory == objects.TYPES and self.getAddedEnumValues(targetFile, currentFile):
+                self.addToPatchData(db, patchfile.UPDATE, newItem.b_path,
+                    self.getAddedEnumValues(targetFile, currentFile))
+            else:
+                # views and changed types are dropped and created again
+                self.addToPatchData(db, patchfile.DELETE, newItem.b_path,
+                    '\n'.join(objects.dropStatements(targetFile)) + '\n\n')
+                self.addToPatchData(db, patchfile.NEW, newItem.b_path)
+                self.replacedPaths.setdefault(db, set()).add(newItem.b_path)
         return
-    
+
+    def addAlteredFunctionsToPatch(self, db, path, targetFile, currentFile):
+        # CREATE OR REPLACE can't remove an overload or change the result or the
+        # argument names of a function, those are dropped first
+        targetEntries = objects.getEntries(targetFile)
+        currentEntries = objects.getEntries(currentFile)
+        drops = []
+        for ownerStatement, entry in targetEntries.items():
+            current = currentEntries.get(ownerStatement)
+            if current is None or self.getFunctionHeader(current) != self.getFunctionHeader(entry):
+                drops += objects.dropStatements(ownerStatement)
+        if len(drops) > 0:
+            self.addToPatchData(db, patchfile.DELETE, path, '\n'.join(drops) + '\n\n')
+            self.replacedPaths.setdefault(db, set()).add(path)
+        self.addToPatchData(db, patchfile.UPDATE, path)
+
+    def getFunctionHeader(self, entry):
+        return re.findall(r'(?m)^(CREATE OR REPLACE .*|\s*RETURNS .*)$', entry)
+
+    def getAddedEnumValues(self, targetFile, currentFile):
+        # ALTER TYPE ... ADD VALUE for labels added to an enum, None when the
+        # type changed in any other way
+        pattern = r'CREATE TYPE (.+) AS ENUM \(\n(.*?)\n\);'
+        target = re.search(pattern, targetFile, re.DOTALL)
+        current = re.search(pattern, currentFile, re.DOTALL)
+        if target is None or current is None or target.group(1) != current.group(1):
+            return None
+        targetLabels = [l.strip() for l in target.group(2).split(',\n')]
+        currentLabels = [l.strip() for l in current.group(2).split(',\n')]
+        if [l for l in currentLabels if l in targetLabels] != targetLabels:
+            return None
+        statements = []
+        for i, label in enumerate(currentLabels):
+            if label in targetLabels:
+                continue
+            position = ' BEFORE ' + currentLabels[i + 1] if i + 1 < len(currentLabels) else ''
+            if i > 0:
+                position = ' AFTER ' + currentLabels[i - 1]
+            statements.append('ALTER TYPE %s ADD VALUE IF NOT EXISTS %s%s;' % (
+                current.group(1), label, position))
+        if len(statements) == 0:
+            return None
+        return '\n'.join(statements) + '\n\n'
+
     def addDeletedFilesToPatch(self, directory):
-        r = git.Repo()
-        currentCommit = r.commit(r.active_branch.name)
-        remoteCommit = r.commit(self.patchTarget)
-        diffIndex = remoteCommit.diff(currentCommit)
-
-        for removedItem in diffIndex.iter_change_type('D'):
-            pathArray = removedItem.a_path.split('/')
-            if len(pathArray) > 2 \
-                and pathArray[2] == directory \
-                and directory == 'tables':
-
-                tableName = pathArray[-3] + '\.' \
-                    + pathArray[-1].split('.')[0]
-                db = pathArray[0]
-                if db in self.patchData:
-                    self.patchData[db]['delete'].append({
-                        'file': removedItem.a_path,
-                        'content': 'DROP TABLE IF EXISTS ' + tableName.replace('\.', '.') + ';\n\n'
-                    })
+        for change in self.getChangedFiles(directory, 'D'):
+            if directory == 'tables' and change['database'] in self.patchData:
+                tableName = change['schema'] + '.' + change['path'].split('/')[-1].split('.')[0]
+                self.addToPatchData(change['database'], patchfile.DELETE, change['path'],
+                    'DROP TABLE IF EXISTS ' + tableName + ';\n\n')
+            elif directory != 'tables':
+                targetFile = change['item'].a_blob.data_stream.read().decode('utf-8')
+                self.addToPatchData(change['database'], patchfile.DELETE, change['path'],
+                    '\n'.join(objects.dropStatements(targetFile)) + '\n\n')
         return
+
+    def addDependentObjectsToPatch(self):
+        # views depending on a dropped or rewritten object are dropped and
+        # created again, according to pg_depend of the patch target
+        for db, paths in self.replacedPaths.items():
+            inPatch = set(change.path for change in self.patchData[db].changes)
+            for path in sorted(objects.getDependents(self.getDependencies(db), paths)):
+                if path in inPatch or not os.path.exists(path):
+                    continue
+                if path.split('/')[3] not in objects.REBUILDABLE:
+                    print("[WARNING] '%s' depends on an object the patch replaces, "
+                        "it may have to be changed by hand" % path)
+                    continue
+                self.addToPatchData(db, patchfile.DELETE, path,
+                    '\n'.join(objects.dropStatements(self.getFileContent(path))) + '\n\n')
+                self.addToPatchData(db, patchfile.NEW, path)
+
+    def getDependencies(self, db):
+        if db not in self.dependencies:
+            self.noteCatalogLoad(db)
+            self.dependencies[db] = objects.loadDependencies(self.connections[db], db)
+        return self.dependencies[db]
+
+    def orderPatchData(self):
+        # drops run first, dependents before what they depend on, then the
+        # objects are created and altered in dependency order; names found in
+        # the new definitions add dependencies between new objects
+        for db, changes in self.patchData.items():
+            if len(changes) < 2:
+                continue
+            dependencies = self.getDependencies(db)
+            names = {}
+            for change in changes.changes:
+                pathArray = change.path.split('/')
+                names[(pathArray[2], pathArray[-1][:-len('.sql')])] = change.path
+            drops = [(c.path, c) for c in changes.changes if c.kind == patchfile.DELETE]
+            creates = [(c.path, c) for c in changes.changes if c.kind != patchfile.DELETE]
+            dropDependencies = {}
+            for dependent, referenced in dependencies.items():
+                for path in referenced:
+                    dropDependencies.setdefault(path, set()).add(dependent)
+            createDependencies = {}
+            for path, change in creates:
+                content = ''.join(change.chunks())
+                createDependencies[path] = dependencies.get(path, set()) | objects.getMentions(content, names)
+            drops = objects.order(drops, dropDependencies,
+                lambda i: (-objects.KINDS.index(drops[i][0].split('/')[3]), i))
+            creates = objects.order(creates, createDependencies,
+                lambda i: (objects.KINDS.index(creates[i][0].split('/')[3]),
+                    patchfile.KINDS.index(creates[i][1].kind), i))
+            changes.changes = [change for path, change in drops + creates]
     
     def checkTableDiff(self, itemBlob, filePath):
+        with tracing.span('checkTableDiff', file=filePath):
+            if self.diffCache is None:
+                return self.diffTable(itemBlob, filePath)
+            # the statements only depend on the blobs, see diffcache.py; the
+            # warnings printed while generating them are printed again on a hit
+            key = (itemBlob.a_blob.hexsha, itemBlob.b_blob.hexsha, filePath, self.online)
+            cached = self.diffCache.get(key)
+            if cached is not None:
+                sql, messages = cached
+                for message in messages:
+                    print(message)
+                return sql
+            messages = []
+
+            def log(message):
+                messages.append(message)
+                print(message)
+
+            sql = self.diffTable(itemBlob, filePath, log)
+            self.diffCache.put(key, sql, messages)
+            return sql
+
+    def diffTable(self, itemBlob, filePath, log=print):
         targetFile = itemBlob.a_blob.data_stream.read().decode('utf-8')
         currentFile = itemBlob.b_blob.data_stream.read().decode('utf-8')
-        tableName = filePath.split('/')[-3] + '\.' + filePath.split('/')[-1].split('.')[0]
-
-        # filter out comments
-        currentFileParts = currentFile.split('\n')
-        currentFileParts = [row for row in currentFileParts if not re.match('^[ \t]*--', row)]
-        currentFileParts = '\n'.join(currentFileParts)
-
-        targetFileParts = targetFile.split('\n')
-        targetFileParts = [row for row in targetFileParts if not re.match('^[ \t]*--', row)]
-        targetFileParts = '\n'.join(targetFileParts)
-
-        # split both files per-command
-        currentFileParts = currentFileParts.split(';')
-        targetFileParts = targetFileParts.split(';')
-
-        # targetFileParts = [row for row in targetFileParts if not re.match('^\h*--', row)]
-        # get a diff string
-        # diff = ''
-        # for updatedItem in diffIndex.iter_change_type('M'):
-        #     if updatedItem.b_path == itemBlob.b_path:
-        #         diff = updatedItem.diff
-        #         break
-        
-        patch = self.compareTableStructure(currentFileParts, targetFileParts, tableName)
-        return patch
-        
-    def compareTableStructure(self, currentFileParts, targetFileParts, tableName):
-        sql = 'ALTER TABLE ' + tableName.replace('\.', '.') + '\n'
-        # look for the "create table" part to compare first
-        createTableCurrent = None
-        createTableTarget  = None
-        # store everything that is not 'create table' in these array
-        remainingFilePartsCurrent = {}
-        remainingFilePartsTarget = {}
-        tableNameArray = tableName.split('\.')
-        regexName = []
-        for el in tableNameArray:
-            regexName.append('\"*\'*\`*' + el + '\"*\'*\`*')
-        regexName = '\.'.join(regexName)
-
-        for el in currentFileParts:
-            el_clear = "".join(el.lower().split('\n'))
-            reObj = re.search('create\s+table\s*' + regexName + '\s*\((.*)\)', el_clear)
-            if reObj:
-                createTableCurrent = reObj.group(1)
-            else:
-                el_clear = "".join(el_clear.split())
-                remainingFilePartsCurrent[el_clear] = el
-
-        for el in targetFileParts:
-            el_clear = "".join(el.lower().split('\n'))
-            reObj = re.search('create\s+table\s*' + regexName + '\s*\((.*)\)', el_clear)
-            if reObj:
-                createTableTarget = reObj.group(1)
-            else:
-                el_clear = "".join(el_clear.split())
-                remainingFilePartsTarget[el_clear] = el
-                # createTableTarget = ''
-
-        # split the create table into column definitions. Strip whitespace for eaier comparison        
-        createTableColumnsCurrent = createTableCurrent.split(',')
-        createTableColumnsTarget = createTableTarget.split(',')
-        checkTableColumnsTarget = [' '.join(c.split()) \
-            for c in createTableColumnsTarget]
-        checkTableColumnsCurrent = [' '.join(c.split()) \
-            for c in createTableColumnsCurrent]
-        isAltered = False
-
-        for c in createTableColumnsTarget:
-            colName = c.split()[0]
-            
-            if not any(re.match('^' + colName + ' .*', check) for check in checkTableColumnsCurrent):
-                isAltered = True
-                sql += '\tDROP COLUMN IF EXISTS ' + colName + ',\n'
-        
-        for c in createTableColumnsCurrent:
-            colName = c.split()[0]
-            
-            if any(re.match('^' + colName + ' .*', check) for check in checkTableColumnsTarget):
-                filteredList = filter(lambda x: \
-                    re.match('^' + colName + ' .*', x),\
-                    checkTableColumnsTarget)
-                filteredList = list(filteredList)
-
-                if ''.join(filteredList[0].split()) != ''.join(c.split()):
-                    sql += '\tALTER COLUMN ' + c.lstrip() + ',\n'
-                    isAltered = True
-
-            else:
-                sql += '\tADD COLUMN IF NOT EXISTS ' + c.lstrip() + ',\n'
-                isAltered = True
-
-        if isAltered:
-            sql = sql.rstrip(',\n') + ';\n\n'
-        else:
-            sql = ''
-        
-
-        # whatever remains in the local file and is not identical to the target file
-        # should be considered an alteration and added to patch
-        isAltered = False
-        remainingFilePartsTargetCheck = remainingFilePartsTarget.keys()
-        for key, value in remainingFilePartsCurrent.items():
-            if key is not '' and key not in remainingFilePartsTargetCheck:
-                isAltered = True
-                sql += value + ';\n'
-
-        return sql
+        return ddl.diffTable(targetFile, currentFile, filePath, self.online, log)
     
     def setPatchTarget(self):
         r = git.Repo()
-        rw = r.config_writer()
+        rw = self.gitConfig
         branch = r.active_branch.name
         sectionName = "branch \"%s\"" % branch
         self.patchTarget = None
 
-        if not rw.has_section(sectionName) or not rw.has_option(sectionName, 'database'):
+        if not rw.hasOption(sectionName, 'database'):
             if len(self.config['default_database']) > 0:
-                rw.release()
                 self.remote_add([self.config['default_database']])
-                rw = r.config_writer()
 
-        if rw.has_section(sectionName) and rw.has_option(sectionName, 'database'):
-            self.patchTarget = rw.get(sectionName, 'database')
-            rw.release()
+        if rw.hasOption(sectionName, 'database'):
+            self.patchTarget = rw.getValue(sectionName, 'database')
         else:
             print("[ERROR] Branch '%s' is not tracking any database" % branch)
-            rw.release()
             exit(1)
 
     def getSimplePatchNumber(self, current, next=True):
@@ -811,17 +1869,14 @@ class Database:
 
     def getPatchName(self,next=True):
         r = git.Repo()
-        rw = r.config_writer()
+        rw = self.gitConfig
         branch = r.active_branch.name
         sectionName = "branch \"%s\"" % branch
         numberingMethod = None
         currentNumber = None
-        if rw.has_section(sectionName) \
-            and rw.has_option(sectionName, 'numbering') \
-            and rw.has_option(sectionName, 'current'):
-            
-            numberingMethod = rw.get(sectionName, 'numbering')
-            currentNumber = rw.get(sectionName, 'current')
+        if rw.hasOption(sectionName, 'numbering') and rw.hasOption(sectionName, 'current'):
+            numberingMethod = rw.getValue(sectionName, 'numbering')
+            currentNumber = rw.getValue(sectionName, 'current')
         
         if numberingMethod is None or currentNumber is None:
             print("[WARNING] Patch numbering method was not selected")
@@ -837,75 +1892,42 @@ class Database:
         if not os.path.exists('patches'):
             os.mkdir('patches')
 
-        rw.set_value(sectionName, 'current', number)
+        if str(number) != currentNumber:
+            rw.setValue(sectionName, 'current', number)
+            rw.write()
 
         filePath = 'patches/patch_%s' % number
         if not os.path.exists(filePath):
             os.mkdir(filePath)
-        
-        rw.release()
+
         return filePath
     
     def checkPatchData(self):
         for db in self.patchData:
-            for key in ['new', 'delete', 'update']:
-                if len(self.patchData[db][key]) > 0:
-                    return True
+            if self.checkPatchDataDb(db):
+                return True
         return False
     
     def checkPatchDataDb(self, dbName):
-        for key in ['new', 'delete', 'update']:
-            if len(self.patchData[dbName][key]) > 0:
-                return True
-        return False
+        return len(self.patchData[dbName]) > 0
 
     def checkGitDbInitialized(self, dbName):
+        # creates or upgrades the git_db schema the first time a database is used
         if dbName in self.connections.keys():
-            connection = self.connections[dbName]
-            cursor = connection.cursor()
-            cursor.execute('''SELECT schema_name 
-                FROM information_schema.schemata 
-                WHERE schema_name = 'git_db' ''')
-            
-            record = cursor.fetchone()
-            if record is None:
-                self.createGitDbSchema(dbName)
-            
-            return True
+            if dbName in self.gitDbInitialized:
+                return True
+            try:
+                # migrate() runs in a transaction of its own, the reads made
+                # on the connection so far are done with
+                self.connections[dbName].commit()
+                metadata.migrate(self.connections[dbName])
+                self.gitDbInitialized.add(dbName)
+                return True
+            except psycopg2.Error as e:
+                print('[WARNING] %s' % str(e).strip())
         print('[WARNING] database \'%s\' did not initialize git-db tables correctly' % dbName)
         return False
 
-    def createGitDbSchema(self, name):
-        connection = self.connections[name]
- 
-        print('[INFO] creating git_db schema in database \'%s\'' % name)
-        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-        cursor = connection.cursor()
-        cursor.execute("CREATE SCHEMA IF NOT EXISTS git_db;")
-
-        cursor = connection.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS git_db.query (
-                id SERIAL NOT NULL,
-                name VARCHAR(128) NOT NULL,
-                namespace VARCHAR(128) NOT NULL,
-                path VARCHAR(256) NOT NULL,
-                timestamp timestamp DEFAULT CURRENT_TIMESTAMP,
-                applied BOOLEAN DEFAULT FALSE,
-                applied_timestamp timestamp,
-                applied_patch_id INT
-            );
-
-            CREATE TABLE IF NOT EXISTS git_db.patch (
-                id SERIAL NOT NULL,
-                name VARCHAR(128) NOT NULL,
-                timestamp timestamp DEFAULT CURRENT_TIMESTAMP,
-                applied BOOLEAN DEFAULT FALSE,
-                applied_timestamp timestamp
-            );
-        ''')
-        connection.commit()
-
     def replaceWildcards(self, name):
         r = git.Repo()
         branch = r.active_branch.name
@@ -919,72 +1941,70 @@ class Database:
     
     
     def addQueriesToPatch(self):
+        if self.offline:
+            # without git_db.query, the query files added or changed since the
+            # patch target go into the patch
+            for changeType in ['A', 'M']:
+                for change in self.getChangedFiles('queries', changeType):
+                    self.addToPatchData(change['database'], patchfile.NEW, change['path'])
+            return
         patchPath = self.getPatchName(False)
         for dbName, connection in self.connections.items():
             patchName = patchPath.split('/')[-1]
             self.registerPatch(patchName, dbName)
             queryFiles, fileIds = self.getQueryFilesForPatch(connection, patchName)
             for f in queryFiles:
-                self.patchData[dbName]['new'].append({
-                    'file': f,
-                    'content': self.getFileContent(f)
-                })
+                self.addToPatchData(dbName, patchfile.NEW, f)
             self.registerQueryFilesInPatch(dbName, fileIds)
-        for d in os.listdir('./'):
-            if d not in self.connections.keys() and os.path.exists(d + '/queries'):
-                for (dirpath, dirnames, filenames) in os.walk(d + '/queries'):
-                    for f in filenames:
-                        fullFilePath = dirpath + '/' + f
-                        if d not in self.patchData.keys():
-                            self.patchData[d] = {
-                                'new': [],
-                                'delete': [],
-                                'update': []
-                            }
-                                
-                        self.patchData[d]['new'].append({
-                            'file': fullFilePath,
-                            'content': self.getFileContent(fullFilePath)
-                        })
+        # databases the server doesn't have yet get all their query files
+        for path in self.queryManifest.getFiles('*'):
+            d = path.split('/')[0]
+            if d not in self.connections.keys():
+                self.addToPatchData(d, patchfile.NEW, path)
 
         return
 
     def getCurrentDb(self, databaseName):
-        url, port, username, password = self.getDatabaseConnectionInfo(self.getDatabaseFromPatchTarget())
-        connection = self.connect(url, port, username, password, databaseName)
+        connection = self.connect(self.getDatabaseFromPatchTarget(), databaseName)
         cursor = connection.cursor()
         return connection, cursor
 
     def registerQuery(self, context):
         connection, cursor = self.getCurrentDb(context['database'])
-
-        contextSet = set(context['record'])
-        recordSet = set(['name', 'namespace', 'path', 'timestamp', 'applied', 'applied_timestamp', 'applied_patch_id'])
-        recordSet = recordSet.intersection(contextSet)
-
-        query = "INSERT INTO git_db.query ("
-        params = []
-        for column in recordSet:
-            query += column + ', '
-            params.append(context['record'][column])
-        query = query.rstrip(', ')
-        query += ') VALUES ('
-        for i in range(len(recordSet)):
-            query += '%s, '
-        query = query.rstrip(', ')
-        query += ') RETURNING id;'
-
-        try:
-            cursor.execute(query % tuple(params))
-            record = cursor.fetchone()
-            cursor.close()
-            connection.commit()
+        ids = self.registerQueries(connection, [context['record']])
+        if len(ids) > 0:
             print ('[INFO] query file registered in the database \'' + self.getDatabaseFromPatchTarget() \
-                + '.' + context['database'] + '.git_db.query\', under id=' + str(record[0]))
-        except:
+                + '.' + context['database'] + '.git_db.query\', under id=' + str(ids[0]))
+        else:
             print ('[INFO] query file was not registered in the database')
         return
 
+    def registerQueries(self, connection, records):
+        # registers query files with a single INSERT, skipping the ones already
+        # registered; records hold name, path, namespace and a unix timestamp
+        cursor = connection.cursor()
+        try:
+            # the lookups by path use query_path_idx; older versions stored the
+            # directory of a file as its path
+            cursor.execute('''INSERT INTO git_db.query (name, namespace, path, timestamp)
+                SELECT r.name, r.namespace, r.path, to_timestamp(r.timestamp)
+                FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::float8[])
+                    AS r(name, namespace, path, directory, timestamp)
+                WHERE NOT EXISTS (SELECT 1 FROM git_db.query q WHERE q.path = r.path)
+                    AND NOT EXISTS (SELECT 1 FROM git_db.query q
+                        WHERE q.path = r.directory AND q.name = r.name)
+                RETURNING id''',
+                ([r['name'] for r in records], [r['namespace'] for r in records],
+                [r['path'] for r in records], [os.path.dirname(r['path']) for r in records],
+                [r['timestamp'] for r in records]))
+            ids = cursor.fetchall()
+            connection.commit()
+            return [i[0] for i in ids]
+        except psycopg2.Error as e:
+            connection.rollback()
+            print('[WARNING] query files were not registered: ' + str(e).strip())
+            return []
+
     def getDatabaseFromPatchTarget(self):
         dbName = self.patchTarget
         # strip the prefix and '/'
@@ -993,11 +2013,7 @@ class Database:
     def resetPatchData(self):
         self.patchData = {}
         for db in self.databases:
-            self.patchData[db] = {
-                'new': [],
-                'delete': [],
-                'update': []
-            }
+            self.patchData[db] = patchfile.PatchChanges()
         return
     
     def deletePatchFiles(self):
@@ -1010,8 +2026,8 @@ class Database:
         cursor.execute('''SELECT q.path, q.id
             FROM git_db.query q
             LEFT JOIN git_db.patch p ON p.id = q.applied_patch_id
-            WHERE (p.id IS NULL OR p.id = %d) AND q.applied = FALSE
-            ORDER BY q.timestamp ASC;''' % self.patchId)
+            WHERE (p.id IS NULL OR p.id = %s) AND q.applied = FALSE
+            ORDER BY q.timestamp ASC;''', (self.patchId,))
         records = cursor.fetchall()
         return [r[0] for r in records], [r[1] for r in records]
     
@@ -1019,14 +2035,14 @@ class Database:
         if (self.checkGitDbInitialized(dbName)):
             connection = self.connections[dbName]
             cursor = connection.cursor()
-            cursor.execute('''SELECT id 
-                FROM git_db.patch 
-                WHERE name = '%s' ''' % patchName)
+            # a concurrent run may register the same patch, see markPatchApplied
+            cursor.execute('''INSERT INTO git_db.patch (name) VALUES (%s)
+                ON CONFLICT (name) DO NOTHING RETURNING id''', (patchName,))
             record = cursor.fetchone()
-
-            if record is None:
+            if record is not None:
                 print('[INFO] registering patch \'%s\' for database \'%s\'' % (patchName, dbName))
-                cursor.execute('INSERT INTO git_db.patch (name) VALUES(\'%s\') RETURNING id' % patchName)
+            else:
+                cursor.execute('SELECT id FROM git_db.patch WHERE name = %s', (patchName,))
                 record = cursor.fetchone()
 
             self.patchId = record[0]
@@ -1042,26 +2058,28 @@ class Database:
             return
         connection = self.connections[dbName]
         cursor = connection.cursor()
-        cursor.execute('UPDATE git_db.query SET applied_patch_id = %d WHERE id IN (%s)' 
-            % (self.patchId, ','.join([str(q) for q in queryRecordIds])) )
+        cursor.execute('UPDATE git_db.query SET applied_patch_id = %s WHERE id = ANY(%s)',
+            (self.patchId, list(queryRecordIds)))
 
     def registerExistingFiles(self, patchName, dbName):
-        for (dirpath, dirnames, filenames) in os.walk(dbName + '/queries'):
-            for f in filenames:
-                ext = f.split('.')[-1]
-                if ext != 'sql':
-                    continue
-                path = '/'.join(dirpath.split('/'))[2:]
-                timestamp = str(int(time()))
-        
-                context = {
-                    'database': dbName,
-                    'record': {
-                        'name': '\'' + f + '\'',
-                        'path': '\'' + dirpath + '\'',
-                        'timestamp': 'to_timestamp(' + timestamp + ')',
-                        'namespace': '\'' + path + '\''
-                    }
-                }
-                self.registerQuery(context)
-                print("[INFO] new query file was registered: '" + f + "'")
\ No newline at end of file
+        records = []
+        queriesPath = dbName + '/queries'
+        for path in self.queryManifest.getFiles(dbName):
+            dirpath, f = os.path.split(path)
+            ext = f.split('.')[-1]
+            if ext != 'sql':
+                continue
+            namespace = os.path.relpath(dirpath, queriesPath)
+            if namespace == '.':
+                namespace = ''
+            records.append({
+                'name': f,
+                'path': path,
+                'timestamp': int(time()),
+                'namespace': namespace
+            })
+        if len(records) == 0:
+            return
+        ids = self.registerQueries(self.connections[dbName], records)
+        print("[INFO] %d new query files registered, %d already registered"
+            % (len(ids), len(records) - len(ids)))
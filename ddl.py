@@ -0,0 +1,796 @@
+import re
+
+# A small SQL tokenizer and a structured model of CREATE TABLE statements,
+# used to compare two versions of a table file and generate ALTER TABLE
+# commands. It understands quoting (identifiers, strings, dollar quotes) and
+# comments, which is all that's needed to split pg_dump output reliably.
+
+WORD = 'word'
+QUOTED = 'quoted'
+STRING = 'string'
+NUMBER = 'number'
+OPERATOR = 'operator'
+PUNCTUATION = 'punctuation'
+COMMENT = 'comment'
+META = 'meta'
+
+TOKEN_REGEX = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*)
+  | (?P<string>[eE]'(?:[^'\\]|\\.|'')*'|[bBxXnN]?'(?:[^']|'')*')
+  | (?P<quoted>(?:[uU]&)?"(?:[^"]|"")*")
+  | (?P<dollar>\$(?:[A-Za-z_\x80-￿][A-Za-z0-9_\x80-￿]*)?\$)
+  | (?P<word>[A-Za-z_\x80-￿][A-Za-z0-9_$\x80-￿]*)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<param>\$\d+)
+  | (?P<typecast>::)
+  | (?P<operator>[+\-*/<>=~!@#%^&|`?]+)
+  | (?P<punctuation>[(),;\[\].:])
+''', re.VERBOSE | re.DOTALL)
+
+# keywords that end the type of a column definition and start its constraints
+COLUMN_CONSTRAINT_KEYWORDS = set(['collate', 'default', 'not', 'null', 'constraint',
+    'check', 'unique', 'primary', 'references', 'generated', 'storage', 'compression'])
+
+TABLE_CONSTRAINT_KEYWORDS = set(['constraint', 'check', 'unique', 'primary', 'foreign',
+    'exclude'])
+
+
+class Token:
+    __slots__ = ('type', 'value', 'start', 'end')
+
+    def __init__(self, type, value, start, end):
+        self.type = type
+        self.value = value
+        self.start = start
+        self.end = end
+
+    def normalized(self):
+        # unquoted words are case insensitive, everything else is compared as written
+        if self.type == WORD:
+            return self.value.lower()
+        return self.value
+
+    def isWord(self, *words):
+        return self.type == WORD and self.value.lower() in words
+
+    def isPunctuation(self, value):
+        return self.type == PUNCTUATION and self.value == value
+
+
+class SqlError(Exception):
+    pass
+
+
+def tokenize(sql):
+    tokens = []
+    position = 0
+    length = len(sql)
+    lineStart = True
+    while position < length:
+        # psql meta-commands (\connect, \restrict ...) take the rest of the line
+        if lineStart and sql[position] == '\\':
+            end = sql.find('\n', position)
+            end = length if end < 0 else end
+            tokens.append(Token(META, sql[position:end], position, end))
+            position = end
+            continue
+        if sql.startswith('/*', position):
+            end = skipBlockComment(sql, position)
+            tokens.append(Token(COMMENT, sql[position:end], position, end))
+            position = end
+            lineStart = False
+            continue
+        match = TOKEN_REGEX.match(sql, position)
+        if match is None:
+            raise SqlError('unexpected character %r at offset %d' % (sql[position], position))
+        kind = match.lastgroup
+        end = match.end()
+        if kind == 'space':
+            lineStart = '\n' in match.group()
+            position = end
+            continue
+        lineStart = False
+        if kind == 'dollar':
+            tag = match.group()
+            close = sql.find(tag, end)
+            if close < 0:
+                raise SqlError('unterminated dollar-quoted string at offset %d' % position)
+            end = close + len(tag)
+            kind = STRING
+        elif kind in ['param', 'typecast']:
+            kind = OPERATOR
+        elif kind == 'string' and not match.group().endswith("'"):
+            raise SqlError('unterminated string at offset %d' % position)
+        tokens.append(Token(kind, sql[position:end], position, end))
+        position = end
+    return tokens
+
+
+def skipBlockComment(sql, position):
+    # block comments nest in PostgreSQL
+    depth = 0
+    while position < len(sql):
+        if sql.startswith('/*', position):
+            depth += 1
+            position += 2
+        elif sql.startswith('*/', position):
+            depth -= 1
+            position += 2
+            if depth == 0:
+                return position
+        else:
+            position += 1
+    raise SqlError('unterminated comment')
+
+
+def significant(tokens):
+    return [t for t in tokens if t.type not in [COMMENT, META]]
+
+
+def splitStatements(sql, withOffsets=False):
+    # returns the statements of a script without their trailing ';', or
+    # (start, end, statement) tuples when withOffsets is set
+    statements = []
+    tokens = significant(tokenize(sql))
+    first = None
+    atomicDepth = 0
+    previous = None
+    for token in tokens:
+        if first is None:
+            if token.isPunctuation(';'):
+                continue
+            first = token
+        # SQL-standard function bodies (BEGIN ATOMIC ... END) contain semicolons
+        if token.isWord('atomic') and previous is not None and previous.isWord('begin'):
+            atomicDepth += 1
+        elif atomicDepth > 0 and token.isWord('case'):
+            atomicDepth += 1
+        elif atomicDepth > 0 and token.isWord('end'):
+            atomicDepth -= 1
+        if token.isPunctuation(';') and atomicDepth == 0:
+            statements.append((first.start, previous.end, sql[first.start:previous.end]))
+            first = None
+        previous = token
+    if first is not None:
+        statements.append((first.start, previous.end, sql[first.start:previous.end]))
+    if withOffsets:
+        return statements
+    return [s[2] for s in statements]
+
+
+def normalize(sql):
+    # a whitespace, comment and keyword-case insensitive form of a statement
+    return ' '.join([t.normalized() for t in significant(tokenize(sql))])
+
+
+def unquote(token):
+    if token.type == QUOTED:
+        return token.value[1:-1].replace('""', '"')
+    return token.value.lower()
+
+
+def splitTopLevel(tokens, separator=','):
+    # splits tokens on a separator outside of parentheses/brackets
+    parts = [[]]
+    depth = 0
+    for token in tokens:
+        if token.type == PUNCTUATION and token.value in ['(', '[']:
+            depth += 1
+        elif token.type == PUNCTUATION and token.value in [')', ']']:
+            depth -= 1
+        if depth == 0 and token.isPunctuation(separator):
+            parts.append([])
+            continue
+        parts[-1].append(token)
+    return [p for p in parts if len(p) > 0]
+
+
+def findClosing(tokens, index):
+    # index of the parenthesis closing the one at tokens[index]
+    depth = 0
+    for i in range(index, len(tokens)):
+        if tokens[i].isPunctuation('('):
+            depth += 1
+        elif tokens[i].isPunctuation(')'):
+            depth -= 1
+            if depth == 0:
+                return i
+    raise SqlError('unbalanced parentheses')
+
+
+class Column:
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.definition = ''
+        self.type = ''
+        self.typeKey = ''
+        self.collation = None
+        self.default = None
+        self.notNull = False
+        self.generated = None
+        self.identity = None
+        self.storage = None
+        self.compression = None
+        self.constraints = []
+
+
+class Constraint:
+    def __init__(self, name, definition, key):
+        self.name = name
+        self.definition = definition
+        self.key = key
+
+
+class Table:
+    def __init__(self):
+        self.schema = None
+        self.name = None
+        self.qualifiedName = None
+        self.unlogged = False
+        self.columns = {}
+        self.constraints = {}
+        self.options = {}
+        self.tablespace = None
+
+
+class TableParser:
+    def __init__(self, statement):
+        self.sql = statement
+        self.tokens = significant(tokenize(statement))
+
+    def text(self, tokens):
+        if len(tokens) == 0:
+            return ''
+        return self.sql[tokens[0].start:tokens[-1].end]
+
+    def key(self, tokens):
+        return ' '.join([t.normalized() for t in tokens])
+
+    def parse(self):
+        tokens = self.tokens
+        i = 0
+        if len(tokens) < 3 or not tokens[0].isWord('create'):
+            return None
+        i = 1
+        table = Table()
+        while i < len(tokens) and tokens[i].isWord('global', 'local', 'temp', 'temporary', 'unlogged'):
+            if tokens[i].isWord('unlogged'):
+                table.unlogged = True
+            i += 1
+        if i >= len(tokens) or not tokens[i].isWord('table'):
+            return None
+        i += 1
+        if i + 2 < len(tokens) and tokens[i].isWord('if') and tokens[i + 1].isWord('not'):
+            i += 3
+
+        nameStart = i
+        nameParts = [tokens[i]]
+        i += 1
+        while i + 1 < len(tokens) and tokens[i].isPunctuation('.'):
+            nameParts.append(tokens[i + 1])
+            i += 2
+        table.qualifiedName = self.text(tokens[nameStart:i])
+        table.name = unquote(nameParts[-1])
+        if len(nameParts) > 1:
+            table.schema = unquote(nameParts[-2])
+
+        if i < len(tokens) and tokens[i].isPunctuation('('):
+            close = findClosing(tokens, i)
+            for element in splitTopLevel(tokens[i + 1:close]):
+                self.parseElement(table, element)
+            i = close + 1
+        self.parseOptions(table, tokens[i:])
+        return table
+
+    def parseElement(self, table, element):
+        if element[0].isWord(*TABLE_CONSTRAINT_KEYWORDS):
+            name = None
+            if element[0].isWord('constraint') and len(element) > 1:
+                name = element[1].value
+            constraint = Constraint(name, self.text(element), self.key(element))
+            table.constraints[name or constraint.key] = constraint
+            return
+        if element[0].isWord('like'):
+            constraint = Constraint(None, self.text(element), self.key(element))
+            table.constraints[constraint.key] = constraint
+            return
+        column = self.parseColumn(element)
+        table.columns[column.key] = column
+
+    def parseColumn(self, element):
+        column = Column(element[0].value, unquote(element[0]))
+        column.definition = self.text(element[1:])
+        i = 1
+        while i < len(element) and not element[i].isWord(*COLUMN_CONSTRAINT_KEYWORDS):
+            i += 1
+        column.type = self.text(element[1:i])
+        column.typeKey = self.key(element[1:i])
+        while i < len(element):
+            token = element[i]
+            if token.isWord('collate'):
+                end = self.skipName(element, i + 1)
+                column.collation = self.text(element[i + 1:end])
+                i = end
+            elif token.isWord('default'):
+                end = self.findConstraintEnd(element, i + 1)
+                column.default = self.text(element[i + 1:end])
+                i = end
+            elif token.isWord('not') and i + 1 < len(element) and element[i + 1].isWord('null'):
+                column.notNull = True
+                i += 2
+            elif token.isWord('null'):
+                column.notNull = False
+                i += 1
+            elif token.isWord('generated'):
+                end = self.findConstraintEnd(element, i + 1)
+                definition = element[i:end]
+                if any(t.isWord('identity') for t in definition):
+                    column.identity = self.text(definition)
+                else:
+                    column.generated = self.text(definition)
+                i = end
+            elif token.isWord('storage', 'compression') and i + 1 < len(element):
+                setattr(column, token.value.lower(), element[i + 1].value)
+                i += 2
+            else:
+                # CHECK, UNIQUE, PRIMARY KEY, REFERENCES, optionally named
+                start = i
+                name = None
+                if token.isWord('constraint') and i + 1 < len(element):
+                    name = element[i + 1].value
+                    i += 2
+                end = self.findConstraintEnd(element, i + 1)
+                column.constraints.append(Constraint(name,
+                    self.text(element[i:end]), self.key(element[start:end])))
+                i = end
+        return column
+
+    def skipName(self, tokens, i):
+        i += 1
+        while i + 1 < len(tokens) and tokens[i].isPunctuation('.'):
+            i += 2
+        return i
+
+    def findConstraintEnd(self, tokens, i):
+        depth = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token.isPunctuation('('):
+                depth += 1
+            elif token.isPunctuation(')'):
+                depth -= 1
+            elif depth == 0 and token.isWord(*COLUMN_CONSTRAINT_KEYWORDS):
+                # NOT DEFERRABLE and UNIQUE NULLS NOT DISTINCT belong to the
+                # constraint, NOT NULL doesn't, and GENERATED BY DEFAULT AS
+                # IDENTITY isn't a default
+                if not (token.isWord('not') and i + 1 < len(tokens)
+                        and tokens[i + 1].isWord('deferrable')) \
+                        and not (token.isWord('not') and tokens[i - 1].isWord('nulls')) \
+                        and not (token.isWord('default') and tokens[i - 1].isWord('by')):
+                    return i
+            i += 1
+        return i
+
+    def parseOptions(self, table, tokens):
+        i = 0
+        while i < len(tokens):
+            if tokens[i].isWord('with') and i + 1 < len(tokens) and tokens[i + 1].isPunctuation('('):
+                close = findClosing(tokens, i + 1)
+                for option in splitTopLevel(tokens[i + 2:close]):
+                    name = option[0].value.lower()
+                    table.options[name] = self.text(option)
+                i = close + 1
+            elif tokens[i].isWord('tablespace') and i + 1 < len(tokens):
+                table.tablespace = tokens[i + 1].value
+                i += 2
+            else:
+                i += 1
+
+
+def parseCreateTable(statement):
+    return TableParser(statement).parse()
+
+
+def alterTable(target, current):
+    # ALTER TABLE subcommands that turn the target table into the current one
+    commands = []
+    for key, column in target.columns.items():
+        if key not in current.columns:
+            commands.append('DROP COLUMN IF EXISTS ' + column.name)
+
+    for key, column in current.columns.items():
+        if key not in target.columns:
+            commands.append('ADD COLUMN IF NOT EXISTS %s %s' % (column.name, column.definition))
+            continue
+        commands += alterColumn(target.columns[key], column)
+
+    for key, constraint in target.constraints.items():
+        if key not in current.constraints or current.constraints[key].key != constraint.key:
+            if constraint.name is not None:
+                commands.append('DROP CONSTRAINT IF EXISTS ' + constraint.name)
+    for key, constraint in current.constraints.items():
+        if key not in target.constraints or target.constraints[key].key != constraint.key:
+            if not constraint.definition.lower().startswith('like'):
+                commands.append('ADD ' + constraint.definition)
+
+    if target.unlogged != current.unlogged:
+        commands.append('SET UNLOGGED' if current.unlogged else 'SET LOGGED')
+    changed = [current.options[o] for o in current.options
+        if target.options.get(o) != current.options[o]]
+    if len(changed) > 0:
+        commands.append('SET (%s)' % ', '.join(changed))
+    removed = [o for o in target.options if o not in current.options]
+    if len(removed) > 0:
+        commands.append('RESET (%s)' % ', '.join(removed))
+    if target.tablespace != current.tablespace:
+        commands.append('SET TABLESPACE ' + (current.tablespace or 'pg_default'))
+    return commands
+
+
+IDENTITY_REGEX = re.compile(r'^GENERATED\s+(ALWAYS|BY\s+DEFAULT)\s+AS\s+IDENTITY\s*(.*)$',
+    re.IGNORECASE | re.DOTALL)
+
+
+def alterColumn(target, current):
+    name = current.name
+    if target.generated != current.generated:
+        # a generated column holds no data of its own, so it can be recreated
+        return ['DROP COLUMN IF EXISTS ' + target.name,
+            'ADD COLUMN %s %s' % (name, current.definition)]
+
+    commands = []
+    if target.typeKey != current.typeKey or target.collation != current.collation:
+        sql = 'ALTER COLUMN %s TYPE %s' % (name, current.type)
+        if current.collation is not None:
+            sql += ' COLLATE ' + current.collation
+        commands.append(sql)
+    # an identity goes before the default replacing it, and comes after the
+    # default it replaces and the NOT NULL it needs
+    targetIdentity = IDENTITY_REGEX.match(target.identity or '')
+    currentIdentity = IDENTITY_REGEX.match(current.identity or '')
+    setGenerated = targetIdentity and currentIdentity \
+        and normalize(targetIdentity.group(2)) == normalize(currentIdentity.group(2))
+    if target.identity != current.identity and target.identity is not None and not setGenerated:
+        commands.append('ALTER COLUMN %s DROP IDENTITY IF EXISTS' % name)
+    if target.default != current.default:
+        if current.default is None:
+            commands.append('ALTER COLUMN %s DROP DEFAULT' % name)
+        else:
+            commands.append('ALTER COLUMN %s SET DEFAULT %s' % (name, current.default))
+    if target.notNull != current.notNull:
+        commands.append('ALTER COLUMN %s %s NOT NULL' % (name, 'SET' if current.notNull else 'DROP'))
+    if setGenerated:
+        # ALWAYS <-> BY DEFAULT keeps the sequence and its current value
+        if normalize(targetIdentity.group(1)) != normalize(currentIdentity.group(1)):
+            commands.append('ALTER COLUMN %s SET GENERATED %s' % (name, currentIdentity.group(1)))
+    elif target.identity != current.identity and current.identity is not None:
+        commands.append('ALTER COLUMN %s ADD %s' % (name, current.identity))
+    if target.storage != current.storage and current.storage is not None:
+        commands.append('ALTER COLUMN %s SET STORAGE %s' % (name, current.storage))
+    if target.compression != current.compression:
+        commands.append('ALTER COLUMN %s SET COMPRESSION %s' % (name, current.compression or 'default'))
+
+    # inline constraints become table constraints of the column
+    targetConstraints = dict((c.key, c) for c in target.constraints)
+    currentConstraints = dict((c.key, c) for c in current.constraints)
+    for key, constraint in targetConstraints.items():
+        if key not in currentConstraints and constraint.name is not None:
+            commands.append('DROP CONSTRAINT IF EXISTS ' + constraint.name)
+    for key, constraint in currentConstraints.items():
+        if key not in targetConstraints:
+            commands.append('ADD ' + columnConstraintToTable(name, constraint))
+    return commands
+
+
+def columnConstraintToTable(columnName, constraint):
+    sql = ''
+    if constraint.name is not None:
+        sql = 'CONSTRAINT %s ' % constraint.name
+    definition = constraint.definition
+    lower = definition.lower()
+    if lower.startswith('references'):
+        return sql + 'FOREIGN KEY (%s) %s' % (columnName, definition)
+    if lower.startswith('unique') or lower.startswith('primary'):
+        tokens = significant(tokenize(definition))
+        keywordEnd = 2 if lower.startswith('primary') else 1
+        # UNIQUE NULLS [NOT] DISTINCT
+        while keywordEnd < len(tokens) and tokens[keywordEnd].isWord('nulls', 'not', 'distinct'):
+            keywordEnd += 1
+        head = definition[:tokens[keywordEnd - 1].end]
+        tail = definition[tokens[keywordEnd - 1].end:]
+        return sql + '%s (%s)%s' % (head, columnName, tail)
+    return sql + definition
+
+
+def dropStatement(statement):
+    # the statement undoing an index, trigger, rule or constraint definition
+    # of a table file, None for anything else
+    tokens = significant(tokenize(statement))
+    words = [t.normalized() for t in tokens]
+    parser = TableParser(statement)
+    if len(words) < 3 or words[0] != 'create' and words[0] != 'alter':
+        return None
+    if words[0] == 'alter':
+        # ALTER TABLE [ONLY] name ADD CONSTRAINT cname ...
+        if words[1] != 'table' or 'add' not in words:
+            return None
+        add = words.index('add')
+        if add + 2 >= len(words) or words[add + 1] != 'constraint':
+            return None
+        nameStart = 3 if words[2] == 'only' else 2
+        return 'ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (
+            parser.text(tokens[nameStart:add]), tokens[add + 2].value)
+
+    i = 1
+    while i < len(words) and words[i] in ['unique', 'or', 'replace', 'constraint']:
+        i += 1
+    if i + 1 >= len(words) or words[i] not in ['index', 'trigger', 'rule']:
+        return None
+    kind = words[i]
+    i += 1
+    if kind == 'index' and words[i] == 'concurrently':
+        i += 1
+    if kind == 'index' and words[i] == 'if':
+        i += 3
+    nameEnd = i + 1
+    while nameEnd + 1 < len(tokens) and tokens[nameEnd].isPunctuation('.'):
+        nameEnd += 2
+    name = parser.text(tokens[i:nameEnd])
+    on = words.index('on', nameEnd) if 'on' in words[nameEnd:] else None
+    if on is None or on + 1 >= len(tokens):
+        return None
+    if kind == 'index':
+        # indexes live in the schema of their table
+        table = tokens[on + 1:]
+        if len(table) > 0 and table[0].isWord('only'):
+            table = table[1:]
+        if '.' not in name and len(table) > 2 and table[1].isPunctuation('.'):
+            name = table[0].value + '.' + name
+        return 'DROP INDEX IF EXISTS ' + name
+    if kind == 'rule':
+        # CREATE RULE name AS ON event TO table
+        if 'to' not in words[on:]:
+            return None
+        on = words.index('to', on)
+    end = on + 2
+    while end + 1 < len(tokens) and tokens[end].isPunctuation('.'):
+        end += 2
+    return 'DROP %s IF EXISTS %s ON %s' % (kind.upper(), name, parser.text(tokens[on + 1:end]))
+
+
+DIRECTIVE_REGEX = re.compile(r'^[ \t]*--[ \t]*git-db:(.*)$', re.MULTILINE)
+
+
+def parseDirectives(text):
+    # '-- git-db: key=value flag' comment lines in front of a statement of a
+    # patch file, returned as {'key': 'value', 'flag': True}
+    directives = {}
+    for match in DIRECTIVE_REGEX.finditer(text):
+        for item in match.group(1).split():
+            if '=' in item:
+                key, value = item.split('=', 1)
+                directives[key] = value
+            else:
+                directives[item] = True
+    return directives
+
+
+# directive marking patch statements that cannot run in a transaction block
+NO_TRANSACTION = 'no-transaction'
+
+
+def concurrentIndex(statement):
+    # CREATE [UNIQUE] INDEX ... as CREATE INDEX CONCURRENTLY, None when that's
+    # not possible (indexes of partitioned tables) or not an index at all
+    tokens = significant(tokenize(statement))
+    if len(tokens) < 4 or not tokens[0].isWord('create'):
+        return None
+    i = 2 if tokens[1].isWord('unique') else 1
+    if not tokens[i].isWord('index') or tokens[i + 1].isWord('concurrently'):
+        return None
+    for j in range(i + 1, len(tokens) - 1):
+        if tokens[j].isWord('on'):
+            if tokens[j + 1].isWord('only'):
+                return None
+            break
+    position = tokens[i].end
+    return statement[:position] + ' CONCURRENTLY' + statement[position:]
+
+
+def notValidConstraint(statement):
+    # ALTER TABLE t ADD CONSTRAINT c FOREIGN KEY/CHECK ... split into adding
+    # it NOT VALID and validating it, which doesn't block writes; None otherwise
+    tokens = significant(tokenize(statement))
+    words = [t.normalized() for t in tokens]
+    if len(words) < 6 or words[0] != 'alter' or words[1] != 'table' or 'add' not in words:
+        return None
+    add = words.index('add')
+    if add + 3 >= len(words) or words[add + 1] != 'constraint':
+        return None
+    if words[add + 3] not in ['foreign', 'check'] or words[-2:] == ['not', 'valid']:
+        return None
+    nameStart = 3 if words[2] == 'only' else 2
+    table = statement[tokens[nameStart].start:tokens[add - 1].end]
+    return [statement + ' NOT VALID',
+        'ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table, tokens[add + 2].value)]
+
+
+# longest identifier PostgreSQL keeps (NAMEDATALEN - 1)
+MAX_NAME_LENGTH = 63
+
+
+def quoteName(name):
+    if re.match(r'^[a-z_][a-z0-9_$]*$', name):
+        return name
+    return '"%s"' % name.replace('"', '""')
+
+
+def constraintName(tableName, columnNames, label):
+    # the name PostgreSQL chooses for an unnamed constraint (makeObjectName),
+    # with the longer part truncated first; when it's taken PostgreSQL adds a
+    # number to it, the explicitly named constraint fails to add instead
+    name2 = '_'.join(columnNames)[:MAX_NAME_LENGTH]
+    available = MAX_NAME_LENGTH - len(label) - 1 - (1 if len(name2) > 0 else 0)
+    length1, length2 = len(tableName), len(name2)
+    while length1 + length2 > available:
+        if length1 > length2:
+            length1 -= 1
+        else:
+            length2 -= 1
+    parts = [tableName[:length1]] + ([name2[:length2]] if len(name2) > 0 else []) + [label]
+    return quoteName('_'.join(parts))
+
+
+def nameConstraint(table, command):
+    # ADD FOREIGN KEY/CHECK ... with the name PostgreSQL would give it, so that
+    # it can be added NOT VALID and validated by name; None for anything else
+    tokens = significant(tokenize(command))
+    if len(tokens) < 4 or not tokens[0].isWord('add'):
+        return None
+    if tokens[1].isWord('foreign') and tokens[3].isPunctuation('('):
+        close = findClosing(tokens, 3)
+        columns = [unquote(t) for t in tokens[4:close] if t.type in [WORD, QUOTED]]
+        name = constraintName(table.name, columns, 'fkey')
+    elif tokens[1].isWord('check') and tokens[2].isPunctuation('('):
+        # named after the column it checks when there is only one
+        close = findClosing(tokens, 2)
+        columns = []
+        for i in range(3, close):
+            token = tokens[i]
+            if token.type not in [WORD, QUOTED] or unquote(token) not in table.columns \
+                    or tokens[i + 1].isPunctuation('(') or tokens[i - 1].isPunctuation('.'):
+                continue
+            if unquote(token) not in columns:
+                columns.append(unquote(token))
+        name = constraintName(table.name, columns if len(columns) == 1 else [], 'check')
+    else:
+        return None
+    return 'ADD CONSTRAINT %s %s' % (name, command[tokens[1].start:])
+
+
+def onlineAlterTable(table, commands):
+    # rewrites ALTER TABLE subcommands generated by alterTable() for the
+    # current table to take only brief locks; returns the subcommands and the
+    # statements to run after them
+    tableName = table.qualifiedName
+    online = []
+    followUps = []
+    for command in commands:
+        command = nameConstraint(table, command) or command
+        added = notValidConstraint('ALTER TABLE %s %s' % (tableName, command))
+        match = re.match(r'^ALTER COLUMN (.+) SET NOT NULL$', command)
+        if added is not None:
+            online.append(added[0][len('ALTER TABLE %s ' % tableName):])
+            followUps.append(added[1])
+        elif match is not None and 'ALTER COLUMN %s ADD GENERATED ' % match.group(1) \
+                not in ' '.join(commands):
+            # SET NOT NULL skips the table scan when a valid CHECK proves it;
+            # an identity added to the column needs it right away
+            column = match.group(1)
+            checkName = re.sub('[^a-z0-9_]+', '_',
+                (tableName.split('.')[-1] + '_' + column + '_not_null').replace('"', '').lower()).strip('_')[:63]
+            online.append('ADD CONSTRAINT %s CHECK (%s IS NOT NULL) NOT VALID' % (checkName, column))
+            followUps.append('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (tableName, checkName))
+            followUps.append('ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (tableName, column))
+            followUps.append('ALTER TABLE %s DROP CONSTRAINT %s' % (tableName, checkName))
+        else:
+            online.append(command)
+    return online, followUps
+
+
+def noTransactionDirective():
+    return '-- git-db: ' + NO_TRANSACTION + '\n'
+
+
+def diffTable(targetFile, currentFile, filePath, online=False, log=print):
+    # the statements turning the target version of a table file into the
+    # current one; diffcache.py keeps them keyed by the two files, so the
+    # generation of its entries has to change along with this code
+    tableName = filePath.split('/')[-3] + '.' + filePath.split('/')[-1].split('.')[0]
+
+    # split both files per-command, comments and quoting are handled by the tokenizer
+    try:
+        currentFileParts = splitStatements(currentFile)
+        targetFileParts = splitStatements(targetFile)
+    except SqlError as e:
+        log("[WARNING] Unable to parse '%s' (%s), adding the whole file" % (filePath, e))
+        return currentFile
+
+    return compareTableStructure(currentFileParts, targetFileParts, tableName, online, log)
+
+
+def compareTableStructure(currentFileParts, targetFileParts, tableName, online=False, log=print):
+    # with online set, the statements are rewritten to take only brief locks:
+    # indexes are created/dropped CONCURRENTLY (outside of a transaction),
+    # constraints are added NOT VALID and validated separately
+    # look for the "create table" part to compare first
+    createTableCurrent = None
+    createTableTarget  = None
+    # store everything that is not 'create table' in these dicts, keyed by
+    # a normalized form of the statement
+    remainingFilePartsCurrent = {}
+    remainingFilePartsTarget = {}
+
+    for el in currentFileParts:
+        table = parseCreateTable(el)
+        if table is not None and createTableCurrent is None:
+            createTableCurrent = table
+            createTableCurrentSql = el
+        else:
+            remainingFilePartsCurrent[normalize(el)] = el
+
+    for el in targetFileParts:
+        table = parseCreateTable(el)
+        if table is not None and createTableTarget is None:
+            createTableTarget = table
+        else:
+            remainingFilePartsTarget[normalize(el)] = el
+
+    sql = ''
+    # indexes, triggers and constraints that are gone or changed go first,
+    # so that their new versions can be created under the same name
+    for key, value in remainingFilePartsTarget.items():
+        if key not in remainingFilePartsCurrent:
+            drop = dropStatement(value)
+            if drop is not None and online and drop.startswith('DROP INDEX '):
+                drop = 'DROP INDEX CONCURRENTLY ' + drop[len('DROP INDEX '):]
+                sql += noTransactionDirective()
+            if drop is not None:
+                sql += drop + ';\n\n'
+
+    followUps = []
+    if createTableCurrent is not None and createTableTarget is not None:
+        commands = alterTable(createTableTarget, createTableCurrent)
+        if online:
+            for command in commands:
+                if command.startswith('ALTER COLUMN') and ' TYPE ' in command:
+                    log("[WARNING] '%s' rewrites table '%s' under an exclusive lock"
+                        % (command, tableName))
+            commands, followUps = onlineAlterTable(createTableCurrent, commands)
+        if len(commands) > 0:
+            sql += 'ALTER TABLE ' + createTableCurrent.qualifiedName + '\n\t'
+            sql += ',\n\t'.join(commands) + ';\n\n'
+    elif createTableCurrent is not None:
+        log("[WARNING] No CREATE TABLE for '%s' in the target, adding it" % tableName)
+        sql += createTableCurrentSql + ';\n\n'
+
+    # whatever remains in the local file and is not identical to the target file
+    # should be considered an alteration and added to patch
+    for key, value in remainingFilePartsCurrent.items():
+        if key != '' and key not in remainingFilePartsTarget:
+            if online and concurrentIndex(value) is not None:
+                sql += noTransactionDirective() + concurrentIndex(value) + ';\n\n'
+            elif online and notValidConstraint(value) is not None:
+                addConstraint, validate = notValidConstraint(value)
+                sql += addConstraint + ';\n\n'
+                followUps.append(validate)
+            else:
+                sql += value + ';\n\n'
+
+    # validation scans the table, but doesn't block writes
+    for statement in followUps:
+        sql += statement + ';\n\n'
+
+    return sql
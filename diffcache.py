@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import tracing
+
+# The ALTER statements 'patch create' generates for a changed table file only
+# depend on the two blobs, the table name and --online, so they are kept in
+# .git/ keyed by those and reused by later runs. Entries are grouped by the
+# generation of the code generating them, a digest of its source files: once
+# the diff logic changes, the whole previous generation is removed. The least
+# recently used entries are evicted when the cache grows over its size limit.
+
+CACHE_DIRECTORY = '.git/git-db/diff-cache'
+# bumped when the format of the entries changes
+FORMAT_VERSION = 1
+# files whose code produces the cached statements, see ddl.diffTable
+GENERATOR_FILES = ['ddl.py']
+MAX_SIZE = '64MB'
+# eviction removes entries until the cache is this much of its limit
+EVICTION_TARGET = 0.8
+
+SIZE_UNITS = {'': 1, 'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+
+
+def parseSize(value):
+    # bytes of a size written like 500kB, 64MB or 1GB, 0 disables the cache
+    match = re.match(r'^\s*(\d+)\s*([kmg]?b)?\s*$', str(value), re.IGNORECASE)
+    if match is None:
+        raise ValueError("invalid size '%s'" % value)
+    return int(match.group(1)) * SIZE_UNITS[(match.group(2) or '').lower()]
+
+
+def getGeneration():
+    digest = hashlib.sha1(b'%d\0' % FORMAT_VERSION)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in GENERATOR_FILES:
+        with open(os.path.join(directory, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class DiffCache:
+    def __init__(self, maxSize, directory=CACHE_DIRECTORY):
+        self.maxSize = maxSize
+        self.directory = directory
+        self.generation = None
+        self.written = False
+
+    def getPath(self, key):
+        if self.generation is None:
+            self.generation = getGeneration()
+        digest = hashlib.sha1(json.dumps(list(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, self.generation, digest[:2], digest[2:] + '.json')
+
+    def get(self, key):
+        # (sql, messages printed while generating it), None when not cached
+        path = self.getPath(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            # the modification time orders entries for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            tracing.count('diff_cache_misses')
+            return None
+        tracing.count('diff_cache_hits')
+        return entry['sql'], entry['messages']
+
+    def put(self, key, sql, messages):
+        path = self.getPath(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # written to a temporary file first, a concurrent run never
+            # reads half an entry
+            fd, temporaryPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'sql': sql, 'messages': messages}, f)
+            os.replace(temporaryPath, path)
+        except OSError as e:
+            print('[WARNING] unable to write the diff cache: %s' % e)
+            return
+        self.written = True
+
+    def evict(self):
+        # run once at the end of 'patch create', only when entries were added
+        if not self.written:
+            return
+        with tracing.span('evict diff cache'):
+            for name in os.listdir(self.directory):
+                if name != self.generation:
+                    shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            entries = []
+            for dirpath, dirnames, filenames in os.walk(os.path.join(self.directory, self.generation)):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        status = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((status.st_mtime, status.st_size, path))
+            total = sum(size for mtime, size, path in entries)
+            if total <= self.maxSize:
+                return
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.maxSize * EVICTION_TARGET:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
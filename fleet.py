@@ -0,0 +1,126 @@
+import fnmatch
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from time import time
+
+# Rolls a patch out to many remotes of the same schema: the canaries are
+# patched first, on their own, and the rollout only goes on when all of them
+# succeeded; the other servers are then patched up to 'parallel' at a time.
+# Once more servers failed than the threshold allows, no further server is
+# started, the ones already running finish and the rest are skipped.
+
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class ServerResult:
+    __slots__ = ('status', 'seconds', 'databases', 'error')
+
+    def __init__(self, status, seconds=0.0, databases=None, error=None):
+        self.status = status
+        self.seconds = seconds
+        # database name -> (ok, seconds), None for skipped databases, see
+        # Database.applyPatchFiles
+        self.databases = databases or {}
+        self.error = error
+
+
+def matchRemotes(remotes, patterns):
+    # remotes matching any of the comma separated names or glob patterns, in
+    # the order of the config
+    patterns = [p.strip() for p in patterns.split(',') if len(p.strip()) > 0]
+    return [r for r in remotes if any(fnmatch.fnmatchcase(r, p) for p in patterns)]
+
+
+def parseThreshold(value, total):
+    # number of failed servers tolerated: '2' or a share of the fleet, '10%'
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*(%)?\s*$', str(value))
+    if match is None:
+        raise ValueError("invalid failure threshold '%s'" % value)
+    if match.group(2) is None:
+        return int(float(match.group(1)))
+    return int(total * float(match.group(1)) / 100)
+
+
+class Rollout:
+    def __init__(self, servers, parallel=1, canaries=1, maxFailures=0):
+        self.servers = list(servers)
+        self.parallel = max(1, parallel)
+        self.canaries = min(max(0, canaries), len(self.servers))
+        self.maxFailures = maxFailures
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.stopped = threading.Event()
+
+    def run(self, apply, log=print):
+        # apply(server) -> ServerResult, called from worker threads; returns
+        # server -> ServerResult in the order of the servers
+        results = {}
+        canaries = self.servers[:self.canaries]
+        if len(canaries) > 0:
+            log('[INFO] canary: %s' % ', '.join(canaries))
+            self.runWave(canaries, apply, results)
+            if any(results[s].status != OK for s in canaries):
+                log('[ERROR] canary failed, the rollout is stopped')
+                self.stopped.set()
+        rest = self.servers[self.canaries:]
+        if len(rest) > 0 and not self.stopped.is_set():
+            log('[INFO] rolling out to %d servers, %d at a time' % (len(rest), self.parallel))
+            self.runWave(rest, apply, results)
+            if self.stopped.is_set():
+                log('[ERROR] %d servers failed, more than the %d allowed, the rollout is stopped'
+                    % (self.failures, self.maxFailures))
+        return dict((s, results.get(s, ServerResult(SKIPPED))) for s in self.servers)
+
+    def runWave(self, servers, apply, results):
+        pending = list(servers)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < self.parallel and not self.stopped.is_set():
+                    server = pending.pop(0)
+                    running[executor.submit(self.applyServer, apply, server)] = server
+                if len(running) == 0:
+                    break
+                done, notDone = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+
+    def applyServer(self, apply, server):
+        started = time()
+        try:
+            result = apply(server)
+        except SystemExit as e:
+            # commands exit on errors they already printed
+            result = ServerResult(FAILED, error='exited with status %s' % e.code)
+        except Exception as e:
+            result = ServerResult(FAILED, error=str(e).strip() or type(e).__name__)
+        result.seconds = time() - started
+        if result.status == FAILED:
+            with self.lock:
+                self.failures += 1
+                if self.failures > self.maxFailures:
+                    self.stopped.set()
+        return result
+
+
+def printReport(patchName, results, log=print):
+    log('\n======== Fleet summary of patch \'%s\' ========' % patchName)
+    counts = {OK: 0, FAILED: 0, SKIPPED: 0}
+    width = max([len(s) for s in results] + [10])
+    for server, result in results.items():
+        counts[result.status] += 1
+        if result.status == SKIPPED:
+            log('%-10s %s' % (result.status, server))
+            continue
+        failed = [db for db, r in result.databases.items() if r is not None and not r[0]]
+        applied = [db for db, r in result.databases.items() if r is not None and r[0]]
+        details = '%d databases applied' % len(applied)
+        if len(failed) > 0:
+            details += ', failed: ' + ', '.join(failed)
+        if result.error is not None:
+            details = result.error
+        log('%-10s %-*s %9.3fs  %s' % (result.status, width, server, result.seconds, details))
+    log('%d servers applied, %d failed, %d skipped' % (counts[OK], counts[FAILED], counts[SKIPPED]))
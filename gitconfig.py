@@ -0,0 +1,90 @@
+import re
+import subprocess
+
+import tracing
+
+# The git config of the repository, read with a single 'git config --list' the
+# first time a value is needed and kept for the rest of the process. Sections
+# are named as in GitPython ('git-db', 'branch "dev"'), values are strings.
+# setValue() changes the snapshot right away, the changes reach the config
+# file when write() is called.
+
+SECTION_REGEX = re.compile(r'^([^ "]+)(?: "(.*)")?$')
+
+
+class ConfigSnapshot:
+    def __init__(self):
+        # (section, subsection, option) -> value, None until loaded
+        self.values = None
+        self.changes = []
+
+    def load(self):
+        if self.values is not None:
+            return
+        tracing.count('subprocesses')
+        with tracing.span('git config'):
+            output = subprocess.run(['git', 'config', '--list', '-z'],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8')
+        self.values = {}
+        # '<name>\n<value>\0' per variable, later ones override earlier ones
+        for item in output.split('\0'):
+            if len(item) == 0:
+                continue
+            name, newline, value = item.partition('\n')
+            self.values[parseName(name)] = value if newline else 'true'
+
+    def getValue(self, sectionName, option, default=None):
+        self.load()
+        return self.values.get(getKey(sectionName, option), default)
+
+    def hasSection(self, sectionName):
+        self.load()
+        section, subsection = parseSection(sectionName)
+        return any(key[0] == section and key[1] == subsection for key in self.values)
+
+    def hasOption(self, sectionName, option):
+        self.load()
+        return getKey(sectionName, option) in self.values
+
+    def getSubsections(self, section):
+        # names of the '[<section> "<name>"]' sections, in the order of the config
+        self.load()
+        names = []
+        for key in self.values:
+            if key[0] == section.lower() and key[1] is not None and key[1] not in names:
+                names.append(key[1])
+        return names
+
+    def setValue(self, sectionName, option, value):
+        self.load()
+        key = getKey(sectionName, option)
+        self.values[key] = str(value)
+        self.changes.append((key, str(value)))
+
+    def write(self):
+        # writes the changes made since the last write to the repository config
+        for key, value in self.changes:
+            section, subsection, option = key
+            name = '.'.join(part for part in [section, subsection, option] if part is not None)
+            tracing.count('subprocesses')
+            subprocess.check_call(['git', 'config', '--local', name, value])
+        self.changes = []
+
+
+def parseName(name):
+    # section and option names are case-insensitive, subsections are not
+    section, dot, rest = name.partition('.')
+    subsection, dot, option = rest.rpartition('.')
+    return (section.lower(), subsection if dot else None, option.lower())
+
+
+def parseSection(sectionName):
+    match = SECTION_REGEX.match(sectionName)
+    if match is None:
+        return (sectionName.lower(), None)
+    return (match.group(1).lower(), match.group(2))
+
+
+def getKey(sectionName, option):
+    section, subsection = parseSection(sectionName)
+    return (section, subsection, option.lower())
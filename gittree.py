@@ -0,0 +1,166 @@
+import binascii
+import hashlib
+import threading
+from io import BytesIO
+
+import lazy
+import tracing
+
+git = lazy.load('git')
+gitdb = lazy.load('gitdb')
+
+# Builds the tree of a commit straight in the object database, starting from
+# the tree of an existing commit: files are stored as blobs, only directories
+# with a changed file get a new tree object and everything else keeps its
+# object id. Used by 'database pull --no-checkout', which never touches the
+# working tree, the index or HEAD.
+
+BLOB_MODE = '100644'
+TREE_MODE = '40000'
+
+
+class TreeBuilder:
+    def __init__(self, repo, commit=None):
+        self.repo = repo
+        self.commit = commit
+        self.lock = threading.Lock()
+        # directory ('' for the root) -> {name: [mode, hex object id]}, the id
+        # of a changed directory is computed by writeTree()
+        self.directories = {'': {}}
+        self.dirty = set()
+        self.baseTree = None
+        if commit is not None:
+            self.baseTree = commit.tree.hexsha
+            with tracing.span('read tree', commit=commit.hexsha):
+                self.readTree(commit)
+
+    def readTree(self, commit):
+        output = self.repo.git.ls_tree('-r', '-t', '-z', '--full-tree', commit.hexsha)
+        for line in output.split('\0'):
+            if len(line) == 0:
+                continue
+            info, path = line.split('\t', 1)
+            mode, kind, objectId = info.split(' ')
+            directory, name = splitPath(path)
+            self.directories.setdefault(directory, {})[name] = [mode.lstrip('0'), objectId]
+            if kind == 'tree':
+                self.directories.setdefault(path, {})
+
+    def getEntry(self, path):
+        directory, name = splitPath(path)
+        entries = self.directories.get(directory)
+        if entries is None:
+            return None
+        return entries.get(name)
+
+    def exists(self, path):
+        with self.lock:
+            return path.rstrip('/') in self.directories or self.getEntry(path) is not None
+
+    def isUnchanged(self, path, content):
+        with self.lock:
+            entry = self.getEntry(path)
+        return entry is not None and entry[1] == getBlobId(content.encode('utf-8'))
+
+    def read(self, path):
+        # content of a file, None when there is no such file
+        with self.lock:
+            entry = self.getEntry(path)
+        if entry is None or entry[0] == TREE_MODE:
+            return None
+        return self.repo.odb.stream(binascii.unhexlify(entry[1])).read().decode('utf-8')
+
+    def write(self, path, content):
+        # returns False when the file already has this content
+        data = content.encode('utf-8')
+        objectId = getBlobId(data)
+        with self.lock:
+            entry = self.getEntry(path)
+            if entry is not None and entry[1] == objectId:
+                return False
+        if not self.repo.odb.has_object(binascii.unhexlify(objectId)):
+            self.repo.odb.store(gitdb.IStream('blob', len(data), BytesIO(data)))
+        with self.lock:
+            directory, name = splitPath(path)
+            self.addDirectory(directory)
+            self.directories[directory][name] = [BLOB_MODE, objectId]
+            self.setDirty(directory)
+        return True
+
+    def remove(self, path):
+        with self.lock:
+            directory, name = splitPath(path)
+            entries = self.directories.get(directory)
+            if entries is not None and name in entries:
+                del entries[name]
+                self.setDirty(directory)
+
+    def paths(self):
+        # every file of the tree
+        with self.lock:
+            return [joinPath(directory, name) for directory, entries in self.directories.items()
+                for name, (mode, objectId) in entries.items() if mode != TREE_MODE]
+
+    def addDirectory(self, directory):
+        if directory in self.directories:
+            return
+        self.directories[directory] = {}
+        parent, name = splitPath(directory)
+        self.addDirectory(parent)
+        self.directories[parent][name] = [TREE_MODE, None]
+
+    def setDirty(self, directory):
+        while True:
+            self.dirty.add(directory)
+            if directory == '':
+                return
+            directory = splitPath(directory)[0]
+
+    def writeTree(self, directory=''):
+        # id of the tree of a directory, None when it has no files
+        entries = []
+        for name, (mode, objectId) in self.directories[directory].items():
+            if mode == TREE_MODE:
+                path = joinPath(directory, name)
+                if path in self.dirty:
+                    objectId = self.writeTree(path)
+                if objectId is None:
+                    continue
+            entries.append((mode, name.encode('utf-8'), objectId))
+        if len(entries) == 0 and directory != '':
+            return None
+        # git orders directories as if their name ended with '/'
+        entries.sort(key=lambda e: e[1] + b'/' if e[0] == TREE_MODE else e[1])
+        data = b''.join(mode.encode('ascii') + b' ' + name + b'\0' + binascii.unhexlify(objectId)
+            for mode, name, objectId in entries)
+        istream = self.repo.odb.store(gitdb.IStream('tree', len(data), BytesIO(data)))
+        tracing.count('trees_written')
+        return binascii.hexlify(istream.binsha).decode('ascii')
+
+    def commitTo(self, branch, message):
+        # commits the tree to the branch without checking it out, None when
+        # nothing changed
+        with self.lock:
+            treeId = self.writeTree() if '' in self.dirty else self.baseTree
+        if treeId is None or treeId == self.baseTree:
+            return None
+        parents = [self.commit] if self.commit is not None else []
+        commit = git.Commit.create_from_tree(self.repo, git.Tree(self.repo,
+            binascii.unhexlify(treeId)), message, parent_commits=parents, head=False)
+        previous = self.commit.hexsha if self.commit is not None else '0' * 40
+        self.repo.git.update_ref('-m', message, 'refs/heads/' + branch, commit.hexsha, previous)
+        return commit
+
+
+def getBlobId(data):
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def splitPath(path):
+    if '/' not in path:
+        return '', path
+    return tuple(path.rsplit('/', 1))
+
+
+def joinPath(directory, name):
+    return directory + '/' + name if directory != '' else name
@@ -0,0 +1,29 @@
+import importlib.util
+import sys
+
+# Modules imported on the first access to one of their attributes, so that a
+# command only pays for importing psycopg2 or GitPython when it uses them.
+# Only for top level modules: finding the spec of a submodule imports its
+# package.
+
+
+def load(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named '%s'" % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def resolve(*modules):
+    # imports the modules right away; the lazy loader of Python < 3.12 is not
+    # thread-safe, so modules first used by worker threads are resolved before
+    # the threads start
+    for module in modules:
+        getattr(module, '__file__', None)
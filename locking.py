@@ -0,0 +1,133 @@
+import random
+import re
+from time import time, sleep
+
+import lazy
+
+psycopg2 = lazy.load('psycopg2')
+
+# Runs patch statements with lock_timeout/statement_timeout set, so that DDL
+# waiting for a lock behind a long running transaction gives up instead of
+# blocking every other query on the table, and retries it with a jittered
+# exponential backoff until a deadline.
+
+LOCK_NOT_AVAILABLE = '55P03'
+
+# object types statements can be given their own timeouts for, see objectType()
+OBJECT_TYPES = ['table', 'index', 'view', 'function', 'procedure', 'trigger',
+    'sequence', 'type', 'schema']
+
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'min': 60, 'h': 3600, 'd': 86400}
+
+
+def parseDuration(value):
+    # seconds of a duration written like the PostgreSQL settings: 500ms, 5s, 10min, 1h
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*(ms|s|min|h|d)?\s*$', str(value))
+    if match is None:
+        raise ValueError("invalid duration '%s'" % value)
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+class LockStats:
+    __slots__ = ('attempts', 'retries', 'lockWait', 'backoff')
+
+    def __init__(self):
+        self.attempts = 0
+        self.retries = 0
+        # time spent in attempts that ended with a lock timeout
+        self.lockWait = 0.0
+        # time spent sleeping between attempts
+        self.backoff = 0.0
+
+
+class LockPolicy:
+    def __init__(self, lockTimeout='', statementTimeout='', deadline='5min',
+            objectTimeouts=None, baseDelay=0.5, maxDelay=30):
+        self.lockTimeout = lockTimeout
+        self.statementTimeout = statementTimeout
+        self.deadline = parseDuration(deadline)
+        # object type -> {'lock_timeout': ..., 'statement_timeout': ...}
+        self.objectTimeouts = objectTimeouts or {}
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+    def timeoutsFor(self, statement=None, directives=None):
+        # a '-- git-db: lock_timeout=...' directive wins over the object type
+        # settings, which win over the defaults
+        timeouts = {'lock_timeout': self.lockTimeout, 'statement_timeout': self.statementTimeout}
+        if statement is not None:
+            for key, value in self.objectTimeouts.get(objectType(statement), {}).items():
+                if value:
+                    timeouts[key] = value
+        for key in timeouts:
+            if directives is not None and directives.get(key):
+                timeouts[key] = directives[key]
+        return timeouts
+
+    def execute(self, connection, work, stats, statement=None, directives=None, log=print,
+            transaction=True):
+        # runs work(cursor) in a transaction and commits it; a lock timeout rolls
+        # the transaction back and retries it until the deadline passes, any
+        # other error is raised after the rollback. Without a transaction
+        # (CREATE INDEX CONCURRENTLY...) the timeouts are set for the session.
+        timeouts = self.timeoutsFor(statement, directives)
+        started = time()
+        retry = 0
+        while True:
+            cursor = connection.cursor()
+            attemptStarted = time()
+            stats.attempts += 1
+            try:
+                connection.autocommit = not transaction
+                for key, value in timeouts.items():
+                    if value:
+                        cursor.execute('SELECT pg_catalog.set_config(%s, %s, %s)',
+                            (key, str(value), transaction))
+                work(cursor)
+                if transaction:
+                    connection.commit()
+                return
+            except psycopg2.Error as e:
+                connection.rollback()
+                if e.pgcode != LOCK_NOT_AVAILABLE:
+                    raise
+                stats.lockWait += time() - attemptStarted
+                delay = self.getDelay(retry)
+                if time() + delay - started > self.deadline:
+                    log('[ERROR] Lock not acquired within the retry deadline of %.0fs' % self.deadline)
+                    raise
+                retry += 1
+                stats.retries += 1
+                log('[WARNING] Lock not available (lock_timeout=%s), retry %d in %.1fs'
+                    % (timeouts['lock_timeout'], retry, delay))
+                sleep(delay)
+                stats.backoff += delay
+            finally:
+                if not transaction:
+                    for key, value in timeouts.items():
+                        if value:
+                            cursor.execute('RESET ' + key)
+                    connection.autocommit = False
+
+    def getDelay(self, retry):
+        # exponential backoff with jitter, so that retries of concurrent
+        # appliers don't line up behind the same transaction
+        delay = min(self.maxDelay, self.baseDelay * (2 ** retry))
+        return random.uniform(delay / 2, delay)
+
+
+def objectType(statement):
+    # the kind of object a DDL statement works on: 'table', 'index', ... or None
+    words = re.findall(r'[A-Za-z_]+', statement[:200].lower())
+    if len(words) < 2 or words[0] not in ['create', 'alter', 'drop', 'comment']:
+        return None
+    for word in words[1:]:
+        if word in ['or', 'replace', 'unique', 'temporary', 'temp', 'unlogged', 'materialized',
+                'concurrently', 'if', 'not', 'exists', 'on', 'global', 'local']:
+            continue
+        if word == 'constraint':
+            return 'trigger'
+        if word in OBJECT_TYPES:
+            return word
+        return None
+    return None
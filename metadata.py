@@ -0,0 +1,136 @@
+import lazy
+
+psycopg2 = lazy.load('psycopg2')
+
+# The git_db schema git-db keeps in every database to track patches and query
+# files. Its version is stored in git_db.schema_version; migrate() brings an
+# installation of any older version (including the unversioned tables of
+# git-db releases before the version table existed) up to date.
+
+SCHEMA_VERSION_TABLE = '''CREATE TABLE IF NOT EXISTS git_db.schema_version (
+    version INT PRIMARY KEY,
+    description VARCHAR(256) NOT NULL,
+    applied_timestamp timestamp DEFAULT CURRENT_TIMESTAMP
+);'''
+
+# (version, description, sql); pending migrations run in one transaction
+# together with the rows recording them. Never change a released migration,
+# add a new one instead.
+MIGRATIONS = [
+    (1, 'query and patch tables', '''
+        CREATE TABLE IF NOT EXISTS git_db.query (
+            id SERIAL NOT NULL,
+            name VARCHAR(128) NOT NULL,
+            namespace VARCHAR(128) NOT NULL,
+            path VARCHAR(256) NOT NULL,
+            timestamp timestamp DEFAULT CURRENT_TIMESTAMP,
+            applied BOOLEAN DEFAULT FALSE,
+            applied_timestamp timestamp,
+            applied_patch_id INT
+        );
+
+        CREATE TABLE IF NOT EXISTS git_db.patch (
+            id SERIAL NOT NULL,
+            name VARCHAR(128) NOT NULL,
+            timestamp timestamp DEFAULT CURRENT_TIMESTAMP,
+            applied BOOLEAN DEFAULT FALSE,
+            applied_timestamp timestamp
+        );'''),
+    (2, 'statement checkpoints of patch apply --statements', '''
+        CREATE TABLE IF NOT EXISTS git_db.patch_statement (
+            patch_name VARCHAR(128) NOT NULL,
+            checksum CHAR(32) NOT NULL,
+            statement_start INT NOT NULL,
+            statement_end INT NOT NULL,
+            duration DOUBLE PRECISION,
+            applied_timestamp timestamp DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (patch_name, statement_start)
+        );'''),
+    (3, 'keys and indexes of query and patch', '''
+        -- patches registered twice by concurrent runs are merged into the first one
+        UPDATE git_db.patch k
+        SET applied = TRUE, applied_timestamp = COALESCE(k.applied_timestamp, p.applied_timestamp)
+        FROM git_db.patch p
+        WHERE p.name = k.name AND p.id > k.id AND p.applied AND NOT k.applied;
+
+        UPDATE git_db.query q
+        SET applied_patch_id = d.keep
+        FROM (SELECT id, min(id) OVER (PARTITION BY name) AS keep FROM git_db.patch) d
+        WHERE q.applied_patch_id = d.id AND d.id <> d.keep;
+
+        DELETE FROM git_db.patch p
+        USING git_db.patch k
+        WHERE p.name = k.name AND p.id > k.id;
+
+        ALTER TABLE git_db.patch
+            ADD CONSTRAINT patch_pkey PRIMARY KEY (id),
+            ADD CONSTRAINT patch_name_key UNIQUE (name);
+
+        ALTER TABLE git_db.query
+            ADD CONSTRAINT query_pkey PRIMARY KEY (id);
+
+        CREATE INDEX query_applied_patch_id_idx ON git_db.query (applied_patch_id);
+        CREATE INDEX query_pending_idx ON git_db.query (timestamp) WHERE NOT applied;
+        CREATE INDEX query_path_idx ON git_db.query (path);'''),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# serializes migrations of concurrent git-db runs on the same database
+MIGRATION_LOCK = 0x67697464
+
+
+def getVersion(cursor):
+    # 0 when there is no git_db schema at all, 1 for the unversioned tables
+    cursor.execute("SELECT pg_catalog.to_regclass('git_db.schema_version') IS NOT NULL, "
+        "pg_catalog.to_regclass('git_db.patch') IS NOT NULL")
+    hasVersionTable, hasTables = cursor.fetchone()
+    if not hasVersionTable:
+        return 1 if hasTables else 0
+    cursor.execute('SELECT COALESCE(max(version), 0) FROM git_db.schema_version')
+    return cursor.fetchone()[0]
+
+
+def migrate(connection, log=print):
+    # runs the pending migrations in a transaction of its own and returns the
+    # versions applied, raises psycopg2.Error when a migration fails; the
+    # connection must not be in a transaction, its autocommit setting is
+    # restored afterwards
+    if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        raise psycopg2.ProgrammingError('the git_db schema cannot be migrated inside a transaction')
+    autocommit = connection.autocommit
+    connection.autocommit = False
+    applied = []
+    try:
+        cursor = connection.cursor()
+        if getVersion(cursor) < LATEST_VERSION:
+            applied = upgrade(cursor, log)
+        connection.commit()
+        return applied
+    except psycopg2.Error:
+        connection.rollback()
+        raise
+    finally:
+        connection.autocommit = autocommit
+
+
+def upgrade(cursor, log):
+    cursor.execute('SELECT pg_catalog.pg_advisory_xact_lock(%s)', (MIGRATION_LOCK,))
+    cursor.execute('CREATE SCHEMA IF NOT EXISTS git_db')
+    # the version is read again under the lock, another run might have migrated
+    version = getVersion(cursor)
+    cursor.execute(SCHEMA_VERSION_TABLE)
+    applied = []
+    for migrationVersion, description, sql in MIGRATIONS:
+        if migrationVersion <= version:
+            continue
+        log('[INFO] upgrading git_db schema to version %d: %s' % (migrationVersion, description))
+        cursor.execute(sql)
+        cursor.execute('INSERT INTO git_db.schema_version (version, description) VALUES (%s, %s)',
+            (migrationVersion, description))
+        applied.append(migrationVersion)
+    if version == 1:
+        # unversioned tables of older releases
+        cursor.execute('''INSERT INTO git_db.schema_version (version, description)
+            VALUES (1, %s) ON CONFLICT DO NOTHING''', (MIGRATIONS[0][1],))
+    return applied
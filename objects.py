@@ -0,0 +1,437 @@
+import heapq
+import re
+
+import tracing
+from catalog import SCHEMA_FILTER, SEQUENCE_LIMITS, quoteLiteral, renderEntry
+
+# Views, materialized views, functions, sequences and types of a whole
+# database, read with one batched catalog query per kind and rendered into
+# structure/<schema>/<kind>/<name>.sql files as pg_dump style entries. Indexes
+# of materialized views are kept in their file, triggers and the sequences
+# owned by a column stay in the file of their table, as in pg_dump --table.
+# Also reads pg_depend to order the statements of a patch, see order().
+
+TABLES = 'tables'
+VIEWS = 'views'
+MATERIALIZED_VIEWS = 'materialized_views'
+FUNCTIONS = 'functions'
+SEQUENCES = 'sequences'
+TYPES = 'types'
+
+# every kind of structure directory, in the order objects are created when
+# nothing else decides it
+KINDS = [TYPES, SEQUENCES, FUNCTIONS, TABLES, VIEWS, MATERIALIZED_VIEWS]
+
+# kinds a patch can drop and create again when an object they use changes
+REBUILDABLE = [VIEWS, MATERIALIZED_VIEWS]
+
+# objects of extensions and objects created along with another one, like the
+# constructor functions of a range type, are not pulled on their own
+NOT_EXTENSION_MEMBER = '''NOT EXISTS (SELECT 1 FROM pg_catalog.pg_depend e
+    WHERE e.classid = %s::pg_catalog.regclass AND e.objid = %s AND e.deptype IN ('e', 'i'))'''
+
+VIEWS_QUERY = '''SELECT n.nspname, c.relname, c.relkind,
+        pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(c.relname),
+        pg_catalog.pg_get_viewdef(c.oid), c.reloptions, r.rolname, pg_catalog.quote_ident(r.rolname),
+        pg_catalog.obj_description(c.oid, 'pg_class'),
+        (SELECT pg_catalog.array_agg(ARRAY[ic.relname, pg_catalog.pg_get_indexdef(i.indexrelid)]
+                ORDER BY ic.relname)
+            FROM pg_catalog.pg_index i
+            JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+            WHERE i.indrelid = c.oid)
+    FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_catalog.pg_roles r ON r.oid = c.relowner
+    WHERE c.relkind IN ('v', 'm') AND ''' + SCHEMA_FILTER + '''
+        AND ''' + NOT_EXTENSION_MEMBER % ("'pg_catalog.pg_class'", 'c.oid') + '''
+    ORDER BY n.nspname, c.relname'''
+
+FUNCTIONS_QUERY = '''SELECT n.nspname, p.proname, p.prokind,
+        pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(p.proname)
+            || '(' || pg_catalog.pg_get_function_identity_arguments(p.oid) || ')',
+        p.proname || '(' || pg_catalog.pg_get_function_identity_arguments(p.oid) || ')',
+        pg_catalog.pg_get_functiondef(p.oid), r.rolname, pg_catalog.quote_ident(r.rolname),
+        pg_catalog.obj_description(p.oid, 'pg_proc')
+    FROM pg_catalog.pg_proc p
+    JOIN pg_catalog.pg_namespace n ON n.oid = p.pronamespace
+    JOIN pg_catalog.pg_roles r ON r.oid = p.proowner
+    WHERE p.prokind IN ('f', 'p') AND ''' + SCHEMA_FILTER + '''
+        AND ''' + NOT_EXTENSION_MEMBER % ("'pg_catalog.pg_proc'", 'p.oid') + '''
+    ORDER BY n.nspname, p.proname, 5'''
+
+# sequences that aren't owned by a column, those are part of the table file
+SEQUENCES_QUERY = '''SELECT n.nspname, s.relname,
+        pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(s.relname),
+        pg_catalog.format_type(q.seqtypid, NULL),
+        q.seqstart, q.seqincrement, q.seqmin, q.seqmax, q.seqcache, q.seqcycle,
+        r.rolname, pg_catalog.quote_ident(r.rolname), pg_catalog.obj_description(s.oid, 'pg_class')
+    FROM pg_catalog.pg_class s
+    JOIN pg_catalog.pg_namespace n ON n.oid = s.relnamespace
+    JOIN pg_catalog.pg_roles r ON r.oid = s.relowner
+    JOIN pg_catalog.pg_sequence q ON q.seqrelid = s.oid
+    WHERE s.relkind = 'S' AND ''' + SCHEMA_FILTER + '''
+        AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_depend d
+            WHERE d.classid = 'pg_catalog.pg_class'::pg_catalog.regclass AND d.objid = s.oid
+            AND d.refclassid = 'pg_catalog.pg_class'::pg_catalog.regclass
+            AND d.deptype IN ('a', 'i', 'e'))
+    ORDER BY n.nspname, s.relname'''
+
+TYPES_QUERY = '''SELECT n.nspname, t.typname, t.typtype,
+        pg_catalog.quote_ident(n.nspname) || '.' || pg_catalog.quote_ident(t.typname),
+        r.rolname, pg_catalog.quote_ident(r.rolname), pg_catalog.obj_description(t.oid, 'pg_type'),
+        (SELECT pg_catalog.array_agg(pg_catalog.quote_literal(e.enumlabel) ORDER BY e.enumsortorder)
+            FROM pg_catalog.pg_enum e WHERE e.enumtypid = t.oid),
+        (SELECT pg_catalog.array_agg(pg_catalog.quote_ident(a.attname) || ' '
+                || pg_catalog.format_type(a.atttypid, a.atttypmod)
+                || CASE WHEN a.attcollation <> at.typcollation THEN ' COLLATE '
+                    || pg_catalog.quote_ident(cn.nspname) || '.' || pg_catalog.quote_ident(co.collname)
+                    ELSE '' END ORDER BY a.attnum)
+            FROM pg_catalog.pg_attribute a
+            JOIN pg_catalog.pg_type at ON at.oid = a.atttypid
+            LEFT JOIN pg_catalog.pg_collation co ON co.oid = a.attcollation
+            LEFT JOIN pg_catalog.pg_namespace cn ON cn.oid = co.collnamespace
+            WHERE a.attrelid = t.typrelid AND a.attnum > 0 AND NOT a.attisdropped),
+        pg_catalog.format_type(t.typbasetype, t.typtypmod), t.typnotnull, t.typdefault,
+        (SELECT pg_catalog.array_agg('CONSTRAINT ' || pg_catalog.quote_ident(c.conname) || ' '
+                || pg_catalog.pg_get_constraintdef(c.oid) ORDER BY c.conname)
+            FROM pg_catalog.pg_constraint c WHERE c.contypid = t.oid AND c.contype = 'c'),
+        pg_catalog.format_type(g.rngsubtype, NULL),
+        CASE WHEN g.rngsubdiff <> 0 THEN g.rngsubdiff::pg_catalog.regproc::pg_catalog.text END,
+        CASE WHEN g.rngcanonical <> 0 THEN g.rngcanonical::pg_catalog.regproc::pg_catalog.text END
+    FROM pg_catalog.pg_type t
+    JOIN pg_catalog.pg_namespace n ON n.oid = t.typnamespace
+    JOIN pg_catalog.pg_roles r ON r.oid = t.typowner
+    LEFT JOIN pg_catalog.pg_range g ON g.rngtypid = t.oid
+    WHERE (t.typtype IN ('e', 'd', 'r') OR t.typtype = 'c' AND EXISTS (SELECT 1
+            FROM pg_catalog.pg_class c WHERE c.oid = t.typrelid AND c.relkind = 'c'))
+        AND ''' + SCHEMA_FILTER + '''
+        AND ''' + NOT_EXTENSION_MEMBER % ("'pg_catalog.pg_type'", 't.oid') + '''
+    ORDER BY n.nspname, t.typname'''
+
+# the file (schema, kind, name) every object of a database is written to,
+# objects without a file of their own belong to the file of their parent
+OBJECT_FILES = '''WITH files AS (
+        SELECT 'pg_catalog.pg_class'::pg_catalog.regclass AS classid, c.oid AS objid,
+            n.nspname, CASE c.relkind WHEN 'v' THEN 'views' WHEN 'm' THEN 'materialized_views'
+                WHEN 'S' THEN 'sequences' WHEN 'c' THEN 'types' ELSE 'tables' END AS kind,
+            c.relname AS name
+        FROM pg_catalog.pg_class c
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p', 'f', 'v', 'm', 'S', 'c') AND ''' + SCHEMA_FILTER + '''
+        UNION ALL
+        SELECT 'pg_catalog.pg_proc'::pg_catalog.regclass, p.oid, n.nspname, 'functions', p.proname
+        FROM pg_catalog.pg_proc p
+        JOIN pg_catalog.pg_namespace n ON n.oid = p.pronamespace
+        WHERE ''' + SCHEMA_FILTER + '''
+        UNION ALL
+        SELECT 'pg_catalog.pg_type'::pg_catalog.regclass, t.oid, n.nspname, 'types', t.typname
+        FROM pg_catalog.pg_type t
+        JOIN pg_catalog.pg_namespace n ON n.oid = t.typnamespace
+        WHERE t.typtype IN ('e', 'd', 'r', 'c') AND t.typelem = 0 AND ''' + SCHEMA_FILTER + '''
+    ), members AS (
+        SELECT * FROM files
+        UNION ALL
+        SELECT 'pg_catalog.pg_rewrite'::pg_catalog.regclass, w.oid, f.nspname, f.kind, f.name
+        FROM pg_catalog.pg_rewrite w JOIN files f ON f.objid = w.ev_class
+            AND f.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+        UNION ALL
+        SELECT 'pg_catalog.pg_attrdef'::pg_catalog.regclass, d.oid, f.nspname, f.kind, f.name
+        FROM pg_catalog.pg_attrdef d JOIN files f ON f.objid = d.adrelid
+            AND f.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+        UNION ALL
+        SELECT 'pg_catalog.pg_constraint'::pg_catalog.regclass, co.oid, f.nspname, f.kind, f.name
+        FROM pg_catalog.pg_constraint co JOIN files f
+            ON f.objid = co.conrelid AND f.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+            OR f.objid = co.contypid AND f.classid = 'pg_catalog.pg_type'::pg_catalog.regclass
+        UNION ALL
+        SELECT 'pg_catalog.pg_trigger'::pg_catalog.regclass, t.oid, f.nspname, f.kind, f.name
+        FROM pg_catalog.pg_trigger t JOIN files f ON f.objid = t.tgrelid
+            AND f.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+        UNION ALL
+        SELECT 'pg_catalog.pg_class'::pg_catalog.regclass, i.indexrelid, f.nspname, f.kind, f.name
+        FROM pg_catalog.pg_index i JOIN files f ON f.objid = i.indrelid
+            AND f.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+        UNION ALL
+        SELECT 'pg_catalog.pg_type'::pg_catalog.regclass, t.oid, f.nspname, f.kind, f.name
+        FROM pg_catalog.pg_type t JOIN files f
+            ON f.objid = t.typrelid AND f.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+            OR f.objid = t.typelem AND f.classid = 'pg_catalog.pg_type'::pg_catalog.regclass
+    )'''
+
+# (dependent file, referenced file) pairs of the database
+DEPENDENCIES_QUERY = OBJECT_FILES + '''
+    SELECT DISTINCT o.nspname, o.kind, o.name, r.nspname, r.kind, r.name
+    FROM pg_catalog.pg_depend d
+    JOIN members o ON o.classid = d.classid AND o.objid = d.objid
+    JOIN members r ON r.classid = d.refclassid AND r.objid = d.refobjid
+    WHERE d.deptype IN ('n', 'a')
+        AND (o.nspname, o.kind, o.name) <> (r.nspname, r.kind, r.name)'''
+
+# sequences owned by a column live in the file of their table
+OWNED_SEQUENCES_QUERY = '''SELECT n.nspname, s.relname, tn.nspname, t.relname
+    FROM pg_catalog.pg_depend d
+    JOIN pg_catalog.pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+    JOIN pg_catalog.pg_namespace n ON n.oid = s.relnamespace
+    JOIN pg_catalog.pg_class t ON t.oid = d.refobjid
+    JOIN pg_catalog.pg_namespace tn ON tn.oid = t.relnamespace
+    WHERE d.classid = 'pg_catalog.pg_class'::pg_catalog.regclass
+        AND d.refclassid = 'pg_catalog.pg_class'::pg_catalog.regclass
+        AND d.deptype IN ('a', 'i')'''
+
+OWNER_REGEX = re.compile(r'^ALTER (FUNCTION|PROCEDURE|VIEW|MATERIALIZED VIEW|SEQUENCE|TYPE|DOMAIN) '
+    r'(.+) OWNER TO .*;$', re.MULTILINE)
+
+QUALIFIED_NAME_REGEX = re.compile(
+    r'("(?:[^"]|"")+"|[A-Za-z_][A-Za-z0-9_$]*)\s*\.\s*("(?:[^"]|"")+"|[A-Za-z_][A-Za-z0-9_$]*)')
+
+
+class ObjectCatalog:
+    def __init__(self, connection):
+        self.connection = connection
+        # schema -> [(kind, file name, content)]
+        self.files = {}
+        self.serverVersion = 0
+
+    def isSupportedServer(self):
+        # same requirement as the table catalog, see Catalog.isSupportedServer
+        return self.serverVersion >= 120000
+
+    def load(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT pg_catalog.current_setting('server_version_num')::int")
+        self.serverVersion = cursor.fetchone()[0]
+        if not self.isSupportedServer():
+            return
+
+        # the definitions are schema qualified with an empty search path
+        cursor.execute('SHOW search_path')
+        searchPath = cursor.fetchone()[0]
+        cursor.execute("SELECT pg_catalog.set_config('search_path', '', false)")
+        try:
+            for load in [self.loadViews, self.loadFunctions, self.loadSequences, self.loadTypes]:
+                with tracing.span('catalog ' + load.__name__):
+                    load(cursor)
+        finally:
+            cursor.execute("SELECT pg_catalog.set_config('search_path', %s, false)",
+                (searchPath,))
+            if not self.connection.autocommit:
+                self.connection.commit()
+
+    def getFiles(self, schema):
+        return self.files.get(schema, [])
+
+    def addFile(self, schema, kind, name, entries):
+        self.files.setdefault(schema, []).append((kind, name, ''.join(entries)))
+
+    def loadViews(self, cursor):
+        cursor.execute(VIEWS_QUERY)
+        for row in cursor.fetchall():
+            schema, name, relkind, qualified, definition, options, owner, ownerIdent, comment, indexes = row
+            objectType = 'VIEW' if relkind == 'v' else 'MATERIALIZED VIEW'
+            sql = 'CREATE %s %s' % (objectType, qualified)
+            if options:
+                sql += ' WITH (%s)' % ', '.join(options)
+            if relkind == 'v':
+                sql += ' AS\n%s\n' % definition
+            else:
+                sql += ' AS\n%s\n  WITH NO DATA;\n' % definition.rstrip(';')
+            entries = [renderEntry(name, objectType, schema, owner, sql,
+                'ALTER %s %s OWNER TO %s;\n\n' % (objectType, qualified, ownerIdent))]
+            if comment is not None:
+                entries.append(renderEntry('%s %s' % (objectType, name), 'COMMENT', schema, owner,
+                    'COMMENT ON %s %s IS %s;\n' % (objectType, qualified, quoteLiteral(comment))))
+            for indexName, index in indexes or []:
+                entries.append(renderEntry(indexName, 'INDEX', schema, owner, index + ';\n'))
+            if relkind == 'm':
+                # the data is not part of the structure, it is computed when applied
+                entries.append(renderEntry(name, 'MATERIALIZED VIEW DATA', schema, owner,
+                    'REFRESH MATERIALIZED VIEW %s;\n' % qualified))
+            self.addFile(schema, VIEWS if relkind == 'v' else MATERIALIZED_VIEWS, name, entries)
+
+    def loadFunctions(self, cursor):
+        # overloaded functions share the file of their name
+        cursor.execute(FUNCTIONS_QUERY)
+        files = {}
+        for row in cursor.fetchall():
+            schema, name, kind, signature, tag, definition, owner, ownerIdent, comment = row
+            objectType = 'PROCEDURE' if kind == 'p' else 'FUNCTION'
+            entries = files.setdefault((schema, name), [])
+            entries.append(renderEntry(tag, objectType, schema, owner, definition.rstrip('\n') + ';\n',
+                'ALTER %s %s OWNER TO %s;\n\n' % (objectType, signature, ownerIdent)))
+            if comment is not None:
+                entries.append(renderEntry('%s %s' % (objectType, tag), 'COMMENT', schema, owner,
+                    'COMMENT ON %s %s IS %s;\n' % (objectType, signature, quoteLiteral(comment))))
+        for (schema, name), entries in files.items():
+            self.addFile(schema, FUNCTIONS, name, entries)
+
+    def loadSequences(self, cursor):
+        cursor.execute(SEQUENCES_QUERY)
+        for row in cursor.fetchall():
+            schema, name, qualified, sequenceType, start, increment, minimum, maximum, cache, cycle, \
+                owner, ownerIdent, comment = row
+            sql = 'CREATE SEQUENCE %s\n' % qualified
+            if sequenceType != 'bigint':
+                sql += '    AS %s\n' % sequenceType
+            minDefault, maxDefault = SEQUENCE_LIMITS.get(sequenceType, (None, None))
+            if increment > 0:
+                minDefault = 1
+            else:
+                maxDefault = -1
+            sql += '    START WITH %s\n' % start
+            sql += '    INCREMENT BY %s\n' % increment
+            sql += '    NO MINVALUE\n' if minimum == minDefault else '    MINVALUE %s\n' % minimum
+            sql += '    NO MAXVALUE\n' if maximum == maxDefault else '    MAXVALUE %s\n' % maximum
+            sql += '    CACHE %s' % cache
+            if cycle:
+                sql += '\n    CYCLE'
+            entries = [renderEntry(name, 'SEQUENCE', schema, owner, sql + ';\n',
+                'ALTER SEQUENCE %s OWNER TO %s;\n\n' % (qualified, ownerIdent))]
+            if comment is not None:
+                entries.append(renderEntry('SEQUENCE ' + name, 'COMMENT', schema, owner,
+                    'COMMENT ON SEQUENCE %s IS %s;\n' % (qualified, quoteLiteral(comment))))
+            self.addFile(schema, SEQUENCES, name, entries)
+
+    def loadTypes(self, cursor):
+        cursor.execute(TYPES_QUERY)
+        for row in cursor.fetchall():
+            schema, name, kind, qualified, owner, ownerIdent, comment, labels, attributes, \
+                baseType, notNull, default, constraints, subtype, subtypeDiff, canonical = row
+            objectType = 'DOMAIN' if kind == 'd' else 'TYPE'
+            if kind == 'e':
+                sql = 'CREATE TYPE %s AS ENUM (\n    %s\n);\n' % (qualified, ',\n    '.join(labels or []))
+            elif kind == 'c':
+                sql = 'CREATE TYPE %s AS (\n    %s\n);\n' % (qualified, ',\n    '.join(attributes or []))
+            elif kind == 'r':
+                options = ['subtype = ' + subtype]
+                if canonical is not None:
+                    options.append('canonical = ' + canonical)
+                if subtypeDiff is not None:
+                    options.append('subtype_diff = ' + subtypeDiff)
+                sql = 'CREATE TYPE %s AS RANGE (\n    %s\n);\n' % (qualified, ',\n    '.join(options))
+            else:
+                sql = 'CREATE DOMAIN %s AS %s' % (qualified, baseType)
+                if default is not None:
+                    sql += ' DEFAULT ' + default
+                if notNull:
+                    sql += ' NOT NULL'
+                for constraint in constraints or []:
+                    sql += '\n\t' + constraint
+                sql += ';\n'
+            entries = [renderEntry(name, objectType, schema, owner, sql,
+                'ALTER %s %s OWNER TO %s;\n\n' % (objectType, qualified, ownerIdent))]
+            if comment is not None:
+                entries.append(renderEntry('%s %s' % (objectType, name), 'COMMENT', schema, owner,
+                    'COMMENT ON %s %s IS %s;\n' % (objectType, qualified, quoteLiteral(comment))))
+            self.addFile(schema, TYPES, name, entries)
+
+
+def loadDependencies(connection, database):
+    # {dependent path: set of referenced paths} of the files of a database
+    cursor = connection.cursor()
+    dependencies = {}
+    with tracing.span('catalog loadDependencies', database=database):
+        cursor.execute(OWNED_SEQUENCES_QUERY)
+        owned = dict(((row[0], row[1]), (row[2], row[3])) for row in cursor.fetchall())
+        cursor.execute(DEPENDENCIES_QUERY)
+        for row in cursor.fetchall():
+            dependent = getObjectPath(database, row[0:3], owned)
+            referenced = getObjectPath(database, row[3:6], owned)
+            if dependent != referenced:
+                dependencies.setdefault(dependent, set()).add(referenced)
+    if not connection.autocommit:
+        connection.commit()
+    return dependencies
+
+
+def getObjectPath(database, key, owned):
+    schema, kind, name = key
+    if kind == SEQUENCES and (schema, name) in owned:
+        schema, name = owned[(schema, name)]
+        kind = TABLES
+    return '%s/structure/%s/%s/%s.sql' % (database, schema, kind, name)
+
+
+def getDependents(dependencies, paths):
+    # every file depending on one of the paths, directly or through others
+    dependents = {}
+    for dependent, referenced in dependencies.items():
+        for path in referenced:
+            dependents.setdefault(path, set()).add(dependent)
+    found = set()
+    pending = list(paths)
+    while len(pending) > 0:
+        for dependent in dependents.get(pending.pop(), []):
+            if dependent not in found and dependent not in paths:
+                found.add(dependent)
+                pending.append(dependent)
+    return found
+
+
+def getMentions(content, names):
+    # paths of the objects whose qualified name appears in the content;
+    # names maps (schema, name) to a path
+    found = set()
+    for match in QUALIFIED_NAME_REGEX.finditer(content):
+        key = (unquoteName(match.group(1)), unquoteName(match.group(2)))
+        if key in names:
+            found.add(names[key])
+    return found
+
+
+def unquoteName(name):
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.lower()
+
+
+def order(items, dependencies, priority):
+    # topological order of items (dependencies first); items is a list of
+    # (path, ...) tuples, dependencies maps a path to the paths it needs and
+    # priority(index) breaks ties. Cycles are broken by priority.
+    byPath = {}
+    for index, item in enumerate(items):
+        byPath.setdefault(item[0], []).append(index)
+    needs = [set() for _ in items]
+    neededBy = [set() for _ in items]
+    for index, item in enumerate(items):
+        for path in dependencies.get(item[0], []):
+            for other in byPath.get(path, []):
+                if other != index:
+                    needs[index].add(other)
+                    neededBy[other].add(index)
+    ready = [(priority(i), i) for i in range(len(items)) if len(needs[i]) == 0]
+    heapq.heapify(ready)
+    done = set()
+    result = []
+    while len(result) < len(items):
+        if len(ready) == 0:
+            # a cycle, continue with the first item left
+            index = min((i for i in range(len(items)) if i not in done), key=priority)
+        else:
+            index = heapq.heappop(ready)[1]
+            if index in done:
+                continue
+        done.add(index)
+        result.append(items[index])
+        for other in neededBy[index]:
+            needs[other].discard(index)
+            if len(needs[other]) == 0 and other not in done:
+                heapq.heappush(ready, (priority(other), other))
+    return result
+
+
+def dropStatements(content):
+    # DROP statements of every object defined in a file, from its OWNER lines
+    return ['DROP %s IF EXISTS %s;' % (objectType, name)
+        for objectType, name in OWNER_REGEX.findall(content)]
+
+
+def getEntries(content):
+    # signature -> text of the entries of a file, keyed by their OWNER line
+    entries = {}
+    parts = re.split(r'(?m)^--\n-- Name: ', content)
+    for part in parts:
+        match = OWNER_REGEX.search(part)
+        if match is not None:
+            entries[match.group(0)] = part
+    return entries
@@ -0,0 +1,93 @@
+import re
+
+# Change records of a patch and the writer streaming them into the patch
+# files. A record only keeps the path of a changed file, the kind of change and
+# - for generated SQL (ALTER/DROP statements) - the text; file contents are
+# read in chunks while the patch file is written, so memory does not depend on
+# the size of the files in the patch.
+
+NEW = 'new'
+UPDATE = 'update'
+DELETE = 'delete'
+
+# order in which changes of the same object kind are written to a patch file
+KINDS = [DELETE, NEW, UPDATE]
+
+CHUNK_SIZE = 64 * 1024
+
+BLANK_LINES = re.compile('\n\n+')
+
+
+class Change:
+    __slots__ = ('path', 'kind', 'content')
+
+    def __init__(self, path, kind, content=None):
+        self.path = path
+        self.kind = kind
+        # None means the content is the file at `path`
+        self.content = content
+
+    def chunks(self):
+        if self.content is not None:
+            yield self.content
+            return
+        with open(self.path, 'r') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+
+class PatchChanges:
+    # change records of one database
+    __slots__ = ('changes',)
+
+    def __init__(self):
+        self.changes = []
+
+    def add(self, path, kind, content=None):
+        self.changes.append(Change(path, kind, content))
+
+    def ofKind(self, kind):
+        return [c for c in self.changes if c.kind == kind]
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __bool__(self):
+        return len(self.changes) > 0
+
+
+def collapseBlankLines(chunks):
+    # streaming version of re.sub('\n\n+', '\n\n', content); `newlines` is the
+    # number of newlines (up to 2) the output written so far ends with
+    newlines = 0
+    for chunk in chunks:
+        chunk = BLANK_LINES.sub('\n\n', chunk)
+        if len(chunk) == 0:
+            continue
+        stripped = chunk.lstrip('\n')
+        leading = min(len(chunk) - len(stripped), 2 - newlines)
+        if len(stripped) == 0:
+            newlines += leading
+            chunk = '\n' * leading
+        else:
+            chunk = '\n' * leading + stripped
+            trailing = len(stripped) - len(stripped.rstrip('\n'))
+            newlines = min(trailing, 2)
+        if len(chunk) > 0:
+            yield chunk
+
+
+def writeChanges(f, changes):
+    # changes are written in the order they were put in, see
+    # Database.orderPatchData
+    previous = None
+    for change in changes.changes:
+        if previous is not None and previous.kind == change.kind:
+            f.write('\n\n')
+        previous = change
+        f.write('-- ' + change.path + '\n')
+        for chunk in collapseBlankLines(change.chunks()):
+            f.write(chunk)
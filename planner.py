@@ -0,0 +1,443 @@
+import re
+
+import lazy
+
+psycopg2 = lazy.load('psycopg2')
+ddl = lazy.load('ddl')
+
+# Estimates what the statements of a patch file cost on a live database
+# without running any of them. Every statement is classified by the most
+# expensive thing PostgreSQL does for it: a catalog-only change, a scan that
+# validates the existing rows (constraints, NOT NULL, index builds) or a full
+# rewrite of the table and its indexes. Sizes come from pg_class.relpages and
+# reltuples, durations assume the scan/rewrite throughput given to Planner.
+
+METADATA = 'metadata-only'
+SCAN = 'validating scan'
+REWRITE = 'full rewrite'
+UNKNOWN = 'unknown'
+
+# classes in the order of their cost, UNKNOWN is for statements changing data
+CLASSES = [METADATA, SCAN, REWRITE, UNKNOWN]
+
+# throughput assumed for the duration estimates, in MB per second
+SCAN_RATE = 100
+REWRITE_RATE = 25
+
+# type modifiers that may grow without a rewrite: varchar(10) -> varchar(20)
+LENGTH_TYPES = ['character varying', 'bit varying']
+PRECISION_TYPES = ['timestamp without time zone', 'timestamp with time zone',
+    'time without time zone', 'time with time zone']
+
+SERIAL_TYPES = ['smallserial', 'serial', 'bigserial', 'serial2', 'serial4', 'serial8']
+
+TABLE_QUERY = '''WITH relation AS (
+        SELECT c.oid, c.relkind FROM pg_catalog.pg_class c
+        WHERE c.oid = pg_catalog.to_regclass(pg_catalog.quote_ident(%s) || '.' || pg_catalog.quote_ident(%s))
+    ), leaf AS (
+        SELECT l.oid, l.relpages, l.reltuples, l.reltoastrelid
+        FROM relation r
+        JOIN pg_catalog.pg_class l ON l.oid = r.oid
+        WHERE r.relkind <> 'p'
+        UNION ALL
+        SELECT l.oid, l.relpages, l.reltuples, l.reltoastrelid
+        FROM relation r, pg_catalog.pg_partition_tree(r.oid) p
+        JOIN pg_catalog.pg_class l ON l.oid = p.relid
+        WHERE r.relkind = 'p' AND p.isleaf
+    )
+    SELECT r.oid,
+        COALESCE(sum(CASE WHEN l.reltuples < 0 THEN pg_catalog.pg_relation_size(l.oid)
+            ELSE l.relpages::bigint * pg_catalog.current_setting('block_size')::int END), 0),
+        COALESCE(sum(GREATEST(l.reltuples, 0)), 0),
+        COALESCE(sum(pg_catalog.pg_relation_size(l.reltoastrelid)) FILTER (WHERE l.reltoastrelid <> 0), 0),
+        COALESCE((SELECT sum(i.relpages::bigint * pg_catalog.current_setting('block_size')::int)
+            FROM pg_catalog.pg_index x
+            JOIN pg_catalog.pg_class i ON i.oid = x.indexrelid
+            WHERE x.indrelid IN (SELECT oid FROM leaf)), 0),
+        bool_or(l.reltuples < 0)
+    FROM relation r
+    LEFT JOIN leaf l ON true
+    GROUP BY r.oid'''
+
+COLUMNS_QUERY = '''SELECT a.attname, a.atttypid, pg_catalog.format_type(a.atttypid, a.atttypmod),
+        pg_catalog.format_type(a.atttypid, NULL)
+    FROM pg_catalog.pg_attribute a
+    WHERE a.attrelid = %s AND a.attnum > 0 AND NOT a.attisdropped'''
+
+NOT_NULL_CHECKS_QUERY = '''SELECT pg_catalog.pg_get_constraintdef(c.oid)
+    FROM pg_catalog.pg_constraint c
+    WHERE c.conrelid = %s AND c.contype = 'c' AND c.convalidated'''
+
+
+class TableStats:
+    __slots__ = ('oid', 'size', 'tuples', 'toastSize', 'indexSize', 'analyzed', 'columns',
+        'notNullChecks')
+
+    def __init__(self, oid=None, size=0, tuples=0, toastSize=0, indexSize=0, analyzed=True):
+        self.oid = oid
+        self.size = size
+        self.tuples = tuples
+        self.toastSize = toastSize
+        self.indexSize = indexSize
+        self.analyzed = analyzed
+        # loaded on first use: column name -> (type oid, type, base type)
+        self.columns = None
+        # columns with a validated CHECK (column IS NOT NULL)
+        self.notNullChecks = None
+
+
+class StatementPlan:
+    __slots__ = ('number', 'statement', 'table', 'steps', 'bytes', 'seconds')
+
+    def __init__(self, number, statement, table=None):
+        self.number = number
+        self.statement = statement
+        self.table = table
+        # (class, reason) of every operation of the statement
+        self.steps = []
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def getClass(self):
+        if len(self.steps) == 0:
+            return METADATA
+        return max([kind for kind, reason in self.steps], key=CLASSES.index)
+
+
+class Planner:
+    def __init__(self, connection, scanRate=SCAN_RATE, rewriteRate=REWRITE_RATE):
+        # without a connection (a database the patch creates) every table is new
+        self.connection = connection
+        self.scanRate = float(scanRate) * 1024 * 1024
+        self.rewriteRate = float(rewriteRate) * 1024 * 1024
+        self.tables = {}
+        # state of the tables changed by the earlier statements of the patch
+        self.newTables = set()
+        self.pendingChecks = {}
+        self.validatedChecks = set()
+
+    def plan(self, content):
+        # raises ddl.SqlError when the content cannot be split into statements
+        plans = []
+        try:
+            for number, statement in enumerate(ddl.splitStatements(content), 1):
+                plans.append(self.planStatement(number, statement))
+        finally:
+            if self.connection is not None and not self.connection.autocommit:
+                self.connection.rollback()
+        return plans
+
+    def planStatement(self, number, statement):
+        tokens = ddl.significant(ddl.tokenize(statement))
+        words = [t.normalized() for t in tokens]
+        plan = StatementPlan(number, statement)
+        if len(words) == 0:
+            return plan
+        if words[:2] == ['alter', 'table']:
+            self.planAlterTable(plan, statement, tokens)
+        elif words[0] == 'create' and 'index' in words[:4]:
+            self.planCreateIndex(plan, tokens, words)
+        elif words[0] == 'create' and 'table' in words[:4]:
+            self.planCreateTable(plan, statement, tokens, words)
+        elif words[:3] == ['refresh', 'materialized', 'view']:
+            i = 4 if len(words) > 3 and words[3] == 'concurrently' else 3
+            plan.table = self.readName(tokens, i)[0]
+            self.addStep(plan, REWRITE, 'the materialized view is computed and written again',
+                self.getRewriteBytes(plan.table))
+        elif words[0] in ['cluster'] or words[:2] == ['vacuum', 'full'] or words[:3] == ['vacuum', '(', 'full']:
+            self.addStep(plan, REWRITE, '%s rewrites the table' % words[0].upper(), 0)
+        elif words[0] in ['insert', 'update', 'delete', 'merge', 'copy', 'do', 'select', 'call']:
+            plan.steps.append((UNKNOWN, 'changes data, the cost depends on the rows it touches'))
+        return plan
+
+    def planCreateTable(self, plan, statement, tokens, words):
+        i = words.index('table') + 1
+        if words[i:i + 3] == ['if', 'not', 'exists']:
+            i += 3
+        plan.table, i = self.readName(tokens, i)
+        self.newTables.add(plan.table)
+        if i < len(tokens) and tokens[i].isPunctuation('('):
+            i = ddl.findClosing(tokens, i) + 1
+        if i < len(tokens) and tokens[i].isWord('as'):
+            plan.steps.append((UNKNOWN, 'the table is filled by a query'))
+
+    def planCreateIndex(self, plan, tokens, words):
+        on = words.index('on') if 'on' in words else None
+        if on is None:
+            return
+        i = on + 1
+        if i < len(words) and words[i] == 'only':
+            i += 1
+        plan.table = self.readName(tokens, i)[0]
+        concurrently = 'concurrently' in words[:on]
+        self.addStep(plan, SCAN, 'the index is built from a scan of the table'
+            + (', twice with CONCURRENTLY' if concurrently else ''),
+            self.getTableBytes(plan.table), self.rewriteRate / (2 if concurrently else 1))
+
+    def planAlterTable(self, plan, statement, tokens):
+        i = 2
+        while i < len(tokens) and tokens[i].isWord('if', 'exists', 'only'):
+            i += 1
+        plan.table, i = self.readName(tokens, i)
+        if i < len(tokens) and tokens[i].value == '*':
+            i += 1
+        parser = ddl.TableParser(statement)
+        rewrite = None
+        for command in ddl.splitTopLevel(tokens[i:]):
+            kind, reason = self.classifyCommand(plan.table, parser, command)
+            if kind == REWRITE:
+                # the subcommands of one statement share a single rewrite
+                if rewrite is None:
+                    rewrite = reason
+                    self.addStep(plan, REWRITE, reason, self.getRewriteBytes(plan.table))
+                else:
+                    plan.steps.append((REWRITE, reason))
+            elif kind == SCAN:
+                self.addStep(plan, SCAN, reason, self.getTableBytes(plan.table))
+            else:
+                plan.steps.append((kind, reason))
+
+    def classifyCommand(self, table, parser, command):
+        # (class, reason) of a single ALTER TABLE subcommand
+        words = [t.normalized() for t in command]
+        text = parser.text(command)
+        if words[0] == 'add':
+            i = 1
+            if len(words) > 1 and words[1] == 'column':
+                i = 2
+            elif len(words) > 1 and words[1] in ddl.TABLE_CONSTRAINT_KEYWORDS:
+                return self.classifyConstraint(table, command[1:], words[1:])
+            if words[i:i + 3] == ['if', 'not', 'exists']:
+                i += 3
+            return self.classifyAddColumn(table, parser.parseColumn(command[i:]))
+        if words[0] == 'alter':
+            i = 2 if len(words) > 1 and words[1] == 'column' else 1
+            column = ddl.unquote(command[i]) if i < len(command) else None
+            action = words[i + 1:]
+            if action[:1] == ['type'] or action[:3] == ['set', 'data', 'type']:
+                typeStart = i + (2 if action[0] == 'type' else 4)
+                return self.classifyTypeChange(table, column, parser, command[typeStart:])
+            if action[:3] == ['set', 'not', 'null']:
+                if (table, column) in self.validatedChecks or column in self.getNotNullChecks(table):
+                    return METADATA, 'SET NOT NULL of %s is proven by a valid CHECK constraint' % column
+                return SCAN, 'SET NOT NULL of %s checks every row' % column
+            if action[:2] == ['set', 'expression']:
+                return REWRITE, 'the generated column %s is computed again' % column
+            return METADATA, text
+        if words[0] == 'validate':
+            name = ddl.unquote(command[-1])
+            if (table, name) in self.pendingChecks:
+                self.validatedChecks.add((table, self.pendingChecks[(table, name)]))
+            return SCAN, 'VALIDATE CONSTRAINT %s checks every row' % command[-1].value
+        if words[0] == 'set' and len(words) > 1:
+            if words[1] in ['logged', 'unlogged']:
+                return REWRITE, 'SET %s copies the table' % words[1].upper()
+            if words[1] == 'tablespace':
+                return REWRITE, 'SET TABLESPACE copies the table'
+            if words[1:3] == ['access', 'method']:
+                return REWRITE, 'SET ACCESS METHOD rewrites the table'
+        if words[0] == 'attach':
+            return SCAN, 'the attached partition is checked against the partition bound'
+        return METADATA, text
+
+    def classifyConstraint(self, table, command, words):
+        name = None
+        if words[0] == 'constraint' and len(command) > 1:
+            name = ddl.unquote(command[1])
+            command = command[2:]
+            words = words[2:]
+        if len(words) == 0:
+            return METADATA, ''
+        notValid = words[-2:] == ['not', 'valid']
+        if words[0] == 'check':
+            column = self.getNotNullCheckColumn(command)
+            if notValid:
+                if column is not None and name is not None:
+                    self.pendingChecks[(table, name)] = column
+                return METADATA, 'CHECK added NOT VALID'
+            if column is not None:
+                self.validatedChecks.add((table, column))
+            return SCAN, 'CHECK constraint checks every row'
+        if words[0] == 'foreign':
+            if notValid:
+                return METADATA, 'FOREIGN KEY added NOT VALID'
+            return SCAN, 'FOREIGN KEY checks every row against the referenced table'
+        if words[0] in ['primary', 'unique']:
+            if 'using' in words and 'index' in words:
+                return METADATA, 'the constraint uses an existing index'
+            return SCAN, 'the %s index is built from a scan of the table' % words[0].upper()
+        if words[0] == 'exclude':
+            return SCAN, 'the exclusion constraint index is built from a scan of the table'
+        return METADATA, ''
+
+    def classifyAddColumn(self, table, column):
+        name = column.name
+        if column.typeKey in SERIAL_TYPES:
+            return REWRITE, 'the %s column %s is filled from a sequence' % (column.typeKey, name)
+        if column.identity is not None:
+            return REWRITE, 'the identity column %s is filled from a sequence' % name
+        if column.generated is not None:
+            return REWRITE, 'the generated column %s is computed for every row' % name
+        if column.default is not None and self.isVolatile(column.default):
+            return REWRITE, 'the volatile default of %s is computed for every row' % name
+        for constraint in column.constraints:
+            key = constraint.key.split(' ')
+            if 'check' in key or 'references' in key:
+                return SCAN, 'the constraint of %s checks every row' % name
+            if 'unique' in key or 'primary' in key:
+                return SCAN, 'the index of %s is built from a scan of the table' % name
+        if column.notNull and column.default is None:
+            return SCAN, 'NOT NULL column %s without a default, fails unless the table is empty' % name
+        return METADATA, 'ADD COLUMN %s' % name
+
+    def classifyTypeChange(self, table, column, parser, tokens):
+        # changes PostgreSQL doesn't rewrite the table for: the same type with
+        # a wider modifier, or a binary coercible type without a modifier
+        using = [i for i, t in enumerate(tokens) if t.isWord('using', 'collate')]
+        typeTokens = tokens[:using[0]] if len(using) > 0 else tokens
+        targetText = parser.text(typeTokens)
+        if any(t.isWord('using') for t in tokens):
+            return REWRITE, 'type change of %s with USING' % column
+        stats = self.getTable(table)
+        if stats is None:
+            return METADATA, 'type change of %s on a table that does not exist yet' % column
+        current = self.getColumns(stats).get(column)
+        if current is None:
+            return REWRITE, 'type change of %s to %s' % (column, targetText)
+        sourceOid, sourceType, sourceBase = current
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('''SELECT t.oid, pg_catalog.format_type(t.oid, NULL),
+                    (SELECT c.castmethod FROM pg_catalog.pg_cast c
+                    WHERE c.castsource = %s AND c.casttarget = t.oid)
+                FROM pg_catalog.pg_type t
+                WHERE t.oid = pg_catalog.to_regtype(%s)''', (sourceOid, targetText))
+            row = cursor.fetchone()
+        except psycopg2.Error:
+            # a type name to_regtype() cannot parse
+            self.connection.rollback()
+            row = None
+        if row is None:
+            return REWRITE, 'type change of %s to %s' % (column, targetText)
+        targetOid, targetBase, castMethod = row
+        description = 'type change of %s from %s to %s' % (column, sourceType, targetText)
+        sourceModifiers = getModifiers(sourceType)
+        targetModifiers = getModifiers(targetText)
+        if targetOid == sourceOid:
+            if isWider(sourceBase, sourceModifiers, targetModifiers):
+                return METADATA, description
+        elif castMethod == 'b' and len(targetModifiers) == 0:
+            return METADATA, description + ' (binary coercible)'
+        return REWRITE, description
+
+    def getNotNullCheckColumn(self, command):
+        # the column of CHECK (column IS NOT NULL), None for any other check
+        words = [t.normalized() for t in command if not t.isPunctuation('(') and not t.isPunctuation(')')]
+        if words[0:1] == ['check'] and words[2:5] == ['is', 'not', 'null'] \
+                and words[5:] in [[], ['not', 'valid']]:
+            column = [t for t in command if not t.isPunctuation('(')][1]
+            return ddl.unquote(column)
+        return None
+
+    def getNotNullChecks(self, table):
+        stats = self.getTable(table)
+        if stats is None:
+            return set()
+        if stats.notNullChecks is None:
+            stats.notNullChecks = set()
+            cursor = self.connection.cursor()
+            cursor.execute(NOT_NULL_CHECKS_QUERY, (stats.oid,))
+            for row in cursor.fetchall():
+                column = self.getNotNullCheckColumn(ddl.significant(ddl.tokenize(row[0])))
+                if column is not None:
+                    stats.notNullChecks.add(column)
+        return stats.notNullChecks
+
+    def isVolatile(self, expression):
+        # a default calling a volatile function (nextval, random, clock_timestamp...)
+        tokens = ddl.significant(ddl.tokenize(expression))
+        functions = [ddl.unquote(t) for i, t in enumerate(tokens[:-1])
+            if t.type in [ddl.WORD, ddl.QUOTED] and tokens[i + 1].isPunctuation('(')]
+        if len(functions) == 0:
+            return False
+        if self.connection is None:
+            return any(f in ['nextval', 'random', 'clock_timestamp', 'gen_random_uuid']
+                for f in functions)
+        cursor = self.connection.cursor()
+        cursor.execute('''SELECT COALESCE(bool_or(p.provolatile = 'v'), false)
+            FROM pg_catalog.pg_proc p WHERE p.proname = ANY(%s)''', (functions,))
+        return cursor.fetchone()[0]
+
+    def readName(self, tokens, i):
+        # ((schema, name), index after the name) of a possibly qualified name
+        parts = [ddl.unquote(tokens[i])] if i < len(tokens) else ['']
+        i += 1
+        while i + 1 < len(tokens) and tokens[i].isPunctuation('.'):
+            parts.append(ddl.unquote(tokens[i + 1]))
+            i += 2
+        if len(parts) == 1:
+            parts.insert(0, 'public')
+        return (parts[-2], parts[-1]), i
+
+    def getTable(self, table):
+        if table in self.newTables or self.connection is None:
+            return None
+        if table not in self.tables:
+            cursor = self.connection.cursor()
+            cursor.execute(TABLE_QUERY, table)
+            row = cursor.fetchone()
+            self.tables[table] = None if row is None else TableStats(row[0], int(row[1]),
+                float(row[2]), int(row[3]), int(row[4]), not row[5])
+        return self.tables[table]
+
+    def getColumns(self, stats):
+        if stats.columns is None:
+            cursor = self.connection.cursor()
+            cursor.execute(COLUMNS_QUERY, (stats.oid,))
+            stats.columns = dict((row[0], row[1:]) for row in cursor.fetchall())
+        return stats.columns
+
+    def getTableBytes(self, table):
+        stats = self.getTable(table)
+        return 0 if stats is None else stats.size
+
+    def getRewriteBytes(self, table):
+        # the heap and TOAST data are copied and every index is rebuilt
+        stats = self.getTable(table)
+        return 0 if stats is None else stats.size + stats.toastSize + stats.indexSize
+
+    def addStep(self, plan, kind, reason, size, rate=None):
+        if rate is None:
+            rate = self.rewriteRate if kind == REWRITE else self.scanRate
+        plan.steps.append((kind, reason))
+        plan.bytes += size
+        plan.seconds += size / rate
+
+
+def getModifiers(typeName):
+    # [10, 2] of 'numeric(10,2)', [] without modifiers
+    match = re.search(r'\(([\d\s,]+)\)', typeName)
+    if match is None:
+        return []
+    return [int(m) for m in match.group(1).split(',')]
+
+
+def isWider(baseType, source, target):
+    # whether a column of baseType(source) fits baseType(target) unchanged
+    if source == target or len(target) == 0 and baseType in LENGTH_TYPES + ['numeric'] + PRECISION_TYPES:
+        return True
+    if len(source) == 0 or len(target) == 0:
+        return False
+    if baseType in LENGTH_TYPES + PRECISION_TYPES:
+        return target[0] >= source[0]
+    if baseType == 'numeric' and len(source) == 2 and len(target) == 2:
+        return target[1] == source[1] and target[0] >= source[0]
+    return False
+
+
+def formatSize(size):
+    for unit in ['bytes', 'kB', 'MB', 'GB']:
+        if size < 10240:
+            return '%d %s' % (size, unit)
+        size /= 1024
+    return '%d TB' % size
@@ -0,0 +1,107 @@
+import json
+import os
+import subprocess
+import tempfile
+
+import tracing
+
+# Index of the query files (<db>/queries/**) of the working tree, so that
+# 'patch create' and 'patch apply' look them up instead of walking every
+# queries directory. It is kept in .git/ with the blob id of every tracked
+# file (None for untracked ones) and listed again with a single 'git ls-files'
+# only when the index or one of the directories holding query files changed
+# since. Whether a file is registered, and in which patch, stays in
+# git_db.query of each database.
+
+MANIFEST_PATH = '.git/git-db/queries.json'
+MANIFEST_VERSION = 1
+QUERIES_PATHSPEC = ':(glob)*/queries/**'
+
+
+class QueryManifest:
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        # path -> blob id, None for untracked files
+        self.files = {}
+        # what the files were listed at: the index and the directories a new
+        # query file would show up in
+        self.stamps = {}
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get('version') != MANIFEST_VERSION:
+            return
+        self.files = manifest['files']
+        self.stamps = dict((path, tuple(stamp) if stamp is not None else None)
+            for path, stamp in manifest['stamps'].items())
+
+    def refresh(self):
+        self.load()
+        if len(self.stamps) > 0 and all(getStamp(path) == stamp for path, stamp in self.stamps.items()):
+            tracing.count('query_manifest_hits')
+            return
+        tracing.count('subprocesses')
+        with tracing.span('list query files'):
+            output = subprocess.run(['git', 'ls-files', '-z', '--stage', '--cached', '--others',
+                '--exclude-standard', '--', QUERIES_PATHSPEC],
+                stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+        self.files = {}
+        for line in output.split('\0'):
+            if len(line) == 0:
+                continue
+            if '\t' in line:
+                info, path = line.split('\t', 1)
+                self.files[path] = info.split(' ')[1]
+            else:
+                self.files[line] = None
+        self.files = dict(sorted(self.files.items()))
+        self.stamps = dict((path, getStamp(path)) for path in self.getWatchedPaths())
+        self.save()
+
+    def getWatchedPaths(self):
+        # a file added to a directory changes its modification time, and so
+        # does a directory added to its parent
+        paths = set(['.git/index', '.'])
+        for name in os.listdir('.'):
+            if os.path.isdir(name + '/queries'):
+                paths.update([name, name + '/queries'])
+        for path in self.files:
+            directory = os.path.dirname(path)
+            while directory not in paths and directory != '':
+                paths.add(directory)
+                directory = os.path.dirname(directory)
+        return sorted(paths)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temporaryPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'version': MANIFEST_VERSION, 'files': self.files,
+                    'stamps': self.stamps}, f)
+            os.replace(temporaryPath, self.path)
+        except OSError as e:
+            print('[WARNING] unable to write the query manifest: %s' % e)
+
+    def getFiles(self, database='*'):
+        # query files of a database, or of every database, sorted by path
+        self.refresh()
+        return [path for path in self.files
+            if path.split('/')[1:2] == ['queries'] and database in ['*', path.split('/')[0]]]
+
+
+def getStamp(path):
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None
+    return (status.st_mtime_ns, status.st_size)
@@ -0,0 +1,170 @@
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+from catalog import Catalog
+
+# Renders every table of a corpus from the catalog and compares it with the
+# output of 'pg_dump --schema-only --table' byte for byte, the way 'database
+# pull' and 'database verify' rely on. The server is the one libpq finds
+# through PGHOST, PGPORT, PGUSER and PGPASSWORD; without a reachable server
+# or pg_dump on the PATH the tests are skipped.
+
+DATABASE = 'git_db_catalog_test_%d' % os.getpid()
+
+CORPUS = '''
+CREATE ROLE git_db_catalog_reader;
+CREATE SCHEMA "Mixed Schema";
+CREATE TABLE public.plain (
+    id integer NOT NULL,
+    name character varying(40) DEFAULT 'x, y'::character varying,
+    price numeric(10,2) CHECK (price > (0)::numeric),
+    created timestamp with time zone DEFAULT now() NOT NULL,
+    PRIMARY KEY (id)
+);
+COMMENT ON TABLE public.plain IS 'it''s plain';
+COMMENT ON COLUMN public.plain.name IS 'the name';
+CREATE INDEX plain_name_idx ON public.plain (lower(name));
+CREATE TABLE public.identities (
+    always_id bigint GENERATED ALWAYS AS IDENTITY,
+    default_id integer GENERATED BY DEFAULT AS IDENTITY (START WITH 10 INCREMENT BY 5),
+    serial_id serial,
+    price numeric(10,2),
+    taxed numeric GENERATED ALWAYS AS (price * 1.2) STORED
+);
+CREATE TABLE public.bookings (
+    room integer,
+    during tsrange,
+    EXCLUDE USING gist (during WITH &&)
+);
+CREATE TABLE public.deferred (
+    id integer PRIMARY KEY,
+    parent integer,
+    code text UNIQUE DEFERRABLE INITIALLY DEFERRED,
+    CONSTRAINT deferred_parent_fkey FOREIGN KEY (parent) REFERENCES public.deferred(id)
+        ON DELETE CASCADE DEFERRABLE INITIALLY IMMEDIATE
+);
+CREATE TABLE "Mixed Schema"."Mixed ""Quoted"" Table" (
+    "Id" integer NOT NULL,
+    "select" text COLLATE "C",
+    "Value, With Comma" text DEFAULT 'a,b'
+);
+ALTER TABLE ONLY "Mixed Schema"."Mixed ""Quoted"" Table"
+    ADD CONSTRAINT "Mixed PK" PRIMARY KEY ("Id");
+CREATE TABLE public.granted (id integer);
+GRANT SELECT, INSERT ON public.granted TO git_db_catalog_reader;
+GRANT UPDATE ON public.granted TO PUBLIC;
+CREATE TABLE public.column_granted (id integer, secret text);
+GRANT UPDATE (id) ON public.column_granted TO git_db_catalog_reader;
+CREATE UNLOGGED TABLE public.scratch (id integer, payload text);
+CREATE TABLE public.stored (
+    id integer,
+    payload text
+);
+ALTER TABLE public.stored ALTER COLUMN payload SET STORAGE EXTERNAL;
+ALTER TABLE public.stored ALTER COLUMN id SET STATISTICS 500;
+CREATE TABLE public.tuned (id integer) WITH (fillfactor = 70, autovacuum_enabled = false);
+CREATE TABLE public.measurements (
+    logdate date NOT NULL,
+    value integer
+) PARTITION BY RANGE (logdate);
+CREATE TABLE public.measurements_2024 PARTITION OF public.measurements
+    FOR VALUES FROM ('2024-01-01') TO ('2025-01-01');
+CREATE FUNCTION public.touch() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    RETURN NEW;
+END
+$$;
+CREATE TRIGGER plain_touch BEFORE UPDATE ON public.plain
+    FOR EACH ROW EXECUTE FUNCTION public.touch();
+'''
+
+# tables the renderer reports as unsupported on purpose (column grants,
+# storage and statistics settings, reloptions, partitioning), 'database pull'
+# extracts them with pg_dump
+PG_DUMP_TABLES = [
+    ('public', 'column_granted'),
+    ('public', 'stored'),
+    ('public', 'tuned'),
+    ('public', 'measurements'),
+    ('public', 'measurements_2024'),
+]
+
+
+def connect(database):
+    try:
+        return psycopg2.connect(dbname=database, connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        pytest.skip('no PostgreSQL server reachable: %s' % str(e).strip())
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    if shutil.which('pg_dump') is None:
+        pytest.skip('pg_dump is not on the PATH')
+    admin = connect('postgres')
+    admin.autocommit = True
+    cursor = admin.cursor()
+    cursor.execute('DROP ROLE IF EXISTS git_db_catalog_reader')
+    cursor.execute('CREATE DATABASE %s' % DATABASE)
+    connection = connect(DATABASE)
+    try:
+        connection.cursor().execute(CORPUS)
+        connection.commit()
+        yield connection
+    finally:
+        connection.close()
+        cursor.execute('DROP DATABASE %s' % DATABASE)
+        cursor.execute('DROP ROLE IF EXISTS git_db_catalog_reader')
+        admin.close()
+
+
+def dump(schema, table):
+    pattern = '"%s"."%s"' % (schema.replace('"', '""'), table.replace('"', '""'))
+    output = subprocess.check_output(['pg_dump', '--schema-only', '--table', pattern,
+        '--dbname', DATABASE])
+    return output.decode('utf-8')
+
+
+def stripDumpKeys(dump):
+    # see Database.stripDumpKeys
+    return re.sub('^\\\\(un)?restrict .*\n', '', dump, flags=re.MULTILINE)
+
+
+@pytest.fixture(scope='module')
+def catalog(corpus):
+    catalog = Catalog(corpus)
+    catalog.load()
+    if not catalog.isSupportedServer():
+        pytest.skip('catalog rendering needs PostgreSQL 12 or newer')
+    assert catalog.setDumpFrame(dump('public', 'plain'))
+    return catalog
+
+
+def getTables(catalog):
+    return sorted(key for key, relation in catalog.relations.items()
+        if relation['kind'] in ['r', 'p'] and key[0] in ['public', 'Mixed Schema'])
+
+
+def test_corpus_tables_are_found(catalog):
+    tables = getTables(catalog)
+    assert ('Mixed Schema', 'Mixed "Quoted" Table') in tables
+    assert len(tables) == 12
+
+
+def test_render_matches_pg_dump(catalog):
+    mismatched = []
+    for schema, table in getTables(catalog):
+        content = catalog.renderTable(schema, table)
+        if (schema, table) in PG_DUMP_TABLES:
+            assert content is None, '%s.%s is expected to fall back to pg_dump' % (schema, table)
+            continue
+        assert content is not None, '%s.%s is not rendered from the catalog' % (schema, table)
+        if stripDumpKeys(content) != stripDumpKeys(dump(schema, table)):
+            mismatched.append('%s.%s' % (schema, table))
+    assert mismatched == []
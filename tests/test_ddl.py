@@ -0,0 +1,390 @@
+import os
+
+import pytest
+
+import ddl
+
+# Table-driven tests of the tokenizer, the CREATE TABLE parser and the ALTER
+# TABLE subcommands generated from two versions of a table. The statements
+# alterTable() emits are also run against a scratch database when a server
+# is reachable, see test_alter_statements_run.
+
+
+TOKENIZE_CASES = [
+    ('numeric(10,2)', [
+        (ddl.WORD, 'numeric'), (ddl.PUNCTUATION, '('), (ddl.NUMBER, '10'),
+        (ddl.PUNCTUATION, ','), (ddl.NUMBER, '2'), (ddl.PUNCTUATION, ')')]),
+    ("DEFAULT 'x, y'::text", [
+        (ddl.WORD, 'DEFAULT'), (ddl.STRING, "'x, y'"), (ddl.OPERATOR, '::'), (ddl.WORD, 'text')]),
+    ('"Mixed ""Quoted"" Name".id', [
+        (ddl.QUOTED, '"Mixed ""Quoted"" Name"'), (ddl.PUNCTUATION, '.'), (ddl.WORD, 'id')]),
+    ("E'it\\'s', 'it''s'", [
+        (ddl.STRING, "E'it\\'s'"), (ddl.PUNCTUATION, ','), (ddl.STRING, "'it''s'")]),
+    ('$body$ a; b $body$', [(ddl.STRING, '$body$ a; b $body$')]),
+    ('a /* x /* nested */ y */ -- tail', [
+        (ddl.WORD, 'a'), (ddl.COMMENT, '/* x /* nested */ y */'), (ddl.COMMENT, '-- tail')]),
+    ('\\restrict abc\nSELECT $1', [
+        (ddl.META, '\\restrict abc'), (ddl.WORD, 'SELECT'), (ddl.OPERATOR, '$1')]),
+]
+
+
+@pytest.mark.parametrize('sql,expected', TOKENIZE_CASES)
+def test_tokenize(sql, expected):
+    assert [(t.type, t.value) for t in ddl.tokenize(sql)] == expected
+
+
+@pytest.mark.parametrize('sql', ["'open", '"open', '$$ open', '/* open', 'a ? \x01'])
+def test_tokenize_errors(sql):
+    with pytest.raises(ddl.SqlError):
+        ddl.tokenize(sql)
+
+
+SPLIT_CASES = [
+    ('SELECT 1; SELECT 2;', ['SELECT 1', 'SELECT 2']),
+    ("SELECT 'a;b'; SELECT \"c;d\"", ["SELECT 'a;b'", 'SELECT "c;d"']),
+    ('-- a; comment\nSELECT 1;;\n/* ; */', ['SELECT 1']),
+    ('CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ LANGUAGE sql; SELECT 2',
+        ['CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ LANGUAGE sql', 'SELECT 2']),
+    ('CREATE FUNCTION f() RETURNS int BEGIN ATOMIC SELECT CASE WHEN true THEN 1 END; '
+        'SELECT 2; END; SELECT 3',
+        ['CREATE FUNCTION f() RETURNS int BEGIN ATOMIC SELECT CASE WHEN true THEN 1 END; '
+            'SELECT 2; END', 'SELECT 3']),
+    ('\\restrict key\nSELECT 1;\n\\unrestrict key\n', ['SELECT 1']),
+]
+
+
+@pytest.mark.parametrize('sql,expected', SPLIT_CASES)
+def test_split_statements(sql, expected):
+    assert ddl.splitStatements(sql) == expected
+
+
+def test_split_statements_offsets():
+    sql = 'SELECT 1;\n\nSELECT 2;'
+    assert ddl.splitStatements(sql, withOffsets=True) == [(0, 8, 'SELECT 1'), (11, 19, 'SELECT 2')]
+
+
+# column definition -> expected attributes of the parsed column
+COLUMN_CASES = [
+    ('price numeric(10,2) NOT NULL',
+        {'type': 'numeric(10,2)', 'notNull': True}),
+    ("name text DEFAULT 'x, y'::text",
+        {'type': 'text', 'default': "'x, y'::text"}),
+    ('"Mixed Case" text COLLATE "C"',
+        {'name': '"Mixed Case"', 'key': 'Mixed Case', 'type': 'text', 'collation': '"C"'}),
+    ('code text COLLATE pg_catalog."default" NOT NULL',
+        {'collation': 'pg_catalog."default"', 'notNull': True}),
+    ('id integer GENERATED BY DEFAULT AS IDENTITY (START WITH 10 INCREMENT BY 5) NOT NULL',
+        {'identity': 'GENERATED BY DEFAULT AS IDENTITY (START WITH 10 INCREMENT BY 5)',
+            'default': None, 'notNull': True}),
+    ('id bigint GENERATED ALWAYS AS IDENTITY',
+        {'type': 'bigint', 'identity': 'GENERATED ALWAYS AS IDENTITY'}),
+    ('taxed numeric GENERATED ALWAYS AS ((price * 1.2)) STORED',
+        {'generated': 'GENERATED ALWAYS AS ((price * 1.2)) STORED', 'identity': None}),
+    ('stamp timestamp(3) with time zone DEFAULT now()',
+        {'type': 'timestamp(3) with time zone', 'default': 'now()'}),
+    ('payload text STORAGE EXTERNAL COMPRESSION lz4',
+        {'storage': 'EXTERNAL', 'compression': 'lz4'}),
+]
+
+
+@pytest.mark.parametrize('definition,expected', COLUMN_CASES)
+def test_parse_column(definition, expected):
+    table = ddl.parseCreateTable('CREATE TABLE public.t (\n    %s\n)' % definition)
+    column = list(table.columns.values())[0]
+    for attribute, value in expected.items():
+        assert getattr(column, attribute) == value, attribute
+
+
+def test_parse_column_constraints():
+    table = ddl.parseCreateTable('''CREATE TABLE public.t (
+        a integer CONSTRAINT a_positive CHECK (a IN (1, 2)) REFERENCES public.p(id)
+            DEFERRABLE INITIALLY DEFERRED NOT NULL
+    )''')
+    column = table.columns['a']
+    assert [(c.name, c.definition) for c in column.constraints] == [
+        ('a_positive', 'CHECK (a IN (1, 2))'),
+        (None, 'REFERENCES public.p(id)\n            DEFERRABLE INITIALLY DEFERRED')]
+    assert column.notNull
+
+
+def test_parse_table():
+    table = ddl.parseCreateTable('''CREATE UNLOGGED TABLE "Mixed Schema"."Mixed ""Quoted"" Table" (
+        id integer,
+        CONSTRAINT t_pkey PRIMARY KEY (id),
+        CHECK (id > 0)
+    ) WITH (fillfactor='70') TABLESPACE fast''')
+    assert table.qualifiedName == '"Mixed Schema"."Mixed ""Quoted"" Table"'
+    assert (table.schema, table.name) == ('Mixed Schema', 'Mixed "Quoted" Table')
+    assert table.unlogged
+    assert list(table.constraints) == ['t_pkey', 'check ( id > 0 )']
+    assert table.options == {'fillfactor': "fillfactor='70'"}
+    assert table.tablespace == 'fast'
+
+
+@pytest.mark.parametrize('statement', ['CREATE VIEW v AS SELECT 1', 'ALTER TABLE t ADD x int',
+    'CREATE INDEX i ON t (a)'])
+def test_parse_not_a_table(statement):
+    assert ddl.parseCreateTable(statement) is None
+
+
+# (columns of the target table, columns of the current one, subcommands of
+# the ALTER TABLE turning the target into the current table)
+ALTER_CASES = [
+    ('numeric precision',
+        'a numeric(10,2)', 'a numeric(12,4)',
+        ['ALTER COLUMN a TYPE numeric(12,4)']),
+    ('numeric spacing',
+        'a numeric(10,2)', 'a numeric(10, 2)',
+        []),
+    ('default with a comma',
+        "a text DEFAULT 'x, y'::text", "a text DEFAULT 'x,y'::text",
+        ["ALTER COLUMN a SET DEFAULT 'x,y'::text"]),
+    ('default dropped',
+        "a text DEFAULT 'x'::text", 'a text',
+        ['ALTER COLUMN a DROP DEFAULT']),
+    ('check with commas',
+        'a integer CONSTRAINT t_a_check CHECK (a IN (1, 2))',
+        'a integer CONSTRAINT t_a_check CHECK (a IN (1, 2, 3))',
+        ['DROP CONSTRAINT IF EXISTS t_a_check', 'ADD CONSTRAINT t_a_check CHECK (a IN (1, 2, 3))']),
+    ('table check changed',
+        'a integer, CONSTRAINT c CHECK (a > 0)', 'a integer, CONSTRAINT c CHECK (a > 1)',
+        ['DROP CONSTRAINT IF EXISTS c', 'ADD CONSTRAINT c CHECK (a > 1)']),
+    ('unique constraint added',
+        'a integer', 'a integer CONSTRAINT t_a_key UNIQUE NULLS NOT DISTINCT',
+        ['ADD CONSTRAINT t_a_key UNIQUE NULLS NOT DISTINCT (a)']),
+    ('foreign key added',
+        'a integer', 'a integer REFERENCES public.p(id) ON DELETE CASCADE',
+        ['ADD FOREIGN KEY (a) REFERENCES public.p(id) ON DELETE CASCADE']),
+    ('quoted column',
+        '"Mixed Case" integer', '"Mixed Case" bigint',
+        ['ALTER COLUMN "Mixed Case" TYPE bigint']),
+    ('quoting changes the column',
+        'mixed integer', '"Mixed" integer',
+        ['DROP COLUMN IF EXISTS mixed', 'ADD COLUMN IF NOT EXISTS "Mixed" integer']),
+    ('unquoted case is ignored',
+        'Mixed integer', 'mixed integer',
+        []),
+    ('collation added',
+        'a text', 'a text COLLATE "C"',
+        ['ALTER COLUMN a TYPE text COLLATE "C"']),
+    ('collation dropped',
+        'a text COLLATE "C"', 'a text',
+        ['ALTER COLUMN a TYPE text']),
+    ('not null',
+        'a integer', 'a integer NOT NULL',
+        ['ALTER COLUMN a SET NOT NULL']),
+    ('nullable',
+        'a integer NOT NULL', 'a integer',
+        ['ALTER COLUMN a DROP NOT NULL']),
+    ('identity added',
+        'a integer NOT NULL', 'a integer GENERATED ALWAYS AS IDENTITY NOT NULL',
+        ['ALTER COLUMN a ADD GENERATED ALWAYS AS IDENTITY']),
+    ('identity dropped',
+        'a integer GENERATED BY DEFAULT AS IDENTITY NOT NULL', 'a integer NOT NULL',
+        ['ALTER COLUMN a DROP IDENTITY IF EXISTS']),
+    ('identity by default to always',
+        'a integer GENERATED BY DEFAULT AS IDENTITY NOT NULL',
+        'a integer GENERATED ALWAYS AS IDENTITY NOT NULL',
+        ['ALTER COLUMN a SET GENERATED ALWAYS']),
+    ('identity options changed',
+        'a integer GENERATED BY DEFAULT AS IDENTITY NOT NULL',
+        'a integer GENERATED BY DEFAULT AS IDENTITY (START WITH 10) NOT NULL',
+        ['ALTER COLUMN a DROP IDENTITY IF EXISTS',
+            'ALTER COLUMN a ADD GENERATED BY DEFAULT AS IDENTITY (START WITH 10)']),
+    ('default to identity',
+        "a integer DEFAULT 0 NOT NULL", 'a integer GENERATED ALWAYS AS IDENTITY NOT NULL',
+        ['ALTER COLUMN a DROP DEFAULT', 'ALTER COLUMN a ADD GENERATED ALWAYS AS IDENTITY']),
+    ('identity to default',
+        'a integer GENERATED ALWAYS AS IDENTITY NOT NULL', 'a integer DEFAULT 0 NOT NULL',
+        ['ALTER COLUMN a DROP IDENTITY IF EXISTS', 'ALTER COLUMN a SET DEFAULT 0']),
+    ('identity on a nullable column',
+        'a integer', 'a integer GENERATED BY DEFAULT AS IDENTITY NOT NULL',
+        ['ALTER COLUMN a SET NOT NULL', 'ALTER COLUMN a ADD GENERATED BY DEFAULT AS IDENTITY']),
+    ('generated column added',
+        'a integer, b integer', 'a integer, b integer GENERATED ALWAYS AS ((a * 2)) STORED',
+        ['DROP COLUMN IF EXISTS b', 'ADD COLUMN b integer GENERATED ALWAYS AS ((a * 2)) STORED']),
+    ('generated column dropped',
+        'a integer, b integer GENERATED ALWAYS AS ((a * 2)) STORED', 'a integer, b integer',
+        ['DROP COLUMN IF EXISTS b', 'ADD COLUMN b integer']),
+    ('generated expression changed',
+        'a integer, b integer GENERATED ALWAYS AS ((a * 2)) STORED',
+        'a integer, b integer GENERATED ALWAYS AS ((a * 3)) STORED',
+        ['DROP COLUMN IF EXISTS b', 'ADD COLUMN b integer GENERATED ALWAYS AS ((a * 3)) STORED']),
+    ('columns added and dropped',
+        'a integer, b text', "a integer, c numeric(10,2) DEFAULT 0.5",
+        ['DROP COLUMN IF EXISTS b', 'ADD COLUMN IF NOT EXISTS c numeric(10,2) DEFAULT 0.5']),
+    ('storage',
+        'a text', 'a text STORAGE EXTERNAL',
+        ['ALTER COLUMN a SET STORAGE EXTERNAL']),
+]
+
+
+def parseColumns(columns, unlogged=False):
+    return ddl.parseCreateTable('CREATE %sTABLE public.t (\n    %s\n)'
+        % ('UNLOGGED ' if unlogged else '', columns))
+
+
+@pytest.mark.parametrize('name,target,current,expected', ALTER_CASES, ids=[c[0] for c in ALTER_CASES])
+def test_alter_table(name, target, current, expected):
+    assert ddl.alterTable(parseColumns(target), parseColumns(current)) == expected
+
+
+def test_alter_table_options():
+    target = ddl.parseCreateTable('CREATE TABLE t (a int) WITH (fillfactor=70, autovacuum_enabled=false)')
+    current = ddl.parseCreateTable('CREATE UNLOGGED TABLE t (a int) WITH (fillfactor=80) TABLESPACE fast')
+    assert ddl.alterTable(target, current) == ['SET UNLOGGED', 'SET (fillfactor=80)',
+        'RESET (autovacuum_enabled)', 'SET TABLESPACE fast']
+    assert ddl.alterTable(current, target) == ['SET LOGGED',
+        'SET (fillfactor=70, autovacuum_enabled=false)', 'SET TABLESPACE pg_default']
+
+
+ONLINE_CASES = [
+    ('ADD CONSTRAINT c FOREIGN KEY (a) REFERENCES public.p(id)',
+        ['ADD CONSTRAINT c FOREIGN KEY (a) REFERENCES public.p(id) NOT VALID'],
+        ['ALTER TABLE public.t VALIDATE CONSTRAINT c']),
+    ('ADD FOREIGN KEY (a) REFERENCES public.p(id)',
+        ['ADD CONSTRAINT t_a_fkey FOREIGN KEY (a) REFERENCES public.p(id) NOT VALID'],
+        ['ALTER TABLE public.t VALIDATE CONSTRAINT t_a_fkey']),
+    ('ADD CHECK (a IN (1, 2))',
+        ['ADD CONSTRAINT t_a_check CHECK (a IN (1, 2)) NOT VALID'],
+        ['ALTER TABLE public.t VALIDATE CONSTRAINT t_a_check']),
+    ('ADD CHECK (a > "B")',
+        ['ADD CONSTRAINT t_check CHECK (a > "B") NOT VALID'],
+        ['ALTER TABLE public.t VALIDATE CONSTRAINT t_check']),
+    ('ALTER COLUMN a SET NOT NULL',
+        ['ADD CONSTRAINT t_a_not_null CHECK (a IS NOT NULL) NOT VALID'],
+        ['ALTER TABLE public.t VALIDATE CONSTRAINT t_a_not_null',
+            'ALTER TABLE public.t ALTER COLUMN a SET NOT NULL',
+            'ALTER TABLE public.t DROP CONSTRAINT t_a_not_null']),
+    ('ALTER COLUMN a TYPE bigint',
+        ['ALTER COLUMN a TYPE bigint'],
+        []),
+]
+
+
+@pytest.mark.parametrize('command,online,followUps', ONLINE_CASES)
+def test_online_alter_table(command, online, followUps):
+    table = parseColumns('a integer, "B" integer')
+    assert ddl.onlineAlterTable(table, [command]) == (online, followUps)
+
+
+def test_constraint_name_truncation():
+    name = ddl.constraintName('t' * 40, ['c' * 40], 'fkey')
+    assert name == 't' * 29 + '_' + 'c' * 28 + '_fkey'
+    assert len(name) == ddl.MAX_NAME_LENGTH
+    assert ddl.constraintName('My Table', ['id'], 'check') == '"My Table_id_check"'
+
+
+DROP_CASES = [
+    ('ALTER TABLE ONLY public.t\n    ADD CONSTRAINT t_pkey PRIMARY KEY (id)',
+        'ALTER TABLE public.t DROP CONSTRAINT IF EXISTS t_pkey'),
+    ('ALTER TABLE ONLY "Mixed Schema"."T" ADD CONSTRAINT "Mixed PK" PRIMARY KEY ("Id")',
+        'ALTER TABLE "Mixed Schema"."T" DROP CONSTRAINT IF EXISTS "Mixed PK"'),
+    ('CREATE INDEX t_a_idx ON public.t USING btree (a)',
+        'DROP INDEX IF EXISTS public.t_a_idx'),
+    ('CREATE UNIQUE INDEX "Idx" ON ONLY "S".t USING btree (a)',
+        'DROP INDEX IF EXISTS "S"."Idx"'),
+    ('CREATE INDEX CONCURRENTLY IF NOT EXISTS i ON t (a)',
+        'DROP INDEX IF EXISTS i'),
+    ('CREATE TRIGGER t1 BEFORE INSERT ON public.t FOR EACH ROW EXECUTE FUNCTION public.f()',
+        'DROP TRIGGER IF EXISTS t1 ON public.t'),
+    ('CREATE CONSTRAINT TRIGGER t2 AFTER INSERT ON public.t FOR EACH ROW EXECUTE FUNCTION f()',
+        'DROP TRIGGER IF EXISTS t2 ON public.t'),
+    ('CREATE RULE r AS ON INSERT TO public.t DO INSTEAD NOTHING',
+        'DROP RULE IF EXISTS r ON public.t'),
+    ('ALTER TABLE public.t OWNER TO admin', None),
+    ('COMMENT ON TABLE public.t IS \'x\'', None),
+    ('CREATE TABLE public.t (a int)', None),
+]
+
+
+@pytest.mark.parametrize('statement,expected', DROP_CASES)
+def test_drop_statement(statement, expected):
+    assert ddl.dropStatement(statement) == expected
+
+
+# the statements a changed table file turns into, see ddl.diffTable
+def test_diff_table():
+    target = '''CREATE TABLE public.t (
+    id integer NOT NULL,
+    note text
+);
+
+CREATE INDEX t_note_idx ON public.t USING btree (note);
+'''
+    current = '''CREATE TABLE public.t (
+    id integer NOT NULL,
+    note text NOT NULL,
+    price numeric(10,2)
+);
+
+CREATE INDEX t_note_idx ON public.t USING btree (lower(note));
+'''
+    assert ddl.diffTable(target, current, 'app/structure/public/tables/t.sql') == (
+        'DROP INDEX IF EXISTS public.t_note_idx;\n\n'
+        'ALTER TABLE public.t\n'
+        '\tALTER COLUMN note SET NOT NULL,\n'
+        '\tADD COLUMN IF NOT EXISTS price numeric(10,2);\n\n'
+        'CREATE INDEX t_note_idx ON public.t USING btree (lower(note));\n\n')
+    assert ddl.diffTable(target, current, 'app/structure/public/tables/t.sql', online=True) == (
+        '-- git-db: no-transaction\n'
+        'DROP INDEX CONCURRENTLY IF EXISTS public.t_note_idx;\n\n'
+        'ALTER TABLE public.t\n'
+        '\tADD CONSTRAINT t_note_not_null CHECK (note IS NOT NULL) NOT VALID,\n'
+        '\tADD COLUMN IF NOT EXISTS price numeric(10,2);\n\n'
+        '-- git-db: no-transaction\n'
+        'CREATE INDEX CONCURRENTLY t_note_idx ON public.t USING btree (lower(note));\n\n'
+        'ALTER TABLE public.t VALIDATE CONSTRAINT t_note_not_null;\n\n'
+        'ALTER TABLE public.t ALTER COLUMN note SET NOT NULL;\n\n'
+        'ALTER TABLE public.t DROP CONSTRAINT t_note_not_null;\n\n')
+
+
+def test_diff_table_unparsable():
+    messages = []
+    current = "CREATE TABLE t (a text DEFAULT 'open);"
+    assert ddl.diffTable('', current, 'app/structure/public/tables/t.sql', log=messages.append) == current
+    assert len(messages) == 1 and messages[0].startswith('[WARNING] Unable to parse')
+
+
+@pytest.fixture(scope='module')
+def scratch():
+    psycopg2 = pytest.importorskip('psycopg2')
+    database = 'git_db_ddl_test_%d' % os.getpid()
+    try:
+        admin = psycopg2.connect(dbname='postgres', connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        pytest.skip('no PostgreSQL server reachable: %s' % str(e).strip())
+    admin.autocommit = True
+    admin.cursor().execute('CREATE DATABASE %s' % database)
+    connection = psycopg2.connect(dbname=database)
+    try:
+        connection.cursor().execute('CREATE TABLE public.p (id integer PRIMARY KEY)')
+        connection.commit()
+        yield connection
+    finally:
+        connection.close()
+        admin.cursor().execute('DROP DATABASE %s' % database)
+        admin.close()
+
+
+@pytest.mark.parametrize('name,target,current,expected', ALTER_CASES, ids=[c[0] for c in ALTER_CASES])
+def test_alter_statements_run(scratch, name, target, current, expected):
+    # the generated statements are valid for a table created from the target
+    # file, online or not
+    cursor = scratch.cursor()
+    try:
+        for online in [False, True]:
+            cursor.execute('SAVEPOINT alter_case')
+            cursor.execute('CREATE TABLE public.t (%s)' % target)
+            table = parseColumns(current)
+            commands = ddl.alterTable(parseColumns(target), table)
+            followUps = []
+            if online:
+                commands, followUps = ddl.onlineAlterTable(table, commands)
+            if len(commands) > 0:
+                cursor.execute('ALTER TABLE public.t ' + ', '.join(commands))
+            for statement in followUps:
+                cursor.execute(statement)
+            cursor.execute('ROLLBACK TO SAVEPOINT alter_case')
+    finally:
+        scratch.rollback()
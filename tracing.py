@@ -0,0 +1,265 @@
+import json
+import os
+import threading
+from time import perf_counter, time
+
+import lazy
+
+git = lazy.load('git')
+psycopg2 = lazy.load('psycopg2')
+
+# Timed spans and counters of a git-db run, recorded when the command is given
+# '--trace' or '--trace=<file>', or when the GIT_DB_TRACE environment variable
+# is set ('1' for the default file, or a file name). Spans are written as JSON
+# lines, or in the Chrome trace event format (chrome://tracing, Perfetto) when
+# the file name ends with '.json', and the hot spots are summarized at the end
+# of the run. While tracing is off span() returns a shared no-op context and
+# count() returns right away.
+
+ENVIRONMENT_VARIABLE = 'GIT_DB_TRACE'
+DEFAULT_PATH = '.git/git-db-trace.jsonl'
+SUMMARY_SIZE = 10
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'args', 'thread', 'start', 'duration', 'childTime')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.thread = None
+        self.start = 0.0
+        self.duration = 0.0
+        # time spent in spans nested into this one, on the same thread
+        self.childTime = 0.0
+
+    def __enter__(self):
+        self.tracer.getStack().append(self)
+        self.thread = threading.get_ident()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration = perf_counter() - self.start
+        stack = self.tracer.getStack()
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1].childTime += self.duration
+        self.tracer.record(self)
+        return False
+
+    def set(self, **args):
+        # adds details only known once the span ran, like a row count
+        self.args.update(args)
+
+    def selfTime(self):
+        return self.duration - self.childTime
+
+
+class Tracer:
+    def __init__(self):
+        self.path = None
+        self.spans = []
+        self.counters = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = 0.0
+        self.startedAt = 0.0
+        self.gitTraced = False
+        self.cursorClass = None
+
+    def isEnabled(self):
+        return self.path is not None
+
+    def start(self, path):
+        self.path = path
+        self.started = perf_counter()
+        self.startedAt = time()
+        self.getThread(threading.get_ident())
+        self.traceGitCommands()
+
+    def span(self, name, **args):
+        if self.path is None:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def count(self, name, n=1):
+        if self.path is None:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def getStack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def getThread(self, ident):
+        # small thread numbers in the order threads recorded their first span
+        with self.lock:
+            return self.threads.setdefault(ident, len(self.threads))
+
+    def record(self, span):
+        thread = self.getThread(span.thread)
+        with self.lock:
+            self.spans.append((thread, span))
+
+    def traceGitCommands(self):
+        # GitPython runs every git command (diff, add, commit, ...) through
+        # Git.execute, wrapping it gives them a span and counts the process
+        if self.gitTraced:
+            return
+        self.gitTraced = True
+        execute = git.cmd.Git.execute
+        tracer = self
+
+        def tracedExecute(self, command, *args, **kwargs):
+            words = [w for w in command[1:] if not str(w).startswith('-')] \
+                if isinstance(command, (list, tuple)) else []
+            tracer.count('subprocesses')
+            with tracer.span('git ' + str(words[0]) if words else 'git'):
+                return execute(self, command, *args, **kwargs)
+
+        git.cmd.Git.execute = tracedExecute
+
+    def finish(self, log=print):
+        if self.path is None:
+            return
+        total = perf_counter() - self.started
+        try:
+            with open(self.path, 'w') as f:
+                if self.path.endswith('.json'):
+                    self.writeChromeTrace(f, total)
+                else:
+                    self.writeJsonLines(f, total)
+        except OSError as e:
+            log('[WARNING] Unable to write the trace to \'%s\': %s' % (self.path, e))
+        self.printSummary(total, log)
+        self.path = None
+        self.spans = []
+        self.counters = {}
+        self.threads = {}
+
+    def writeJsonLines(self, f, total):
+        f.write(json.dumps({'type': 'run', 'started': self.startedAt, 'duration': total,
+            'pid': os.getpid()}) + '\n')
+        for thread, span in self.spans:
+            f.write(json.dumps({'type': 'span', 'name': span.name, 'thread': thread,
+                'start': round(span.start - self.started, 6),
+                'duration': round(span.duration, 6), 'self': round(span.selfTime(), 6),
+                'args': span.args}, default=str) + '\n')
+        f.write(json.dumps({'type': 'counters', 'counters': self.counters}) + '\n')
+
+    def writeChromeTrace(self, f, total):
+        pid = os.getpid()
+        events = []
+        for ident, thread in self.threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread,
+                'args': {'name': 'main' if thread == 0 else 'worker %d' % thread}})
+        for thread, span in self.spans:
+            events.append({'name': span.name, 'cat': 'git-db', 'ph': 'X', 'pid': pid,
+                'tid': thread, 'ts': round((span.start - self.started) * 1e6, 1),
+                'dur': round(span.duration * 1e6, 1), 'args': span.args})
+        events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'tid': 0,
+            'ts': round(total * 1e6, 1), 'args': self.counters})
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+    def printSummary(self, total, log=print):
+        # spans are grouped by name and ranked by their own time, excluding the
+        # spans nested into them, followed by the slowest single spans
+        groups = {}
+        for thread, span in self.spans:
+            group = groups.setdefault(span.name, [0, 0.0, 0.0, 0.0])
+            group[0] += 1
+            group[1] += span.duration
+            group[2] += span.selfTime()
+            group[3] = max(group[3], span.duration)
+        log('\n======== Trace summary (%.3fs, %d spans, written to %s) ========'
+            % (total, len(self.spans), self.path))
+        log('%-32s %8s %10s %10s %10s' % ('span', 'calls', 'total', 'self', 'max'))
+        ranked = sorted(groups.items(), key=lambda item: item[1][2], reverse=True)
+        for name, (calls, spanTotal, selfTotal, longest) in ranked[:SUMMARY_SIZE]:
+            log('%-32s %8d %9.3fs %9.3fs %9.3fs' % (name[:32], calls, spanTotal, selfTotal, longest))
+        slowest = sorted(self.spans, key=lambda item: item[1].duration, reverse=True)
+        slowest = [span for thread, span in slowest if len(span.args) > 0][:SUMMARY_SIZE]
+        if len(slowest) > 0:
+            log('slowest:')
+            for span in slowest:
+                log('%9.3fs %s %s' % (span.duration, span.name,
+                    ' '.join('%s=%s' % (key, value) for key, value in span.args.items())))
+        if len(self.counters) > 0:
+            log('counters: ' + ', '.join('%s=%d' % (name, value)
+                for name, value in sorted(self.counters.items())))
+
+
+def createTracingCursor():
+    # psycopg2 is only imported once a connection is opened, so is the class
+    class TracingCursor(psycopg2.extensions.cursor):
+        # every query gets a span and is counted
+        def execute(self, query, vars=None):
+            tracer.count('queries')
+            with tracer.span('query'):
+                return super().execute(query, vars)
+
+    return TracingCursor
+
+
+tracer = Tracer()
+
+
+def start(path=None):
+    tracer.start(path or DEFAULT_PATH)
+
+
+def getEnvironmentPath():
+    # the file GIT_DB_TRACE asks for, None when tracing isn't requested
+    value = os.environ.get(ENVIRONMENT_VARIABLE, '')
+    if value in ['', '0', 'false', 'no', 'off']:
+        return None
+    if value in ['1', 'true', 'yes', 'on']:
+        return DEFAULT_PATH
+    return value
+
+
+def isEnabled():
+    return tracer.isEnabled()
+
+
+def span(name, **args):
+    return tracer.span(name, **args)
+
+
+def count(name, n=1):
+    tracer.count(name, n)
+
+
+def getCursorFactory():
+    # for psycopg2.connect(); None keeps the default cursor while tracing is off
+    if not tracer.isEnabled():
+        return None
+    if tracer.cursorClass is None:
+        tracer.cursorClass = createTracingCursor()
+    return tracer.cursorClass
+
+
+def finish(log=print):
+    tracer.finish(log)